@@ -1,22 +1,215 @@
+
 import asyncio
+import logging
 import os
-
-from pinecone import Pinecone
-from pinecone_plugins.assistant.models.chat import Message
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from box_integration.box_client import get_client
-from box_integration.box_integration import download_files, get_files_in_folder
+from box_integration.box_integration import download_file, get_files_in_folder
+from ingestion.manifest import file_fingerprint
 
 import config
 
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
 PINECONE_API_KEY = config.PINECONE_API_KEY
 
+ASSISTANT_NAME = getattr(config, "ASSISTANT_NAME", "box-assistant")
+# Number of files downloaded and uploaded to the assistant in parallel
+ASSISTANT_SYNC_WORKERS = getattr(config, "ASSISTANT_SYNC_WORKERS", 4)
+
+def get_or_create_assistant(pc, assistant_name=ASSISTANT_NAME):
+    """
+    Returns the assistant with the given name, creating it if it does not exist yet.
+
+    Parameters:
+    - pc: The Pinecone client.
+    - assistant_name: The name of the assistant (default is ASSISTANT_NAME).
+
+    Returns:
+    - The assistant.
+    """
+    if any(assistant.name == assistant_name for assistant in pc.assistant.list_assistants()):
+        logging.info(f"Reusing assistant {assistant_name}")
+        return pc.assistant.Assistant(assistant_name=assistant_name)
+
+    logging.info(f"Creating assistant {assistant_name}")
+    return pc.assistant.create_assistant(
+        assistant_name=assistant_name,
+        instructions="Use American English for spelling and grammar.", # Description or directive for the assistant to apply to all responses.
+        region="us", # Region to deploy assistant. Options: "us" (default) or "eu".
+        timeout=30 # Maximum seconds to wait for assistant status to become "Ready" before timing out.
+    )
+
+def box_file_version(file):
+    """
+    Returns the version of a Box file stored in the metadata of its assistant copy.
+
+    Parameters:
+    - file: The Box file object.
+
+    Returns:
+    - The file version ID, or the SHA-1 of the content when the version is unknown.
+    """
+    fingerprint = file_fingerprint(file)
+    return str(fingerprint["version"] or fingerprint["sha1"])
+
+def plan_assistant_sync(box_files, assistant_files):
+    """
+    Compares the files of the Box folder with the files of the assistant.
+
+    Assistant files are matched to Box files by the "box_file_id" and
+    "box_file_version" of their metadata. Files without this metadata were
+    not uploaded by the sync and are replaced.
+
+    Parameters:
+    - box_files: The Box file objects of the folder.
+    - assistant_files: The files of the assistant.
+
+    Returns:
+    - A tuple of the Box files to upload, a dictionary of the assistant file IDs
+      to delete once the upload of a Box file ID is done, the assistant file IDs
+      to delete right away, and the number of unchanged files.
+    """
+    uploaded = {}
+    stale = []
+    for assistant_file in assistant_files:
+        metadata = getattr(assistant_file, "metadata", None) or {}
+        box_file_id = metadata.get("box_file_id")
+        if box_file_id is None or box_file_id in uploaded:
+            stale.append(assistant_file.id)
+        else:
+            uploaded[box_file_id] = (assistant_file.id, metadata.get("box_file_version"))
+
+    to_upload = []
+    replaced = {}
+    unchanged = 0
+    for file in box_files:
+        assistant_file_id, version = uploaded.pop(file.id, (None, None))
+        if assistant_file_id is None:
+            to_upload.append(file)
+        elif version != box_file_version(file):
+            to_upload.append(file)
+            replaced[file.id] = assistant_file_id
+        else:
+            unchanged += 1
+
+    # Whatever is left was removed from the folder
+    stale.extend(assistant_file_id for assistant_file_id, _ in uploaded.values())
+    return to_upload, replaced, stale, unchanged
+
+def sync_assistant(box_client, assistant, folder_id, box_user_id, max_workers=ASSISTANT_SYNC_WORKERS):
+    """
+    Makes the files of the assistant match the files of a Box folder.
+
+    Only new and changed files are downloaded, into a temporary directory,
+    and uploaded, with up to max_workers files in flight. The previous copy
+    of a changed file is deleted after its new copy is uploaded, and files
+    removed from the folder are deleted from the assistant. Running the sync
+    again after an interruption picks up where it stopped.
+
+    Parameters:
+    - box_client: The Box client used to interact with the Box service.
+    - assistant: The assistant to sync.
+    - folder_id: The ID of the Box folder.
+    - box_user_id: The ID of the Box user, stored in the metadata of every file.
+    - max_workers: The number of files synced in parallel (default is ASSISTANT_SYNC_WORKERS).
+
+    Returns:
+    - A dictionary with the number of "uploaded", "deleted", "unchanged" and "failed" files.
+    """
+    box_files = get_files_in_folder(box_client, folder_id)
+    to_upload, replaced, stale, unchanged = plan_assistant_sync(box_files, assistant.list_files())
+    logging.info(f"Assistant sync: {len(to_upload)} files to upload, {len(stale)} to delete, {unchanged} unchanged")
+    stats = {"uploaded": 0, "deleted": 0, "unchanged": unchanged, "failed": 0}
+    lock = threading.Lock()
+
+    def count(outcome):
+        with lock:
+            stats[outcome] += 1
+
+    def delete(assistant_file_id):
+        try:
+            assistant.delete_file(file_id=assistant_file_id)
+            count("deleted")
+        except Exception as e:
+            logging.error(f"Failed to delete assistant file {assistant_file_id}: {e}")
+
+    def upload(file, download_dir):
+        # One directory per file, so files with the same name in different folders do not collide
+        target_dir = os.path.join(download_dir, file.id)
+        os.mkdir(target_dir)
+        try:
+            file_name = download_file(box_client, file, target_dir)
+            file_path = os.path.join(target_dir, file_name)
+            assistant.upload_file(
+                file_path=file_path,
+                metadata={
+                    "box_user_id": box_user_id,
+                    "box_file_id": file.id,
+                    "box_file_version": box_file_version(file),
+                },
+                timeout=None
+            )
+            os.remove(file_path)
+            count("uploaded")
+        except Exception as e:
+            logging.error(f"Failed to sync file {file.name} ({file.id}) to the assistant: {e}")
+            count("failed")
+            return
+        if file.id in replaced:
+            delete(replaced[file.id])
+
+    with tempfile.TemporaryDirectory(prefix="box-assistant-") as download_dir:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="assistant-sync") as executor:
+            for assistant_file_id in stale:
+                executor.submit(delete, assistant_file_id)
+            for file in to_upload:
+                executor.submit(upload, file, download_dir)
+
+    logging.info(f"Assistant sync finished: {stats}")
+    return stats
+
+def run_background_sync(box_client, assistant, folder_id, box_user_id):
+    """
+    Runs sync_assistant on a daemon thread and prints a line when it is done.
+
+    Quitting the chat does not wait for the sync: the next run completes it.
+
+    Returns:
+    - The started thread.
+    """
+    def run():
+        try:
+            stats = sync_assistant(box_client, assistant, folder_id, box_user_id)
+        except Exception as e:
+            logging.error(f"Assistant sync failed: {e}")
+            print(f"\n[sync failed: {e}]")
+            return
+        print(
+            f"\n[sync done: {stats['uploaded']} uploaded, {stats['deleted']} deleted, "
+            f"{stats['unchanged']} unchanged, {stats['failed']} failed]"
+        )
+
+    thread = threading.Thread(target=run, name="assistant-sync", daemon=True)
+    thread.start()
+    return thread
+
 async def main():
-    
+
     if not PINECONE_API_KEY:
         print("Error: PINECONE_API_KEY environment variable not set.")
         return
-    
+
+    # Imported on use, the Pinecone SDK and its assistant plugin are slow to load
+    # pylint: disable=import-outside-toplevel
+    from pinecone import Pinecone
+    from pinecone_plugins.assistant.models.chat import Message
+
     pc = Pinecone(api_key=PINECONE_API_KEY)
 
     # Initialize Box client
@@ -25,41 +218,12 @@ async def main():
     # Get Box User ID for namespacing
     box_user = box_client.user().get()
 
-    # Define the Box folder ID containing the files
-    folder_id = config.BOX_FOLDER_ID
-    
-    # Get all files in the specified folder
-    files = get_files_in_folder(box_client, folder_id)
-
-    download_files(box_client, files)
+    assistant = get_or_create_assistant(pc)
 
-    assistant = pc.assistant.create_assistant(
-        assistant_name="box-assistant", 
-        instructions="Use American English for spelling and grammar.", # Description or directive for the assistant to apply to all responses.
-        region="us", # Region to deploy assistant. Options: "us" (default) or "eu".
-        timeout=30 # Maximum seconds to wait for assistant status to become "Ready" before timing out.
-    )
+    # Bring the assistant up to date with the Box folder while chatting
+    print("Syncing files in the background, answers cover the files uploaded so far...")
+    run_background_sync(box_client, assistant, config.BOX_FOLDER_ID, box_user.id)
 
-    # Define the Box folder ID containing the files
-    folder_id = config.BOX_FOLDER_ID
-    
-    # Get all files in the specified folder
-    files = get_files_in_folder(box_client, folder_id)
-
-    print("Downloading files...")
-
-    file_names = download_files(box_client, files)
-
-    print("Uploading files...")
-
-    for file_name in file_names:
-        # Upload a file.
-        response = assistant.upload_file(
-            file_path=f"./{file_name}",
-            metadata={"box_user_id": box_user.id},
-            timeout=None
-        )
-    
     while True:
         try:
             user_input = await asyncio.to_thread(input, "You: ")
@@ -70,18 +234,14 @@ async def main():
         if user_input.lower() in ["quit", "exit"]:
             print("Exiting...")
             break
-        
+
         if not user_input.strip():
             continue
 
         msg = Message(role="user", content=user_input)
-        resp = assistant.chat(messages=[msg])
+        resp = await asyncio.to_thread(assistant.chat, messages=[msg])
 
         print(f"Assistant:\n{resp.message.content}")
 
-    pc.assistant.delete_assistant(
-        assistant_name="box-assistant", 
-    )
-
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,215 @@
+"""batch_query.py"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from box_integration.box_client import get_client
+from pinecone_integration.pinecone_client import get_pinecone_index
+from pinecone_integration.query_utils import query_pinecone, search_results_to_dict
+from pinecone_integration.context_builder import build_context
+from common import metrics
+from query import initialize_openai, query_openai_for_answer, QUERY_TOP_K
+import argparse
+import csv
+import json
+import os
+import time
+import config
+import logging
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+# Questions answered at once, the Pinecone and OpenAI requests are limited by the request scheduler
+BATCH_WORKERS = getattr(config, "BATCH_QUERY_WORKERS", 12)
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Answer a batch of questions about the indexed Box files.")
+    parser.add_argument("questions", help="A .jsonl file with a \"question\" per line, or a .csv file with a \"question\" column. An \"id\" is optional.")
+    parser.add_argument("output", help="The .jsonl file the answers are appended to.")
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Answer every question again instead of resuming, the output file is overwritten.",
+    )
+    return parser.parse_args(argv)
+
+def read_questions(path):
+    """
+    Reads the questions of a JSONL or CSV file.
+
+    Parameters:
+    - path: The path of the file, the format is chosen by its extension.
+
+    Returns:
+    - A generator of dictionaries with the "id" and "question", and any other field of the input.
+      The id defaults to the line number of the question.
+    """
+    with open(path, "r", encoding="UTF-8", newline="") as file:
+        if path.lower().endswith(".csv"):
+            rows = csv.DictReader(file)
+        else:
+            rows = (json.loads(line) for line in file if line.strip())
+        for number, row in enumerate(rows, start=1):
+            if not isinstance(row, dict):
+                logging.warning(f"Skipping question {number}, not a JSON object")
+                continue
+            if not row.get("question"):
+                logging.warning(f"Skipping question {number} without text")
+                continue
+            row["id"] = str(row.get("id") or number)
+            yield row
+
+def read_answered_ids(path):
+    """
+    Reads the IDs of the questions answered without error in a previous run.
+
+    Parameters:
+    - path: The path of the output file.
+
+    Returns:
+    - A set of question IDs.
+    """
+    answered = set()
+    if not os.path.isfile(path):
+        return answered
+    with open(path, "r", encoding="UTF-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # Last line of an interrupted run
+                continue
+            if not isinstance(result, dict) or "id" not in result:
+                # Not a result written by run_batch
+                continue
+            if "error" not in result:
+                answered.add(str(result["id"]))
+    return answered
+
+def answer_batch_question(openai_client, pinecone_index, box_user_id, row, top_k=QUERY_TOP_K):
+    """
+    Runs the search, context packing and answer of one question.
+
+    Parameters:
+    - openai_client: The OpenAI client used to interact with the OpenAI service.
+    - pinecone_index: The Pinecone index to search in.
+    - box_user_id: The namespace identifier for the Box user.
+    - row: The question, a dictionary with the "id" and "question".
+    - top_k: The number of search results (default is QUERY_TOP_K).
+
+    Returns:
+    - The result dictionary, with the "answer", the "sources" and the "timings" of each stage in seconds,
+      or the "error" if the question failed.
+    """
+    result = {"id": row["id"], "question": row["question"]}
+    timings = {}
+    started = time.perf_counter()
+    try:
+        stage_started = time.perf_counter()
+        results = search_results_to_dict(query_pinecone(pinecone_index, row["question"], box_user_id, top_k=top_k))
+        timings["search"] = time.perf_counter() - stage_started
+
+        stage_started = time.perf_counter()
+        context, sources = build_context(results['result']['hits'])
+        timings["context"] = time.perf_counter() - stage_started
+        metrics.observe("context_build_seconds", timings["context"])
+
+        stage_started = time.perf_counter()
+        result["answer"] = query_openai_for_answer(openai_client, row["question"], context)
+        timings["answer"] = time.perf_counter() - stage_started
+        result["sources"] = sources
+    except Exception as e:
+        logging.error(f"Failed to answer question {row['id']}: {e}")
+        result["error"] = str(e)
+    timings["total"] = time.perf_counter() - started
+    metrics.observe("question_seconds", timings["total"])
+    result["timings"] = {stage: round(seconds, 4) for stage, seconds in timings.items()}
+    return result
+
+def run_batch(openai_client, pinecone_index, box_user_id, questions, output_path, resume=True):
+    """
+    Answers the questions concurrently, appending each result to the output file as soon as it is ready.
+
+    Parameters:
+    - openai_client: The OpenAI client used to interact with the OpenAI service.
+    - pinecone_index: The Pinecone index to search in.
+    - box_user_id: The namespace identifier for the Box user.
+    - questions: An iterable of question dictionaries, see read_questions.
+    - output_path: The path of the JSONL output file.
+    - resume: Skip the questions already answered in the output file (default is True).
+
+    Returns:
+    - A dictionary with the number of "answered", "failed" and "skipped" questions.
+    """
+    answered_ids = read_answered_ids(output_path) if resume else set()
+    stats = {"answered": 0, "failed": 0, "skipped": 0}
+    workers = BATCH_WORKERS
+
+    with open(output_path, "a" if resume else "w", encoding="UTF-8") as output, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-query") as executor:
+        if resume and output.tell() and not _ends_with_newline(output_path):
+            # Terminate the partial last line of an interrupted run
+            output.write("\n")
+
+        def write_done(futures):
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+                stats["failed" if "error" in result else "answered"] += 1
+            return pending
+
+        # Only a few questions are queued ahead of the workers, so reading the input stays lazy
+        in_flight = set()
+        for row in questions:
+            if row["id"] in answered_ids:
+                stats["skipped"] += 1
+                continue
+            in_flight.add(executor.submit(
+                answer_batch_question, openai_client, pinecone_index, box_user_id, row
+            ))
+            if len(in_flight) >= workers * 2:
+                in_flight = write_done(in_flight)
+        while in_flight:
+            in_flight = write_done(in_flight)
+
+    logging.info(f"Answered {stats['answered']} questions, {stats['failed']} failed, {stats['skipped']} already answered")
+    return stats
+
+def _ends_with_newline(path):
+    with open(path, "rb") as file:
+        file.seek(-1, os.SEEK_END)
+        return file.read(1) == b"\n"
+
+def main(argv=None):
+    """
+    Answers the questions of a file and writes the answers, with the timings of each stage, to a JSONL file.
+    """
+    args = parse_args(argv)
+
+    # Initialize OpenAI and Pinecone clients
+    openai_client = initialize_openai()
+    pinecone_index = get_pinecone_index()
+
+    # Get Box User ID for namespacing
+    box_client = get_client()
+    box_user = box_client.user().get()
+
+    with metrics.profile("batch questions"):
+        stats = run_batch(
+            openai_client,
+            pinecone_index,
+            box_user.id,
+            read_questions(args.questions),
+            args.output,
+            resume=not args.restart,
+        )
+    metrics.report()
+    print(f"Answered: {stats['answered']}, failed: {stats['failed']}, skipped: {stats['skipped']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""
+Benchmark of the text cleaner.
+---
+Checks that clean_up_text produces exactly the output of the original
+regular expression implementation on a golden corpus, then reports the
+throughput of both in MB/s.
+
+Usage:
+    python -m benchmarks.bench_clean_text [--size-mb 20] [--repeat 3]
+"""
+import argparse
+import random
+import re
+import time
+from box_integration.text_cleaning import clean_up_text
+
+
+def legacy_clean_up_text(content):
+    """
+    The original implementation of clean_up_text, kept as the reference output.
+    """
+    if not content:
+        return content
+    content = re.sub(r'(\w+)-\n(\w+)', r'\1\2', content)
+    unwanted_patterns = [
+        "\\n", "  —", "——————————", "—————————", "—————",
+        r'\\u[\dA-Fa-f]{4}', r'\uf075', r'\uf0b7'
+    ]
+    for pattern in unwanted_patterns:
+        content = re.sub(pattern, "", content)
+    content = re.sub(r'(\w)\s*-\s*(\w)', r'\1-\2', content)
+    content = re.sub(r'\s+', ' ', content)
+    return content
+
+
+# Edge cases of the cleaning rules and of how they interact
+GOLDEN_CASES = [
+    "",
+    " ",
+    "\n",
+    "plain text",
+    "exam-\nple",
+    "ab-\ncd-\nef",
+    "a-\nb-\nc-\nd",
+    "trailing-\n",
+    "-\nleading",
+    "co-\n-op",
+    "a - b - c",
+    "a -b -c",
+    "a--b",
+    "a - - b",
+    "2024 - 01 - 05",
+    "x \t-\t y",
+    "well-known, self - evident",
+    "dash——————————run",
+    "dash—————————————————run",
+    "nine—————————dashes",
+    "  ——————————  ",
+    "  —  —   —",
+    "—\n————",
+    "— \n————",
+    "escaped \\u00e9 and \\u00E9\\u12",
+    "\\\\u0041",
+    "bullet \uf0b7 item \uf075 box",
+    "—\uf075————",
+    "a\uf0b7-\nb",
+    "word\u00a0-\u2003word",
+    "\u2003lead and trail\u00a0",
+    "snake_case - _private",
+    "ünïcödé-\nwörds - déjà",
+    "line one\nline two\n\nline three",
+    "\t\t",
+]
+
+_VOCABULARY = [
+    "the", "report", "quarterly", "revenue", "self", "well", "known", "Box", "Pinecone",
+    "2024", "01", "_id", "naïve", "café", "data,", "(see", "table)", "e.g.", "A.1",
+]
+
+_NOISE = [
+    " ", " ", " ", " ", "\n", "\n\n", "\t", "  ", "-", " - ", "-\n", " -", "- ",
+    "—————", "——————————", "  —", "\\u00e9", "\\uZZZZ", "\uf0b7", "\uf075", "\u00a0", ". ",
+]
+
+
+def generate_document(size, seed):
+    """
+    Generates a document mixing prose with the noise found in extracted text.
+
+    Parameters:
+    - size: The approximate number of characters.
+    - seed: The random seed, the corpus is deterministic.
+
+    Returns:
+    - The document.
+    """
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        part = rng.choice(_VOCABULARY) if rng.random() < 0.7 else rng.choice(_NOISE)
+        parts.append(part)
+        length += len(part)
+    return "".join(parts)
+
+
+def generate_prose(size, seed):
+    """
+    Generates line wrapped prose, the typical shape of a PDF text extraction.
+    """
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join(rng.choice(_VOCABULARY[:9]) for _ in range(12))
+        if rng.random() < 0.15:
+            line += " hyphen-"
+        if rng.random() < 0.05:
+            line += " 10 - 12"
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def check_golden_corpus():
+    """
+    Compares clean_up_text with the reference implementation.
+
+    Returns:
+    - The number of corpus entries checked.
+    """
+    corpus = list(GOLDEN_CASES)
+    corpus.extend(generate_document(200, seed) for seed in range(2000))
+    corpus.extend(generate_document(20000, seed) for seed in range(20))
+    rng = random.Random(0)
+    alphabet = ["a", "_", "1", " ", "\t", "\n", "-", "—", "\\", "u", "0", "F", "\uf075", "\uf0b7", "é", ".", "\u00a0"]
+    corpus.extend("".join(rng.choice(alphabet) for _ in range(rng.randint(1, 16))) for _ in range(50000))
+
+    for entry in corpus:
+        expected = legacy_clean_up_text(entry)
+        actual = clean_up_text(entry)
+        if actual != expected:
+            raise AssertionError(f"Output differs for {entry!r}: expected {expected!r}, got {actual!r}")
+    return len(corpus)
+
+
+def measure(function, document, repeat):
+    """
+    Returns the best throughput of function over repeat runs, in MB/s.
+    """
+    size_mb = len(document.encode("utf-8")) / 1_000_000
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(document)
+        best = min(best, time.perf_counter() - start)
+    return size_mb / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark clean_up_text against the original implementation.")
+    parser.add_argument("--size-mb", type=float, default=20, help="Size of the generated documents.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the best one is reported.")
+    args = parser.parse_args()
+
+    checked = check_golden_corpus()
+    print(f"Golden corpus: {checked} entries, output identical to the original implementation")
+
+    size = int(args.size_mb * 1_000_000)
+    documents = {
+        "prose": generate_prose(size, seed=1),
+        "noisy": generate_document(size, seed=2),
+    }
+    print(f"{'document':<10}{'original MB/s':>16}{'cleaner MB/s':>16}{'speedup':>10}")
+    for name, document in documents.items():
+        original = measure(legacy_clean_up_text, document, args.repeat)
+        cleaner = measure(clean_up_text, document, args.repeat)
+        print(f"{name:<10}{original:>16.1f}{cleaner:>16.1f}{cleaner / original:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark of the process pool offload of cleaning and chunking.
+---
+Runs the process stage of the indexer on large generated documents from
+as many threads as worker processes, first in the threads themselves,
+then offloaded to 1, 2, 4... worker processes, and reports the MB/s of
+each run. The records of every run must match the in-thread ones.
+
+Usage:
+    python -m benchmarks.bench_cpu_offload [--documents 16] [--size-mb 2] [--max-processes 16]
+"""
+import argparse
+import os
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from benchmarks.bench_clean_text import generate_prose
+from ingestion import cpu_offload, indexer, text_cache
+
+
+def run(documents, threads):
+    """Runs the process stage on every document from threads threads, returns the seconds and the records."""
+    file = types.SimpleNamespace(id="bench", name="bench.pdf", created_at=None, modified_at=None, size=0)
+
+    def process(text):
+        job = indexer.FileJob(None, file, "bench-user")
+        job.text = text
+        return indexer.process_stage(job).records
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        records = list(executor.map(process, documents))
+    return time.perf_counter() - started, records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the process pool offload of cleaning and chunking.")
+    parser.add_argument("--documents", type=int, default=16, help="Number of documents.")
+    parser.add_argument("--size-mb", type=float, default=2, help="Size of each document in MB.")
+    parser.add_argument("--max-processes", type=int, default=os.cpu_count(), help="Largest number of worker processes.")
+    args = parser.parse_args(argv)
+
+    documents = [generate_prose(int(args.size_mb * 1_000_000), seed=number) for number in range(args.documents)]
+    megabytes = sum(len(document) for document in documents) / 1_000_000
+    cpu_offload.CPU_OFFLOAD_MIN_CHARS = 0
+    text_cache.TEXT_CACHE_ENABLED = False
+
+    cpu_offload.CPU_OFFLOAD = False
+    baseline_seconds, baseline = run(documents, args.max_processes)
+    print(f"{'in threads':<16}{megabytes / baseline_seconds:>10.2f} MB/s")
+
+    cpu_offload.CPU_OFFLOAD = True
+    processes = 1
+    while processes <= args.max_processes:
+        cpu_offload._pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+        # Start the workers before timing
+        list(cpu_offload._pool.map(int, range(processes)))
+        seconds, records = run(documents, processes)
+        cpu_offload._pool.shutdown()
+        if records != baseline:
+            raise SystemExit(f"Records differ with {processes} processes")
+        print(f"{f'{processes} workers':<16}{megabytes / seconds:>10.2f} MB/s  x{baseline_seconds / seconds:.2f}")
+        processes *= 2
+
+
+if __name__ == "__main__":
+    main()
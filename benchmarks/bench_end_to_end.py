@@ -0,0 +1,240 @@
+"""
+End to end benchmark of ingestion and querying, against local fake services.
+---
+Starts the fakes of benchmarks.fakes, points main.py and query.py at them
+and runs both unchanged: main.main() indexes the fake folder, then the
+interactive loop of query.main() answers generated questions read from a
+patched input(). Reports files/s, chunks/s, MB of text cleaned/s, the
+p50/p99 latency of the questions and the peak RSS of the process.
+
+Results can be saved as a JSON baseline and compared with a previous one,
+the exit code is 1 when a metric regressed more than the tolerance.
+
+Usage:
+    python -m benchmarks.bench_end_to_end [--files 200] [--file-kb 100] [--latency-ms 5]
+        [--rate-limit-ratio 0.01] [--questions 50] [--save results.json] [--compare baseline.json]
+"""
+import argparse
+import builtins
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import config
+import main as ingestion_main
+import query
+from openai import OpenAI
+from benchmarks.fakes import FakeBoxServer, FakeChatServer, FakeIndex, VOCABULARY
+
+# Metrics compared with a baseline, and whether higher values are better
+METRICS = {
+    "ingestion.files_per_second": True,
+    "ingestion.chunks_per_second": True,
+    "ingestion.mb_cleaned_per_second": True,
+    "query.p50_seconds": False,
+    "query.p99_seconds": False,
+    "peak_rss_mb": False,
+}
+
+
+def percentile(values, fraction):
+    """Returns the value below which the given fraction of the values fall (nearest rank)."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of the process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_ingestion(box, index):
+    """
+    Runs main.main() against the fake Box server and index.
+
+    Returns:
+    - A dictionary of ingestion metrics.
+    """
+    ingestion_main.get_client = box.client
+    ingestion_main.get_pinecone_index = lambda: index
+    started = time.perf_counter()
+    ingestion_main.main([])
+    elapsed = time.perf_counter() - started
+
+    files = box.counters.get("files_served", 0)
+    megabytes = box.counters.get("bytes_served", 0) / 1_000_000
+    return {
+        "seconds": round(elapsed, 3),
+        "files": files,
+        "chunks": index.upserted_records,
+        "megabytes": round(megabytes, 3),
+        "box_requests": box.counters.get("requests", 0),
+        "rate_limited": box.counters.get("rate_limited", 0),
+        "files_per_second": round(files / elapsed, 2),
+        "chunks_per_second": round(index.upserted_records / elapsed, 2),
+        "mb_cleaned_per_second": round(megabytes / elapsed, 3),
+    }
+
+
+def run_queries(box, index, chat, questions):
+    """
+    Runs the interactive loop of query.main() with the given questions typed in.
+
+    Returns:
+    - A dictionary of query metrics.
+    """
+    query.get_client = box.client
+    query.get_pinecone_index = lambda: index
+    query.initialize_openai = lambda: OpenAI(api_key="bench", base_url=chat.base_url, max_retries=0)
+
+    latencies = []
+    pending = iter(questions)
+    asked = [None]
+
+    def fake_input(prompt=""):
+        # A question is answered once the loop asks for the next one
+        if asked[0] is not None:
+            latencies.append(time.perf_counter() - asked[0])
+        try:
+            question = next(pending)
+        except StopIteration:
+            raise EOFError from None
+        asked[0] = time.perf_counter()
+        return question
+
+    original_input = builtins.input
+    builtins.input = fake_input
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            query.main([])
+    finally:
+        builtins.input = original_input
+
+    return {
+        "questions": len(latencies),
+        "searches": index.searches,
+        "completions": chat.counters.get("completions", 0),
+        "prompt_characters": chat.counters.get("prompt_characters", 0),
+        "p50_seconds": round(percentile(latencies, 0.5), 4),
+        "p99_seconds": round(percentile(latencies, 0.99), 4),
+        "mean_seconds": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+    }
+
+
+def generate_questions(count, seed):
+    """Generates distinct questions from the vocabulary of the fake documents."""
+    rng = random.Random(seed)
+    return [f"{' '.join(rng.choice(VOCABULARY) for _ in range(5))} {number}?" for number in range(count)]
+
+
+def metric(results, name):
+    """Reads a dotted metric name from a results dictionary."""
+    value = results
+    for key in name.split("."):
+        value = value[key]
+    return value
+
+
+def compare(results, baseline, tolerance, metrics=None):
+    """
+    Prints the change of every metric against a baseline.
+
+    Parameters:
+    - results: The results of the current run.
+    - baseline: The results of the baseline run.
+    - tolerance: The relative change reported as a regression.
+    - metrics: The dotted names of the compared metrics, mapped to whether higher values are better
+      (default is METRICS).
+
+    Returns:
+    - The names of the metrics that regressed by more than the tolerance.
+    """
+    regressions = []
+    print(f"\n{'metric':<34}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, higher_is_better in (metrics or METRICS).items():
+        try:
+            before, after = metric(baseline, name), metric(results, name)
+        except KeyError:
+            continue
+        change = (after - before) / before if before else 0.0
+        regressed = -change > tolerance if higher_is_better else change > tolerance
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<34}{before:>12}{after:>12}{change:>+9.1%}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ingestion and querying against local fake services.")
+    parser.add_argument("--files", type=int, default=200, help="Number of files in the fake Box folder.")
+    parser.add_argument("--folders", type=int, default=4, help="Number of subfolders the files are spread over.")
+    parser.add_argument("--file-kb", type=int, default=100, help="Size of the extracted text of each file, in KB.")
+    parser.add_argument("--latency-ms", type=float, default=5, help="Latency added to every Box and Pinecone request.")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.01, help="Share of Box requests answered with 429.")
+    parser.add_argument("--pending-ratio", type=float, default=0.05, help="Share of files whose representation is pending at first.")
+    parser.add_argument("--questions", type=int, default=50, help="Number of questions asked.")
+    parser.add_argument("--first-token-ms", type=float, default=50, help="Time to first token of the fake chat endpoint.")
+    parser.add_argument("--token-ms", type=float, default=2, help="Delay between two tokens of the fake chat endpoint.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare the results with this JSON baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change reported as a regression.")
+    args = parser.parse_args(argv)
+
+    box = FakeBoxServer(
+        files=args.files,
+        file_size=args.file_kb * 1000,
+        folders=args.folders,
+        latency=args.latency_ms / 1000,
+        rate_limit_ratio=args.rate_limit_ratio,
+        pending_ratio=args.pending_ratio,
+    ).start()
+    chat = FakeChatServer(first_token_latency=args.first_token_ms / 1000, token_latency=args.token_ms / 1000).start()
+    index = FakeIndex(latency=args.latency_ms / 1000)
+
+    # The manifest, the query cache and the other local files go to a scratch directory
+    working_directory = os.getcwd()
+    config.BOX_FOLDER_ID = "0"
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            ingestion = run_ingestion(box, index)
+            queries = run_queries(box, index, chat, generate_questions(args.questions, seed=1))
+        finally:
+            os.chdir(working_directory)
+            box.stop()
+            chat.stop()
+
+    results = {
+        "parameters": vars(args),
+        "python": platform.python_version(),
+        "ingestion": ingestion,
+        "query": queries,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    print(json.dumps(results, indent=4))
+
+    # Compare before saving, the baseline may be the file being replaced
+    regressions = []
+    if args.compare:
+        with open(args.compare, "r", encoding="UTF-8") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+    if args.save:
+        with open(args.save, "w", encoding="UTF-8") as file:
+            file.write(json.dumps(results, indent=4))
+    if regressions:
+        print(f"\n{len(regressions)} metrics regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+End to end check of the event sync, against the local fake services.
+---
+Indexes the fake folder with main.main(), then runs run_event_sync()
+on a thread, following the events stream of the fake Box server through
+EventStream and its long-poll realtime server, and makes one change of
+every kind in the folder:
+- upload: a new file in a subfolder, whose chunks must appear;
+- edit: a new version of a file, which the manifest must record;
+- trash: a file moved to the trash, whose chunks must be deleted;
+- restore: the trashed file restored, whose chunks must appear again;
+- copy: a copy of a file in another subfolder, whose chunks must appear;
+- move-out: a file moved to a folder outside the synced one, whose chunks must be deleted.
+
+Reports the seconds from every change to its effect on the index, the
+exit code is 1 when a change was not applied within the timeout.
+
+Usage:
+    python -m benchmarks.bench_event_sync [--files 20] [--file-kb 20] [--debounce 0.5] [--timeout 30]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import config
+import main as ingestion_main
+from benchmarks.fakes import FakeBoxServer, FakeIndex
+from box_integration.box_events import EventCursor, EventStream
+from ingestion.event_sync import EventCoalescer, run_event_sync
+from ingestion.indexer import MANIFEST_PATH
+from ingestion.manifest import Manifest
+
+NAMESPACE = "bench-user"
+
+
+def file_record_ids(index, file_id):
+    """Returns the IDs of the records of a file in the fake index."""
+    return [record_id for ids in index.list(prefix=f"{file_id}_chunk_", namespace=NAMESPACE) for record_id in ids]
+
+
+def wait_until(condition, timeout):
+    """
+    Polls a condition until it holds.
+
+    Returns:
+    - The seconds it took, or None if the condition did not hold within the timeout.
+    """
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if condition():
+            return round(time.perf_counter() - started, 3)
+        time.sleep(0.05)
+    return None
+
+
+def run_changes(box, index, manifest, timeout):
+    """
+    Makes every kind of change in the fake folder and waits for the event sync to apply it.
+
+    Returns:
+    - A dictionary of the seconds each change took to apply, None for the changes that were not applied.
+    """
+    folder_id = next(item["id"] for item in box.folders["0"] if item["type"] == "folder")
+    file_ids = [item["id"] for item in box.folders[folder_id] if item["type"] == "file"]
+    edited_id, trashed_id, moved_id = file_ids[:3]
+    results = {}
+
+    uploaded_id = box.upload_file(folder_id)
+    results["upload"] = wait_until(
+        lambda: manifest.get(NAMESPACE, uploaded_id) is not None and file_record_ids(index, uploaded_id), timeout
+    )
+
+    sha1 = box.edit_file(edited_id)
+
+    def edited():
+        entry = manifest.get(NAMESPACE, edited_id)
+        return entry is not None and entry["sha1"] == sha1 and set(file_record_ids(index, edited_id)) == set(entry["chunk_ids"])
+    results["edit"] = wait_until(edited, timeout)
+
+    box.trash_file(trashed_id)
+    results["trash"] = wait_until(
+        lambda: manifest.get(NAMESPACE, trashed_id) is None and not file_record_ids(index, trashed_id), timeout
+    )
+
+    box.restore_file(trashed_id)
+    results["restore"] = wait_until(
+        lambda: manifest.get(NAMESPACE, trashed_id) is not None and file_record_ids(index, trashed_id), timeout
+    )
+
+    other_folder_id = next(
+        (item["id"] for item in box.folders["0"] if item["type"] == "folder" and item["id"] != folder_id), folder_id
+    )
+    copied_id = box.copy_file(edited_id, other_folder_id)
+    results["copy"] = wait_until(
+        lambda: manifest.get(NAMESPACE, copied_id) is not None and file_record_ids(index, copied_id), timeout
+    )
+
+    box.move_file(moved_id, "outside")
+    results["move_out"] = wait_until(
+        lambda: manifest.get(NAMESPACE, moved_id) is None and not file_record_ids(index, moved_id), timeout
+    )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the event sync end to end against local fake services.")
+    parser.add_argument("--files", type=int, default=20, help="Number of files in the fake Box folder.")
+    parser.add_argument("--folders", type=int, default=2, help="Number of subfolders the files are spread over.")
+    parser.add_argument("--file-kb", type=int, default=20, help="Size of the extracted text of each file, in KB.")
+    parser.add_argument("--latency-ms", type=float, default=5, help="Latency added to every Box and Pinecone request.")
+    parser.add_argument("--debounce", type=float, default=0.5, help="Seconds of quiet before a changed file is applied.")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for every change to be applied.")
+    args = parser.parse_args(argv)
+
+    box = FakeBoxServer(
+        files=args.files,
+        file_size=args.file_kb * 1000,
+        folders=max(1, args.folders),
+        latency=args.latency_ms / 1000,
+        realtime_timeout=1,
+    ).start()
+    index = FakeIndex(latency=args.latency_ms / 1000)
+    client = box.client()
+
+    # The manifest, the cursor and the other local files go to a scratch directory
+    working_directory = os.getcwd()
+    config.BOX_FOLDER_ID = "0"
+    stop = threading.Event()
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        try:
+            ingestion_main.get_client = lambda: client
+            ingestion_main.get_pinecone_index = lambda: index
+            with contextlib.redirect_stderr(io.StringIO()):
+                ingestion_main.main([])
+            indexed_records = index.record_count()
+
+            manifest = Manifest(MANIFEST_PATH)
+            stream = EventStream(get_access_token=lambda: "bench-token", base_url=box.url)
+            sync = threading.Thread(
+                target=run_event_sync,
+                args=(client, stream, EventCursor("events.json"), index, manifest, NAMESPACE, "0"),
+                kwargs={"coalescer": EventCoalescer(debounce_seconds=args.debounce), "should_stop": stop.is_set},
+                daemon=True,
+            )
+            sync.start()
+            try:
+                # The sync starts from the current position, the changes must come after it
+                wait_until(lambda: os.path.exists("events.json"), args.timeout)
+                changes = run_changes(box, index, manifest, args.timeout)
+            finally:
+                stop.set()
+                # The sync stops once its current long poll returns
+                sync.join(timeout=box.realtime_timeout + 5)
+                manifest.close()
+        finally:
+            os.chdir(working_directory)
+            box.stop()
+
+    results = {
+        "parameters": vars(args),
+        "indexed_records": indexed_records,
+        "events": len(box.events),
+        "seconds_to_apply": changes,
+    }
+    print(json.dumps(results, indent=4))
+    failed = [change for change, seconds in changes.items() if seconds is None]
+    if failed:
+        print(f"\nNot applied within {args.timeout} seconds: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmark of the start-up time of the command line scripts.
+---
+Launches every script in a new interpreter, with --help (assistant.py,
+which has no arguments, is only imported), and reports:
+- cold: the seconds of a launch without any bytecode cache, as on the
+  first run after a checkout or an upgrade of the dependencies;
+- warm: the median seconds of --runs launches with the bytecode cached;
+- the modules imported at the top level that took the longest, read
+  from the -X importtime output of a warm launch.
+
+Results can be saved as a JSON baseline and compared with a previous one,
+the exit code is 1 when a start-up time regressed more than the tolerance.
+A config.py must exist, but none of its credentials are used.
+
+Usage:
+    python -m benchmarks.bench_startup [--runs 5] [--top 5] [--save results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.bench_end_to_end import compare
+
+# The Python arguments launching each script without doing any work
+SCRIPTS = {
+    "main": ["main.py", "--help"],
+    "query": ["query.py", "--help"],
+    "query_server": ["query_server.py", "--help"],
+    "batch_query": ["batch_query.py", "--help"],
+    "multi_tenant": ["multi_tenant.py", "--help"],
+    "assistant": ["-c", "import assistant"],
+}
+
+
+def launch(arguments, pycache_prefix, importtime=False):
+    """
+    Runs a script in a new interpreter.
+
+    Parameters:
+    - arguments: The Python arguments.
+    - pycache_prefix: The directory of the bytecode cache of the interpreter.
+    - importtime: Run with -X importtime (default is False).
+
+    Returns:
+    - A tuple of the seconds until the interpreter exited and its stderr.
+    """
+    environment = dict(os.environ, PYTHONPYCACHEPREFIX=pycache_prefix)
+    # Warm launches need the bytecode written by the previous ones
+    environment.pop("PYTHONDONTWRITEBYTECODE", None)
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + arguments
+    started = time.perf_counter()
+    completed = subprocess.run(command, env=environment, capture_output=True, text=True, check=False)
+    seconds = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise SystemExit(f"{' '.join(arguments)} failed:\n{completed.stderr}")
+    return seconds, completed.stderr
+
+
+def slowest_imports(importtime_output, top):
+    """
+    Returns the top level imports that took the longest.
+
+    Parameters:
+    - importtime_output: The stderr of a launch with -X importtime.
+    - top: The number of imports returned.
+
+    Returns:
+    - A list of [module, seconds] pairs, slowest first, the time including the nested imports.
+    """
+    imports = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented under the module importing them
+        if name.startswith("  ") or not cumulative.strip().isdigit():
+            continue
+        imports.append([name.strip(), int(cumulative) / 1_000_000])
+    imports.sort(key=lambda item: item[1], reverse=True)
+    return [[name, round(seconds, 4)] for name, seconds in imports[:top]]
+
+
+def measure(arguments, runs, top):
+    """
+    Measures the cold and warm start-up of a script.
+
+    Returns:
+    - A dictionary with the "cold_seconds", the median "warm_seconds" and the "slowest_imports".
+    """
+    with tempfile.TemporaryDirectory() as cold_cache:
+        cold_seconds, _ = launch(arguments, cold_cache)
+        # The cold launch filled the cache
+        warm = [launch(arguments, cold_cache)[0] for _ in range(runs)]
+        _, importtime_output = launch(arguments, cold_cache, importtime=True)
+    return {
+        "cold_seconds": round(cold_seconds, 4),
+        "warm_seconds": round(statistics.median(warm), 4),
+        "slowest_imports": slowest_imports(importtime_output, top),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the start-up time of the command line scripts.")
+    parser.add_argument("--runs", type=int, default=5, help="Number of warm launches of every script.")
+    parser.add_argument("--top", type=int, default=5, help="Number of slowest top level imports reported.")
+    parser.add_argument("--scripts", nargs="+", choices=sorted(SCRIPTS), default=list(SCRIPTS),
+                        help="The scripts to launch.")
+    parser.add_argument("--save", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare the results with this JSON baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Relative change reported as a regression.")
+    args = parser.parse_args(argv)
+
+    # Only the stdlib baseline, to tell the time of the interpreter from the time of the imports
+    scripts = {"python": ["-c", "pass"], **{name: SCRIPTS[name] for name in args.scripts}}
+    results = {"parameters": vars(args), "python": platform.python_version(), "scripts": {}}
+    print(f"{'script':<16}{'cold s':>10}{'warm s':>10}  slowest imports (warm)")
+    for name, arguments in scripts.items():
+        result = results["scripts"][name] = measure(arguments, args.runs, args.top)
+        imports = ", ".join(f"{module} {seconds:.3f}" for module, seconds in result["slowest_imports"])
+        print(f"{name:<16}{result['cold_seconds']:>10.3f}{result['warm_seconds']:>10.3f}  {imports}")
+
+    # Compare before saving, the baseline may be the file being replaced
+    regressions = []
+    if args.compare:
+        with open(args.compare, "r", encoding="UTF-8") as file:
+            baseline = json.load(file)
+        metrics = {
+            f"scripts.{name}.{kind}": False
+            for name in args.scripts for kind in ("cold_seconds", "warm_seconds")
+        }
+        regressions = compare(results, baseline, args.tolerance, metrics)
+    if args.save:
+        with open(args.save, "w", encoding="UTF-8") as file:
+            file.write(json.dumps(results, indent=4))
+    if regressions:
+        print(f"\n{len(regressions)} start-up times regressed by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
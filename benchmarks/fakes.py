@@ -0,0 +1,500 @@
+"""
+Local stand-ins for Box, Pinecone and OpenAI used by the benchmarks.
+---
+- FakeBoxServer serves a generated folder tree, the [extracted_text]
+  representations of its files and the current user, with a configurable
+  latency and a share of requests answered with 429. Files can be
+  uploaded, edited, trashed and moved, which is reported through the
+  events stream and its long-poll realtime server.
+- FakeIndex implements the parts of a Pinecone index used by this repo,
+  searching with a simple word overlap score.
+- FakeChatServer answers chat completions, streamed or not, with a
+  configurable time to first token and delay between tokens.
+
+All of them count what they served, so the benchmarks can report
+throughputs without instrumenting the code under test.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from boxsdk import Client, OAuth2
+from boxsdk.config import API
+from boxsdk.session.session import AuthorizedSession
+from benchmarks.bench_clean_text import generate_prose
+from box_integration.http_session import ScheduledNetwork
+
+# Words of the generated documents, also used to build the questions
+VOCABULARY = ["the", "report", "quarterly", "revenue", "self", "well", "known", "Box", "Pinecone"]
+
+
+class _Server:
+    """A ThreadingHTTPServer running on a daemon thread, on a free local port."""
+
+    def __init__(self, handler_class):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name=handler_class.__name__, daemon=True)
+        self._lock = threading.Lock()
+        self.counters = {}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeBoxServer(_Server):
+    """
+    Serves a folder tree of generated text files through the Box API routes used by this repo.
+
+    Parameters:
+    - files: The number of files.
+    - file_size: The number of characters of each extracted text.
+    - folders: The number of subfolders of the root folder "0" the files are spread over (default is 0).
+    - latency: The seconds added to every request (default is 0).
+    - rate_limit_ratio: The share of requests answered with a 429 (default is 0).
+    - pending_ratio: The share of files whose representation is pending on the first request (default is 0).
+    - seed: The random seed of the documents and of the injected errors (default is 0).
+    - realtime_timeout: The seconds a long poll of the realtime server waits for an event (default is 5).
+    """
+
+    def __init__(self, files, file_size, folders=0, latency=0.0, rate_limit_ratio=0.0, pending_ratio=0.0, seed=0,
+                 realtime_timeout=5):
+        super().__init__(_BoxHandler)
+        self.file_size = file_size
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.seed = seed
+        self.realtime_timeout = realtime_timeout
+        self._random = random.Random(seed)
+        self._documents = {}
+        # The number of new versions uploaded of every edited file
+        self._edits = {}
+        folder_ids = [str(1000 + number) for number in range(folders)]
+        self.folders = {"0": [{"type": "folder", "id": folder_id, "name": f"folder-{folder_id}"} for folder_id in folder_ids]}
+        # The parent of every folder, None for the roots
+        self.parents = {"0": None}
+        for folder_id in folder_ids:
+            self.folders[folder_id] = []
+            self.parents[folder_id] = "0"
+        parents = folder_ids or ["0"]
+        self.pending = set()
+        self.trashed = {}
+        # The events stream, a stream position is an index in this list
+        self.events = []
+        self._changed = threading.Condition(self._lock)
+        self._files = 0
+        for _ in range(files):
+            file_id = self._add_file(parents[self._files % len(parents)])
+            if self._random.random() < pending_ratio:
+                self.pending.add(file_id)
+
+    def _add_file(self, folder_id):
+        number = self._files
+        self._files += 1
+        file_id = str(100000 + number)
+        self.folders[folder_id].append({
+            "type": "file",
+            "id": file_id,
+            "name": f"document-{file_id}.pdf",
+            "size": self.file_size,
+            "created_at": "2024-01-01T00:00:00-00:00",
+            "modified_at": "2024-01-01T00:00:00-00:00",
+            "sha1": f"{number:040x}",
+            "file_version": {"type": "file_version", "id": f"9{file_id}"},
+        })
+        return file_id
+
+    def document(self, file_id):
+        """The extracted text of the current version of a file, generated on first use."""
+        with self._lock:
+            key = (file_id, self._edits.get(file_id, 0))
+            document = self._documents.get(key)
+        if document is None:
+            document = generate_prose(self.file_size, seed=int(file_id) + 1_000_003 * key[1]).encode("utf-8")
+            with self._lock:
+                self._documents[key] = document
+        return document
+
+    def _find(self, file_id):
+        """The folder ID and the listing entry of a file, (None, {}) if there is no such file."""
+        for folder_id, items in self.folders.items():
+            for item in items:
+                if item["type"] == "file" and item["id"] == file_id:
+                    return folder_id, item
+        return None, {}
+
+    def file_entry(self, file_id):
+        """The listing entry of a file, empty if there is no such file."""
+        with self._lock:
+            return self._find(file_id)[1]
+
+    def file_info(self, file_id):
+        """The file object of GET /files/{id}, with its parent, path and status, empty if there is no such file."""
+        with self._lock:
+            folder_id, entry = self._find(file_id)
+            status = "active"
+            if folder_id is None and file_id in self.trashed:
+                folder_id, entry = self.trashed[file_id]
+                status = "trashed"
+            if folder_id is None:
+                return {}
+            path = []
+            parent = folder_id
+            while parent is not None:
+                path.insert(0, {"type": "folder", "id": parent})
+                parent = self.parents.get(parent)
+        return {**entry, "parent": path[-1], "path_collection": {"total_count": len(path), "entries": path},
+                "item_status": status}
+
+    def _emit(self, event_type, file_id):
+        """Appends an event to the stream and wakes the long polls, the lock must be held."""
+        self.events.append({
+            "type": "event",
+            "event_id": str(len(self.events)),
+            "event_type": event_type,
+            "source": {"type": "file", "id": file_id},
+        })
+        self._changed.notify_all()
+
+    def upload_file(self, folder_id="0"):
+        """Adds a new file to a folder, returns its ID."""
+        with self._lock:
+            file_id = self._add_file(folder_id)
+            self._emit("ITEM_UPLOAD", file_id)
+        return file_id
+
+    def edit_file(self, file_id):
+        """Uploads a new version of a file, with a new text, returns its new SHA-1."""
+        with self._lock:
+            _, entry = self._find(file_id)
+            edits = self._edits[file_id] = self._edits.get(file_id, 0) + 1
+            version = f"{edits}9{file_id}"
+            entry["file_version"] = {"type": "file_version", "id": version}
+            entry["sha1"] = f"{int(version):040x}"
+            entry["modified_at"] = time.strftime("%Y-%m-%dT%H:%M:%S-00:00", time.gmtime())
+            self._emit("ITEM_UPLOAD", file_id)
+        return entry["sha1"]
+
+    def trash_file(self, file_id):
+        """Moves a file to the trash."""
+        with self._lock:
+            folder_id, entry = self._find(file_id)
+            self.folders[folder_id].remove(entry)
+            self.trashed[file_id] = (folder_id, entry)
+            self._emit("ITEM_TRASH", file_id)
+
+    def restore_file(self, file_id):
+        """Restores a trashed file to the folder it was trashed from."""
+        with self._lock:
+            folder_id, entry = self.trashed.pop(file_id)
+            self.folders[folder_id].append(entry)
+            self._emit("ITEM_UNDELETE_VIA_TRASH", file_id)
+
+    def copy_file(self, file_id, folder_id):
+        """Copies a file, with the same text, to a folder, returns the ID of the copy."""
+        document = self.document(file_id)
+        with self._lock:
+            copy_id = self._add_file(folder_id)
+            self._documents[(copy_id, 0)] = document
+            self._emit("ITEM_COPY", copy_id)
+        return copy_id
+
+    def move_file(self, file_id, folder_id):
+        """Moves a file to a folder, an unknown folder is created as a root outside folder "0"."""
+        with self._lock:
+            current_folder_id, entry = self._find(file_id)
+            self.folders[current_folder_id].remove(entry)
+            if folder_id not in self.folders:
+                self.folders[folder_id] = []
+                self.parents[folder_id] = None
+            self.folders[folder_id].append(entry)
+            self._emit("ITEM_MOVE", file_id)
+
+    def events_after(self, stream_position, limit):
+        """The body of GET /events, the events after a stream position or none for "now"."""
+        with self._lock:
+            start = len(self.events) if stream_position == "now" else int(stream_position)
+            entries = self.events[start:start + limit]
+        return {"chunk_size": len(entries), "entries": entries, "next_stream_position": start + len(entries)}
+
+    def wait_for_event(self, stream_position):
+        """Long polls until there are events after a stream position, returns the realtime server message."""
+        with self._lock:
+            changed = self._changed.wait_for(lambda: len(self.events) > stream_position, self.realtime_timeout)
+        return "new_change" if changed else "reconnect"
+
+    def inject_rate_limit(self):
+        with self._lock:
+            return self._random.random() < self.rate_limit_ratio
+
+    def representation(self, file_id):
+        with self._lock:
+            state = "pending" if file_id in self.pending else "success"
+            self.pending.discard(file_id)
+        return {
+            "representation": "extracted_text",
+            "properties": {},
+            "info": {"url": f"{self.url}/reps/{file_id}/info"},
+            "content": {"url_template": f"{self.url}/reps/{file_id}/{{+asset_path}}"},
+            "status": {"state": state},
+        }
+
+    def client(self):
+        """
+        Returns a boxsdk Client sending its requests to this server, through the request scheduler.
+        """
+        api_config = API()
+        api_config.BASE_API_URL = self.url
+        api_config.OAUTH2_API_URL = f"{self.url}/oauth2"
+        oauth = OAuth2(client_id="bench", client_secret="bench", access_token="bench-token")
+        return Client(oauth, AuthorizedSession(oauth, api_config=api_config, network_layer=ScheduledNetwork()))
+
+
+class _BoxHandler(_Handler):
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        fake = self.server.fake
+        fake.count("requests")
+        if fake.latency:
+            time.sleep(fake.latency)
+        if fake.inject_rate_limit():
+            fake.count("rate_limited")
+            self.send_json(429, {"type": "error", "status": 429, "code": "rate_limit_exceeded"}, {"Retry-After": "0"})
+            return
+
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        query = parse_qs(url.query)
+        if parts == ["users", "me"]:
+            self.send_json(200, {"type": "user", "id": "bench-user", "name": "Benchmark"})
+        elif len(parts) == 3 and parts[0] == "folders" and parts[2] == "items":
+            self._folder_items(parts[1], query)
+        elif len(parts) == 2 and parts[0] == "files":
+            info = fake.file_info(parts[1])
+            if not info:
+                self.send_json(404, {"type": "error", "status": 404, "code": "not_found"})
+                return
+            self.send_json(200, {**info, "representations": {"entries": [fake.representation(parts[1])]}})
+        elif parts == ["events"]:
+            self.send_json(200, fake.events_after(query.get("stream_position", ["0"])[0],
+                                                  int(query.get("limit", ["500"])[0])))
+        elif parts == ["realtime"]:
+            self.send_json(200, {"message": fake.wait_for_event(int(query.get("stream_position", ["0"])[0]))})
+        elif len(parts) == 3 and parts[0] == "reps" and parts[2] == "info":
+            self.send_json(200, fake.representation(parts[1]))
+        elif len(parts) >= 2 and parts[0] == "reps":
+            document = fake.document(parts[1])
+            fake.count("files_served")
+            fake.count("bytes_served", len(document))
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(document)))
+            self.end_headers()
+            self.wfile.write(document)
+        else:
+            self.send_json(404, {"type": "error", "status": 404, "code": "not_found"})
+
+    def do_OPTIONS(self):  # pylint: disable=invalid-name
+        fake = self.server.fake
+        fake.count("requests")
+        if urlparse(self.path).path.strip("/") != "events":
+            self.send_json(404, {"type": "error", "status": 404, "code": "not_found"})
+            return
+        self.send_json(200, {"chunk_size": 1, "entries": [{
+            "type": "realtime_server",
+            "url": f"{fake.url}/realtime",
+            "ttl": "10",
+            "max_retries": "10",
+            "retry_timeout": fake.realtime_timeout,
+        }]})
+
+    def _folder_items(self, folder_id, query):
+        items = self.server.fake.folders.get(folder_id)
+        if items is None:
+            self.send_json(404, {"type": "error", "status": 404, "code": "not_found"})
+            return
+        limit = int(query.get("limit", ["100"])[0])
+        offset = int(query.get("marker", ["0"])[0] or 0)
+        page = items[offset:offset + limit]
+        body = {"entries": page, "limit": limit}
+        if offset + limit < len(items):
+            body["next_marker"] = str(offset + limit)
+        self.send_json(200, body)
+
+
+class FakeIndex:
+    """
+    In-memory stand-in for a Pinecone index with integrated embedding. Safe to share between threads.
+
+    Parameters:
+    - latency: The seconds added to every call (default is 0).
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.upserted_records = 0
+        self.searches = 0
+        self._lock = threading.Lock()
+        self._namespaces = {}
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def upsert_records(self, namespace, records):
+        self._wait()
+        with self._lock:
+            records_by_id = self._namespaces.setdefault(namespace, {})
+            for record in records:
+                records_by_id[record["_id"]] = dict(record)
+            self.upserted_records += len(records)
+
+    def delete(self, ids, namespace):
+        self._wait()
+        with self._lock:
+            records_by_id = self._namespaces.get(namespace, {})
+            for record_id in ids:
+                records_by_id.pop(record_id, None)
+
+    def update(self, id, set_metadata=None, namespace=None):  # pylint: disable=redefined-builtin
+        self._wait()
+        with self._lock:
+            record = self._namespaces.get(namespace, {}).get(id)
+            if record is not None:
+                record.update(set_metadata or {})
+
+    def list(self, prefix, namespace):
+        self._wait()
+        with self._lock:
+            ids = sorted(record_id for record_id in self._namespaces.get(namespace, {}) if record_id.startswith(prefix))
+        for start in range(0, len(ids), 100):
+            yield ids[start:start + 100]
+
+    def search(self, namespace, query, fields=None, rerank=None):
+        self._wait()
+        words = set(query["inputs"]["text"].lower().split())
+        with self._lock:
+            records = list(self._namespaces.get(namespace, {}).values())
+            self.searches += 1
+        scored = sorted(
+            records,
+            key=lambda record: len(words & set(record.get("chunk_text", "").lower().split())),
+            reverse=True,
+        )[:query["top_k"]]
+        if rerank:
+            scored = scored[:rerank["top_n"]]
+        hits = [
+            {"_id": record["_id"], "fields": {field: record.get(field) for field in (fields or record)}}
+            for record in scored
+        ]
+        return {"result": {"hits": hits}}
+
+    def record_count(self):
+        with self._lock:
+            return sum(len(records) for records in self._namespaces.values())
+
+
+class FakeChatServer(_Server):
+    """
+    Answers OpenAI chat completions with a fixed answer.
+
+    Parameters:
+    - first_token_latency: The seconds before the first token (default is 0).
+    - token_latency: The seconds between two streamed tokens (default is 0).
+    - answer_tokens: The number of tokens of the answer (default is 40).
+    """
+
+    def __init__(self, first_token_latency=0.0, token_latency=0.0, answer_tokens=40):
+        super().__init__(_ChatHandler)
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.tokens = [f" {VOCABULARY[number % len(VOCABULARY)]}" for number in range(answer_tokens)]
+
+    @property
+    def base_url(self):
+        return f"{self.url}/v1"
+
+
+class _ChatHandler(_Handler):
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.server.fake.count("requests")
+        self.send_json(200, {"object": "list", "data": []})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        fake = self.server.fake
+        fake.count("requests")
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        fake.count("completions")
+        fake.count("prompt_characters", sum(len(message.get("content", "")) for message in request.get("messages", [])))
+        if fake.first_token_latency:
+            time.sleep(fake.first_token_latency)
+
+        if not request.get("stream"):
+            if fake.token_latency:
+                time.sleep(fake.token_latency * len(fake.tokens))
+            self.send_json(200, {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "gpt-4"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(fake.tokens)},
+                    "finish_reason": "stop",
+                }],
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for token in fake.tokens:
+            event = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "gpt-4"),
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if fake.token_latency:
+                time.sleep(fake.token_latency)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
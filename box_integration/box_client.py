@@ -1,18 +1,47 @@
 """
 Handles the box client object creation.
 Orchestrates the authentication process.
+
+The boxsdk is imported, and the client created, on the first call of get_client.
 """
 
-from boxsdk import Client
-from box_integration.box_oauth import oauth_from_previous
-from box_integration.oauth_callback import callback_handle_request, open_browser
+import threading
+from typing import TYPE_CHECKING
 import config
 
+if TYPE_CHECKING:
+    from boxsdk import Client
+
+# The client of get_client, created on first use
+_client = None
+_client_lock = threading.Lock()
+
 
-def get_client() -> Client:
+def get_client() -> "Client":
     """
     Returns a boxsdk Client object.
+
+    The stored access token is reused as long as it is valid, it is only
+    refreshed when close to expiry, then ahead of time in the background.
+    Requests go through the request scheduler. The client is created once
+    per process, later calls return the same client.
     """
+    global _client  # pylint: disable=global-statement
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _create_client()
+    return _client
+
+
+def _create_client():
+    # pylint: disable=import-outside-toplevel
+    from boxsdk import Client
+    from boxsdk.session.session import AuthorizedSession
+    from box_integration.box_oauth import oauth_from_previous
+    from box_integration.http_session import ScheduledNetwork
+    from box_integration.oauth_callback import callback_handle_request, open_browser
+
     oauth = oauth_from_previous()
 
     if not oauth.access_token:
@@ -25,6 +54,7 @@ def get_client() -> Client:
     if not oauth.access_token:
         raise RuntimeError("Unable to authenticate")
 
-    oauth.refresh(oauth.access_token)
+    oauth.ensure_fresh()
+    oauth.start_background_refresh()
 
-    return Client(oauth)
+    return Client(oauth, AuthorizedSession(oauth, network_layer=ScheduledNetwork()))
@@ -0,0 +1,165 @@
+"""
+Reads the Box events stream.
+---
+Uses the long-poll API: OPTIONS /events returns a realtime server URL,
+a GET on that URL blocks until something changes, and GET /events then
+returns the new events from a stream_position on. The position is
+persisted so a restarted daemon continues where it stopped.
+The API base URL comes from the config so the stream can be pointed at
+a local fake endpoint.
+"""
+import json
+import logging
+import os
+import requests
+import config
+from box_integration.http_session import BOX_API_URL, get_session
+from common.rate_limiter import scheduled_call
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+
+class EventCursor:
+    """
+    Persists the stream position of the events stream in a JSON file.
+
+    Parameters:
+    - path: The path of the cursor file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        Returns the saved stream position, or None if there is none.
+        """
+        if not os.path.isfile(self.path):
+            return None
+        with open(self.path, "r", encoding="UTF-8") as file:
+            return json.load(file).get("stream_position")
+
+    def save(self, stream_position):
+        """
+        Saves the stream position, replacing the file atomically.
+
+        Parameters:
+        - stream_position: The position to continue from after a restart.
+        """
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="UTF-8") as file:
+            file.write(json.dumps({"stream_position": stream_position}, indent=4))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+
+
+class EventStream:
+    """
+    Minimal client for the Box events and long-poll endpoints.
+
+    Parameters:
+    - get_access_token: Callable returning the current access token.
+    - refresh_access_token: Optional callable(access_token) refreshing an expired token.
+    - base_url: The Box API base URL (default is BOX_API_URL).
+    - stream_type: The events stream to read (default is "changes").
+    - page_size: The maximum number of events per request (default is 500).
+    """
+
+    def __init__(self, get_access_token, refresh_access_token=None, base_url=BOX_API_URL,
+                 stream_type="changes", page_size=500):
+        self.get_access_token = get_access_token
+        self.refresh_access_token = refresh_access_token
+        self.base_url = base_url.rstrip("/")
+        self.stream_type = stream_type
+        self.page_size = page_size
+        self.session = get_session()
+        self._realtime_server = None
+        self._realtime_retries = 0
+
+    def _request(self, method, url, **kwargs):
+        """Sends an authenticated request through the request scheduler, refreshing the token once on a 401."""
+        return scheduled_call("box_api", self._send, method, url, **kwargs)
+
+    def _send(self, method, url, **kwargs):
+        access_token = self.get_access_token()
+        headers = {"Authorization": f"Bearer {access_token}"}
+        response = self.session.request(method, url, headers=headers, **kwargs)
+        if response.status_code == 401 and self.refresh_access_token:
+            logging.info("Access token rejected by the events API, refreshing it")
+            self.refresh_access_token(access_token)
+            headers = {"Authorization": f"Bearer {self.get_access_token()}"}
+            response = self.session.request(method, url, headers=headers, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def current_position(self):
+        """
+        Returns the stream position of "now", skipping all past events.
+        """
+        response = self._request(
+            "GET",
+            f"{self.base_url}/events",
+            params={"stream_position": "now", "stream_type": self.stream_type},
+            timeout=30,
+        )
+        return response.json()["next_stream_position"]
+
+    def get_events(self, stream_position):
+        """
+        Fetches the events after a stream position.
+
+        Parameters:
+        - stream_position: The position to read from.
+
+        Returns:
+        - A tuple of the list of events and the next stream position.
+        """
+        response = self._request(
+            "GET",
+            f"{self.base_url}/events",
+            params={
+                "stream_position": stream_position,
+                "stream_type": self.stream_type,
+                "limit": self.page_size,
+            },
+            timeout=30,
+        )
+        body = response.json()
+        return body.get("entries", []), body["next_stream_position"]
+
+    def wait_for_change(self, stream_position):
+        """
+        Blocks on the realtime server until a change happens or the poll times out.
+
+        Parameters:
+        - stream_position: The position the caller has read up to.
+
+        Returns:
+        - True if there are new events, False if the caller should just poll again.
+        """
+        if self._realtime_server is None or self._realtime_retries <= 0:
+            response = self._request("OPTIONS", f"{self.base_url}/events", timeout=30)
+            self._realtime_server = response.json()["entries"][0]
+            self._realtime_retries = int(self._realtime_server.get("max_retries", 10))
+
+        self._realtime_retries -= 1
+        timeout = int(self._realtime_server.get("retry_timeout", 610))
+        try:
+            response = self.session.get(
+                self._realtime_server["url"],
+                params={"stream_position": stream_position},
+                timeout=timeout + 30,
+            )
+            response.raise_for_status()
+            message = response.json().get("message")
+        except (requests.RequestException, ValueError) as e:
+            logging.warning(f"Long poll failed, reconnecting: {e}")
+            self._realtime_server = None
+            return False
+
+        if message == "reconnect":
+            self._realtime_server = None
+        return message == "new_change"
@@ -1,7 +1,11 @@
-import requests
+import codecs
+import os
 import config
-import re
 import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from box_integration.http_session import BOX_API_URL, box_get
+from box_integration.text_cleaning import clean_up_text
+from common import metrics
 
 # Configure logging
 log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
@@ -28,110 +32,251 @@ def is_supported_file_type(file_name):
     logging.debug('Checking if file type is supported for: %s', file_name)
     return any(file_name.endswith(ext) for ext in SUPPORTED_TEXT_FILE_TYPES)
 
-def get_files_in_folder(client, folder_id):
+# Number of files downloaded in parallel by download_files
+DOWNLOAD_WORKERS = getattr(config, "BOX_DOWNLOAD_WORKERS", 8)
+
+# Fields requested when listing folders, exactly what indexing needs
+LISTING_FIELDS = [
+    "type", "id", "name", "size", "created_at", "modified_at", "sha1", "file_version"
+]
+
+# Number of items requested per listing page (Box allows up to 1000)
+LISTING_PAGE_SIZE = 1000
+
+def _iter_folder_items(client, folder_id):
     """
-    Fetches all files in the specified folder.
+    Pages through the items of a single folder using marker based pagination.
 
     Parameters:
     - client: The Box client used to interact with the Box service.
-    - folder_id: The ID of the folder to fetch files from.
+    - folder_id: The ID of the folder to list.
 
     Returns:
-    - A list of file objects.
+    - A lazy iterator over the items of the folder.
     """
-    logging.debug('Fetching files in folder with ID: %s', folder_id)
-    client.user().get(headers={"x-box-ai-library": "pinecone"})
-    folder = client.folder(folder_id).get()
-    items = folder.get_items()
-    file_objects = []
-    for item in items:
-        if item.type == 'file' and is_supported_file_type(item.name):
-            file_objects.append(item.get())
-    return file_objects
+    logging.debug('Listing items in folder with ID: %s', folder_id)
+    return client.folder(folder_id).get_items(
+        limit=LISTING_PAGE_SIZE,
+        use_marker=True,
+        fields=LISTING_FIELDS,
+    )
 
-def clean_up_text(content: str) -> str:
+def _list_folder(client, folder_id):
     """
-    Cleans up the text content by fixing hyphenated words broken by newline and removing unwanted patterns and characters.
+    Lists a single folder completely.
 
     Parameters:
-    - content: The text content to clean up.
+    - client: The Box client used to interact with the Box service.
+    - folder_id: The ID of the folder to list.
 
     Returns:
-    - The cleaned up text content.
+    - A tuple of the supported files in the folder and the IDs of its subfolders.
     """
-    logging.debug('Cleaning up text content')
-    if not content:
-        logging.warning('No content to clean')
-        return content
-    
-    try:
-        content = re.sub(r'(\w+)-\n(\w+)', r'\1\2', content)
-    except Exception as e:
-        logging.error('Error cleaning up text content: %s', e)
-        return content
+    files = []
+    subfolder_ids = []
+    for item in metrics.timed_iter("box_listing_seconds", _iter_folder_items(client, folder_id)):
+        if item.type == 'folder':
+            subfolder_ids.append(item.id)
+        elif item.type == 'file' and is_supported_file_type(item.name):
+            files.append(item)
+    metrics.increment("box_listed_files", len(files))
+    return files, subfolder_ids
+
+def iter_files_in_folder(client, folder_id, recursive=True, max_workers=1):
+    """
+    Yields the supported files in the specified folder as they are listed.
 
-    unwanted_patterns = [
-        "\\n", "  —", "——————————", "—————————", "—————",
-        r'\\u[\dA-Fa-f]{4}', r'\uf075', r'\uf0b7'
-    ]
-    logging.debug('Removing unwanted patterns from text content')
-    for pattern in unwanted_patterns:
-        content = re.sub(pattern, "", content)
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - folder_id: The ID of the folder to fetch files from.
+    - recursive: Whether to descend into subfolders (default is True).
+    - max_workers: The number of folders listed in parallel (default is 1).
 
-    logging.debug('Fixing improperly spaced hyphenated words and normalizing whitespace')
-    content = re.sub(r'(\w)\s*-\s*(\w)', r'\1-\2', content)
-    content = re.sub(r'\s+', ' ', content)
+    Returns:
+    - A generator of file objects carrying the LISTING_FIELDS.
+    """
+    logging.debug('Fetching files in folder with ID: %s', folder_id)
+    client.user().get(headers={"x-box-ai-library": "pinecone"})
 
-    return content
+    if max_workers <= 1:
+        pending = [folder_id]
+        while pending:
+            for item in metrics.timed_iter("box_listing_seconds", _iter_folder_items(client, pending.pop())):
+                if item.type == 'folder':
+                    if recursive:
+                        pending.append(item.id)
+                elif item.type == 'file' and is_supported_file_type(item.name):
+                    metrics.increment("box_listed_files")
+                    yield item
+        return
 
-def get_file_text_content(client, file):
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="box-listing") as executor:
+        running = {executor.submit(_list_folder, client, folder_id)}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subfolder_ids = future.result()
+                if recursive:
+                    running.update(executor.submit(_list_folder, client, subfolder_id) for subfolder_id in subfolder_ids)
+                yield from files
+
+def get_files_in_folder(client, folder_id, recursive=True):
     """
-    Gets the text content for a file.
+    Fetches all files in the specified folder.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - folder_id: The ID of the folder to fetch files from.
+    - recursive: Whether to include the files of subfolders (default is True).
+
+    Returns:
+    - A list of file objects.
+    """
+    return list(iter_files_in_folder(client, folder_id, recursive=recursive))
+
+def get_text_representation_url(client, file):
+    """
+    Gets the download URL of the extracted text representation for a file.
 
     Parameters:
     - client: The Box client used to interact with the Box service.
     - file: The file object to get the text content for.
 
     Returns:
-    - The text content for the file.
+    - The download URL, or None if the file has no text representation.
     """
-    logging.debug('Getting text content for file ID: %s', file.id)
     rep_hints = '[extracted_text]'
-    oauth2 = client.auth
-    access_token = oauth2.access_token
     representations = client.file(file.id).get_representation_info(rep_hints)
     for representation in representations:
         if not representation['status']['state'] == 'success':
             raise ValueError(f"Representation not ready: {representation['status']['state']}")
-        download_url = representation['content']['url_template'].replace('{+asset_path}', '') + '?access_token=' + access_token
-        print(download_url)
-        response = requests.get(download_url)
-        response.raise_for_status()
-        cleaned_text = clean_up_text(response.text)
-        logging.debug('Cleaned up text content: %s', cleaned_text)
-        return cleaned_text
+        return representation_download_url(representation)
+    return None
+
+def representation_download_url(representation):
+    """
+    Gets the download URL of a representation that is ready.
+
+    Parameters:
+    - representation: The representation info returned by Box.
 
-def download_files(client, files):
+    Returns:
+    - The download URL of the representation content.
     """
-    Downloads the specified files.
+    return representation['content']['url_template'].replace('{+asset_path}', '')
+
+def fetch_file_text(client, file, download_url=None):
+    """
+    Downloads the raw extracted text representation for a file.
 
     Parameters:
     - client: The Box client used to interact with the Box service.
-    - files: The list of file objects to download.
+    - file: The file object to get the text content for.
+    - download_url: The representation download URL, if already known (default is to look it up).
 
     Returns:
-    - A list of file names.
+    - The raw, uncleaned text content for the file.
     """
-    logging.debug('Downloading files')
-    file_names = []
+    logging.debug('Getting text content for file ID: %s', file.id)
+    if download_url is None:
+        download_url = get_text_representation_url(client, file)
+    if download_url is None:
+        return None
+    with metrics.timer("box_download_seconds"):
+        response = box_get(client, download_url)
+        text = response.text
+    metrics.increment("box_download_bytes", len(response.content))
+    return text
+
+def open_file_text_stream(client, file, chunk_size=65536, download_url=None):
+    """
+    Opens a streamed download of the extracted text representation for a file.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - file: The file object to get the text content for.
+    - chunk_size: The number of bytes read from the connection at a time (default is 65536).
+    - download_url: The representation download URL, if already known (default is to look it up).
+
+    Returns:
+    - A generator of decoded, uncleaned text pieces. The request is sent
+      before returning, the body is read as the generator is consumed.
+    """
+    logging.debug('Streaming text content for file ID: %s', file.id)
+    if download_url is None:
+        download_url = get_text_representation_url(client, file)
+    if download_url is None:
+        raise ValueError(f"No extracted text representation for file ID: {file.id}")
+    response = box_get(client, download_url, stream=True)
+    return _iter_decoded_text(response, chunk_size)
+
+def _iter_decoded_text(response, chunk_size):
+    """
+    Decodes a streamed response body incrementally, like response.text does in one go.
+    """
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    try:
+        for data in response.iter_content(chunk_size=chunk_size):
+            metrics.increment("box_download_bytes", len(data))
+            text = decoder.decode(data)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+    finally:
+        response.close()
+
+def get_file_text_content(client, file):
+    """
+    Gets the text content for a file.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - file: The file object to get the text content for.
 
-    for file in files:
-        file_name=file.name
-        logging.debug('Downloading file: %s', file_name)
+    Returns:
+    - The text content for the file.
+    """
+    text = fetch_file_text(client, file)
+    if text is None:
+        return None
+    cleaned_text = clean_up_text(text)
+    logging.debug('Cleaned up text content: %s', cleaned_text)
+    return cleaned_text
 
-        with open(f"./{file_name}", 'wb') as output_file:
-            client.file(file.id).download_to(output_file)
+def download_file(client, file, target_dir="."):
+    """
+    Downloads the content of a file through the shared HTTP session.
 
-        file_names.append(file_name)        
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - file: The file object to download.
+    - target_dir: The directory to write the file to (default is the current directory).
 
-    return file_names
\ No newline at end of file
+    Returns:
+    - The name of the downloaded file.
+    """
+    logging.debug('Downloading file: %s', file.name)
+    response = box_get(client, f"{BOX_API_URL}/files/{file.id}/content", stream=True)
+    with response, open(os.path.join(target_dir, file.name), 'wb') as output_file:
+        for data in response.iter_content(chunk_size=1024 * 1024):
+            output_file.write(data)
+    return file.name
+
+def download_files(client, files, target_dir=".", max_workers=DOWNLOAD_WORKERS):
+    """
+    Downloads the specified files in parallel.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - files: The list of file objects to download.
+    - target_dir: The directory to write the files to (default is the current directory).
+    - max_workers: The number of concurrent downloads (default is DOWNLOAD_WORKERS).
+
+    Returns:
+    - A list of file names, in the order of files.
+    """
+    logging.debug('Downloading files')
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="box-download") as executor:
+        return list(executor.map(lambda file: download_file(client, file, target_dir), files))
@@ -1,67 +1,32 @@
 """ Manage oAuth2 for Box"""
-from datetime import datetime, timedelta
-import json
-import os.path
-from boxsdk import OAuth2
 import config
 import logging
+from box_integration.token_manager import ManagedOAuth2
 
 log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
 logging.basicConfig(level=log_level)
 logging.getLogger("box-pinecone-integration")
 
 
-def oauth_from_config() -> OAuth2:
+def oauth_from_config() -> ManagedOAuth2:
     """
     Returns a boxsdk OAuth2 object
     from the configuration file
+    and the tokens stored in the token file, if any
     """
-    return OAuth2(
+    return ManagedOAuth2(
         client_id=config.BOX_CLIENT_ID,
         client_secret=config.BOX_CLIENT_SECRET,
-        store_tokens=store_tokens,
     )
 
 
-def store_tokens(access_token: str, refresh_token: str):
-    """Stores the access and refresh tokens in a file"""
-    access_token_expires_on = datetime.today() + timedelta(minutes=60)
-    refresh_token_expires_on = datetime.today() + timedelta(days=60)
-    oauth_json = {
-        "access_token": access_token,
-        "access_token_expires_on": str(access_token_expires_on),
-        "refresh_token": refresh_token,
-        "refresh_token_expires_on": str(refresh_token_expires_on),
-    }
-    with open(".oauth.json", "w", encoding="UTF-8") as file:
-        file.write(json.dumps(oauth_json, indent=4))
-
-
-def oauth_from_previous() -> OAuth2:
+def oauth_from_previous() -> ManagedOAuth2:
     """
     Returns an OAuth2 object
-    Instatiated from the .oauth.json file
+    Instatiated from the token file (.oauth.json by default)
     and the configurations
     """
-
-    oauth = oauth_from_config()
-    if not os.path.isfile(".oauth.json"):
-        return oauth
-
-    with open(".oauth.json", "r", encoding="UTF-8") as file:
-        oauth_json = file.read()
-
-    oauth_dict = json.loads(oauth_json)
-
-    oauth = OAuth2(
-        client_id=config.BOX_CLIENT_ID,
-        client_secret=config.BOX_CLIENT_SECRET,
-        store_tokens=store_tokens,
-        access_token=oauth_dict.get("access_token"),
-        refresh_token=oauth_dict.get("refresh_token"),
-    )
-
-    return oauth
+    return oauth_from_config()
 
 
 def oauth_authenticate(code: str):
@@ -0,0 +1,177 @@
+"""
+Shared HTTP session for the direct Box downloads.
+---
+Representation and file content downloads do not go through the boxsdk,
+they use one requests session shared by all threads. Its connection pool
+is sized to the worker count, so connections (and their TLS handshakes)
+are reused across files. The session retries idempotent requests on
+connection errors only: 429 and 5xx responses are handled by the request
+scheduler (common/rate_limiter.py), which lowers the concurrency of the
+endpoint class and honors Retry-After.
+
+The boxsdk client sends its requests through ScheduledNetwork, so its
+listing and representation calls are scheduled too.
+"""
+import logging
+import threading
+import requests
+from boxsdk.network.default_network import DefaultNetwork
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from common.rate_limiter import THROTTLE_STATUS_CODES, get_scheduler, parse_retry_after
+import config
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+BOX_API_URL = getattr(config, "BOX_API_URL", "https://api.box.com/2.0")
+
+# (connect, read) timeouts in seconds
+HTTP_TIMEOUT = getattr(config, "HTTP_TIMEOUT", (10, 120))
+HTTP_MAX_RETRIES = getattr(config, "HTTP_MAX_RETRIES", 5)
+HTTP_POOL_SIZE = getattr(
+    config,
+    "HTTP_POOL_SIZE",
+    getattr(config, "INGEST_FETCH_WORKERS", 8) + getattr(config, "INGEST_UPSERT_WORKERS", 4),
+)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class TimeoutSession(requests.Session):
+    """
+    A requests session applying a default timeout to every request.
+
+    Parameters:
+    - timeout: The default timeout, a number or a (connect, read) tuple.
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session(pool_size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT, max_retries=HTTP_MAX_RETRIES):
+    """
+    Creates a session with a pooled, retrying adapter.
+
+    Parameters:
+    - pool_size: The number of keep-alive connections kept per host (default is HTTP_POOL_SIZE).
+    - timeout: The default timeout of requests (default is HTTP_TIMEOUT).
+    - max_retries: The number of retries of a failing request (default is HTTP_MAX_RETRIES).
+
+    Returns:
+    - A TimeoutSession instance.
+    """
+    # Statuses are retried by the request scheduler
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=0.5,
+        status_forcelist=(),
+        allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+        respect_retry_after_header=False,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = TimeoutSession(timeout)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+    return session
+
+
+def get_session():
+    """
+    Returns the process wide session, creating it on first use.
+    """
+    global _session  # pylint: disable=global-statement
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                logging.debug(f"Creating HTTP session with a pool of {HTTP_POOL_SIZE} connections")
+                _session = create_session()
+    return _session
+
+
+def box_get(client, url, endpoint="box_content", **kwargs):
+    """
+    Sends an authenticated GET request to Box through the shared session and the request scheduler.
+
+    The access token is sent in the Authorization header. If Box rejects it,
+    the token is refreshed through the client's auth object and the request
+    is sent once more. Throttled requests are retried by the scheduler.
+
+    Parameters:
+    - client: The Box client whose access token is used.
+    - url: The URL to get.
+    - endpoint: The endpoint class of the request (default is "box_content").
+    - kwargs: Additional arguments for requests, e.g. stream or params.
+
+    Returns:
+    - The response, after raise_for_status.
+    """
+    session = get_session()
+
+    def get():
+        access_token = client.auth.access_token
+        response = session.get(url, headers={"Authorization": f"Bearer {access_token}"}, **kwargs)
+        if response.status_code == 401:
+            response.close()
+            logging.info("Access token rejected, refreshing it")
+            client.auth.refresh(access_token)
+            response = session.get(url, headers={"Authorization": f"Bearer {client.auth.access_token}"}, **kwargs)
+        if not response.ok:
+            response.close()
+            response.raise_for_status()
+        return response
+
+    return get_scheduler().call(endpoint, get)
+
+
+def box_endpoint(url, headers=None, params=None):
+    """
+    Classifies a Box API request into an endpoint class of the request scheduler.
+
+    Parameters:
+    - url: The URL of the request.
+    - headers: The headers of the request.
+    - params: The query parameters of the request.
+
+    Returns:
+    - "box_listing", "box_representations", "box_content" or "box_api".
+    """
+    path = url.split("?", 1)[0]
+    if "/folders/" in path and path.endswith("/items"):
+        return "box_listing"
+    if path.endswith("/content"):
+        return "box_content"
+    fields = str((params or {}).get("fields", ""))
+    if "representations" in fields or any(name.lower() == "x-rep-hints" for name in (headers or {})):
+        return "box_representations"
+    return "box_api"
+
+
+class ScheduledNetwork(DefaultNetwork):
+    """
+    boxsdk network layer sending every request through the request scheduler.
+
+    The boxsdk keeps retrying throttled requests itself, honoring Retry-After:
+    this layer holds a request slot of the endpoint class for every attempt
+    and reports the responses, so the concurrency adapts to them.
+    """
+
+    def request(self, method, url, access_token, **kwargs):
+        limiter = get_scheduler().limiter(box_endpoint(url, kwargs.get("headers"), kwargs.get("params")))
+        with limiter.slot() as sent_at:
+            response = super().request(method, url, access_token, **kwargs)
+            if response.status_code in THROTTLE_STATUS_CODES:
+                limiter.record_throttle(parse_retry_after(response.headers.get("Retry-After")), sent_at)
+            elif response.ok:
+                limiter.record_success()
+        return response
@@ -0,0 +1,213 @@
+"""
+Waits for Box to generate the extracted text representations.
+---
+Box generates the [extracted_text] representation of a file on demand,
+so right after an upload it is often "pending" or not generated at all
+("none"). The scheduler requests the representation of every file up
+front, triggers the generation where needed, and polls the pending ones
+in the background with exponential backoff. Files are handed out as soon
+as their representation is ready, in whatever order that happens. Files
+whose text is already available locally, e.g. cached, can be handed out
+right away without any request.
+"""
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import config
+from box_integration.box_integration import representation_download_url
+from box_integration.http_session import box_get
+from common import metrics
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+REPRESENTATION_WORKERS = getattr(config, "REPRESENTATION_WORKERS", 8)
+REPRESENTATION_MAX_ATTEMPTS = getattr(config, "REPRESENTATION_MAX_ATTEMPTS", 12)
+REPRESENTATION_MAX_DELAY = getattr(config, "REPRESENTATION_MAX_DELAY", 60)
+
+READY_STATES = {"success", "viewable"}
+
+# Marks the end of the ready files
+_DONE = object()
+
+
+class RepresentationScheduler:
+    """
+    Hands out files once their extracted text representation is ready.
+
+    Files whose representation cannot be obtained are collected in failed,
+    keyed by reason: "none" (Box cannot generate it), "error" (generation
+    failed), "timeout" (still pending after max_attempts polls) and
+    "exception" (the requests failed).
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - workers: The number of concurrent representation requests (default is REPRESENTATION_WORKERS).
+    - max_attempts: The number of polls of a pending representation (default is REPRESENTATION_MAX_ATTEMPTS).
+    - initial_delay: The seconds before the first poll, doubled on every attempt (default is 1).
+    - max_delay: The longest delay between two polls (default is REPRESENTATION_MAX_DELAY).
+    - has_text: Optional callable(file) returning True if the text of the file is available without
+      the representation. These files are handed out right away, with no download URL.
+    """
+
+    def __init__(self, client, workers=REPRESENTATION_WORKERS, max_attempts=REPRESENTATION_MAX_ATTEMPTS,
+                 initial_delay=1.0, max_delay=REPRESENTATION_MAX_DELAY, has_text=None):
+        self.client = client
+        self.has_text = has_text
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.failed = {"none": [], "error": [], "timeout": [], "exception": []}
+        self._ready = queue.Queue()
+        self._lock = threading.Condition()
+        self._polls = []
+        self._sequence = itertools.count()
+        self._outstanding = 0
+        self._scheduling_done = False
+        # The error that stopped the iteration of the files, raised once the files scheduled before are handed out
+        self._listing_error = None
+        self._executor = None
+
+    def ready_files(self, files):
+        """
+        Requests the representations of files and yields them as they become ready.
+
+        Parameters:
+        - files: An iterable of Box file objects, consumed on a background thread.
+
+        Returns:
+        - A generator of (file, download_url) tuples, download_url being None for the files of has_text.
+          It raises the error of files, if any, once the files listed before it are handed out.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="box-representation")
+        threading.Thread(target=self._schedule_all, args=(files,), name="representation-feeder", daemon=True).start()
+        threading.Thread(target=self._run_polls, name="representation-poller", daemon=True).start()
+        try:
+            while True:
+                item = self._ready.get()
+                if item is _DONE:
+                    break
+                yield item
+            if self._listing_error is not None:
+                raise self._listing_error
+        finally:
+            with self._lock:
+                self._scheduling_done = True
+                self._outstanding = 0
+                self._lock.notify_all()
+            self._executor.shutdown(wait=False)
+            self._log_failures()
+
+    def _schedule_all(self, files):
+        """Submits the first representation request of every file."""
+        try:
+            for file in files:
+                if self.has_text is not None and self.has_text(file):
+                    self._ready.put((file, None))
+                    continue
+                with self._lock:
+                    self._outstanding += 1
+                self._executor.submit(self._request, file, time.monotonic())
+        except Exception as e:
+            logging.error(f"Listing files for representations failed: {e}")
+            self._listing_error = e
+        finally:
+            with self._lock:
+                self._scheduling_done = True
+                self._lock.notify_all()
+            self._maybe_finish()
+
+    def _request(self, file, scheduled):
+        """Gets the representation info of a file."""
+        try:
+            representations = self.client.file(file.id).get_representation_info('[extracted_text]')
+            if not representations:
+                self._fail(file, "none", "no extracted text representation")
+                return
+            self._handle(file, representations[0], 0, scheduled)
+        except Exception as e:
+            self._fail(file, "exception", e)
+
+    def _poll(self, file, info_url, attempt, scheduled):
+        """Polls the info URL of a pending representation."""
+        try:
+            representation = box_get(self.client, info_url, endpoint="box_representations").json()
+            self._handle(file, representation, attempt, scheduled)
+        except Exception as e:
+            self._fail(file, "exception", e)
+
+    def _handle(self, file, representation, attempt, scheduled):
+        """Hands out, fails or reschedules a file depending on its representation state."""
+        state = representation['status']['state']
+        if state in READY_STATES:
+            metrics.observe("box_representation_wait_seconds", time.monotonic() - scheduled)
+            self._ready.put((file, representation_download_url(representation)))
+            self._resolve()
+            return
+        if state == "error":
+            self._fail(file, "error", "representation generation failed")
+            return
+        if state == "none" and attempt > 0:
+            self._fail(file, "none", "representation cannot be generated")
+            return
+        if attempt >= self.max_attempts:
+            self._fail(file, "timeout", f"representation still {state} after {attempt} polls")
+            return
+
+        info_url = representation['info']['url']
+        if state == "none":
+            # Requesting the info URL starts the generation
+            logging.debug(f"Requesting text representation generation for file: {file.name}")
+            box_get(self.client, info_url, endpoint="box_representations").close()
+        delay = min(self.initial_delay * (2 ** attempt), self.max_delay)
+        with self._lock:
+            heapq.heappush(self._polls, (time.monotonic() + delay, next(self._sequence), file, info_url, attempt + 1, scheduled))
+            self._lock.notify_all()
+
+    def _run_polls(self):
+        """Submits the polls of pending representations when they are due."""
+        with self._lock:
+            while True:
+                if self._scheduling_done and not self._outstanding:
+                    return
+                if not self._polls:
+                    self._lock.wait()
+                    continue
+                due, _, file, info_url, attempt, scheduled = self._polls[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._lock.wait(wait)
+                    continue
+                heapq.heappop(self._polls)
+                self._executor.submit(self._poll, file, info_url, attempt, scheduled)
+
+    def _fail(self, file, reason, error):
+        logging.warning(f"Text representation of file {file.name} unavailable ({reason}): {error}")
+        metrics.increment("box_representation_unavailable", reason=reason)
+        with self._lock:
+            self.failed[reason].append(file)
+        self._resolve()
+
+    def _resolve(self):
+        with self._lock:
+            self._outstanding -= 1
+        self._maybe_finish()
+
+    def _maybe_finish(self):
+        with self._lock:
+            finished = self._scheduling_done and not self._outstanding
+            self._lock.notify_all()
+        if finished:
+            self._ready.put(_DONE)
+
+    def _log_failures(self):
+        for reason, files in self.failed.items():
+            if files:
+                logging.error(f"{len(files)} files without text representation ({reason}): "
+                              + ", ".join(file.name for file in files))
@@ -0,0 +1,250 @@
+"""
+Cleans the extracted text representation of Box files.
+---
+The rules are applied in a fixed order, and each rule sees the output of
+the previous one. The cleaner keeps that behavior exactly, but avoids
+running a regular expression over the whole document for every rule:
+
+- literal removals use str.replace / str.translate and are skipped when
+  the text does not contain them,
+- the two word-joining rules are anchored on the hyphens in the text
+  instead of trying a match at every position,
+- whitespace is normalized with str.split / str.join.
+
+This module only depends on the standard library, so it is cheap to
+import in worker processes.
+"""
+import logging
+import re
+
+# Dash runs removed from the text, in order. "  —" goes first, so the
+# leftover dashes of a longer run can still match the shorter runs.
+_DASH_RUNS = ("  —", "——————————", "—————————", "—————")
+
+# Escaped unicode sequences left over by the text extraction, e.g. "\u00e9"
+_ESCAPED_UNICODE = re.compile(r'\\u[\dA-Fa-f]{4}')
+
+# Private use characters (bullets and checkboxes of symbol fonts)
+_PRIVATE_USE_CHARACTERS = {0xf075: None, 0xf0b7: None}
+
+
+def _is_word_character(character):
+    """Same as the \\w class of the re module for str patterns."""
+    return character.isalnum() or character == '_'
+
+
+def join_hyphenated_line_breaks(content):
+    """
+    Joins words broken by a hyphen at the end of a line, e.g. "exam-\\nple".
+
+    Same output as re.sub(r'(\\w+)-\\n(\\w+)', r'\\1\\2', content): a word
+    consumed as the second half of a join is not joined to the next one.
+
+    Parameters:
+    - content: The text content.
+
+    Returns:
+    - The text content with the broken words joined.
+    """
+    length = len(content)
+    pieces = []
+    start = 0
+    previous_end = 0
+    position = content.find('-\n')
+    while position != -1:
+        if (
+            0 < position != previous_end
+            and position + 2 < length
+            and _is_word_character(content[position - 1])
+            and _is_word_character(content[position + 2])
+        ):
+            pieces.append(content[start:position])
+            start = position + 2
+            end = position + 3
+            while end < length and _is_word_character(content[end]):
+                end += 1
+            previous_end = end
+            position = content.find('-\n', end)
+        else:
+            position = content.find('-\n', position + 1)
+
+    if not pieces:
+        return content
+    pieces.append(content[start:])
+    return ''.join(pieces)
+
+
+def tighten_spaced_hyphens(content):
+    """
+    Removes the whitespace around hyphens between two words, e.g. "a - b".
+
+    Same output as re.sub(r'(\\w)\\s*-\\s*(\\w)', r'\\1-\\2', content): the
+    word character following a hyphen cannot start the next match.
+
+    Parameters:
+    - content: The text content.
+
+    Returns:
+    - The text content with the hyphens tightened.
+    """
+    length = len(content)
+    pieces = []
+    start = 0
+    previous_end = 0
+    hyphen = content.find('-')
+    while hyphen != -1:
+        left = hyphen - 1
+        while left >= 0 and content[left].isspace():
+            left -= 1
+        right = hyphen + 1
+        while right < length and content[right].isspace():
+            right += 1
+        if (
+            left >= previous_end
+            and right < length
+            and _is_word_character(content[left])
+            and _is_word_character(content[right])
+        ):
+            if right - left != 2:
+                pieces.append(content[start:left + 1])
+                pieces.append('-')
+                start = right
+            previous_end = right + 1
+        hyphen = content.find('-', hyphen + 1)
+
+    if not pieces:
+        return content
+    pieces.append(content[start:])
+    return ''.join(pieces)
+
+
+def normalize_whitespace(content):
+    """
+    Collapses every run of whitespace into a single space.
+
+    Same output as re.sub(r'\\s+', ' ', content).
+
+    Parameters:
+    - content: The text content.
+
+    Returns:
+    - The text content with normalized whitespace.
+    """
+    words = content.split()
+    if not words:
+        return ' ' if content else content
+    normalized = ' '.join(words)
+    if content[0].isspace():
+        normalized = ' ' + normalized
+    if content[-1].isspace():
+        normalized += ' '
+    return normalized
+
+
+def clean_up_text(content: str) -> str:
+    """
+    Cleans up the text content by fixing hyphenated words broken by newline and removing unwanted patterns and characters.
+
+    Parameters:
+    - content: The text content to clean up.
+
+    Returns:
+    - The cleaned up text content.
+    """
+    logging.debug('Cleaning up text content')
+    if not content:
+        logging.warning('No content to clean')
+        return content
+
+    try:
+        if '-\n' in content:
+            content = join_hyphenated_line_breaks(content)
+    except Exception as e:
+        logging.error('Error cleaning up text content: %s', e)
+        return content
+
+    logging.debug('Removing unwanted patterns from text content')
+    content = content.replace('\n', '')
+    if '—' in content:
+        for dash_run in _DASH_RUNS:
+            content = content.replace(dash_run, '')
+    if '\\u' in content:
+        content = _ESCAPED_UNICODE.sub('', content)
+    if '\uf075' in content or '\uf0b7' in content:
+        content = content.translate(_PRIVATE_USE_CHARACTERS)
+
+    logging.debug('Fixing improperly spaced hyphenated words and normalizing whitespace')
+    if '-' in content:
+        content = tighten_spaced_hyphens(content)
+    return normalize_whitespace(content)
+
+
+# Characters no cleaning rule matches or removes. Cleaning the text before
+# and after one of them gives the same result as cleaning the whole text.
+_SAFE_SPLIT_CHARACTERS = ".,;:!?)(]["
+
+# Pending text is cleaned anyway past this size, even without a safe split
+_MAX_PENDING_CHARACTERS = 1_000_000
+
+
+class IncrementalCleaner:
+    """
+    Cleans text arriving in pieces, e.g. from a streamed download.
+
+    Text is held back until a punctuation character allows to split it
+    without changing the result, so the concatenated output is identical
+    to clean_up_text on the whole text. Only text without any punctuation
+    for more than a million characters is split at an arbitrary point.
+    """
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, piece):
+        """
+        Adds a piece of text.
+
+        Parameters:
+        - piece: The next piece of raw text.
+
+        Returns:
+        - The cleaned text that is final, possibly empty.
+        """
+        self._pending += piece
+        split = max(self._pending.rfind(character) for character in _SAFE_SPLIT_CHARACTERS)
+        if split == -1:
+            if len(self._pending) < _MAX_PENDING_CHARACTERS:
+                return ""
+            split = len(self._pending) - 1
+        ready, self._pending = self._pending[:split + 1], self._pending[split + 1:]
+        return _clean_piece(ready)
+
+    def finish(self):
+        """
+        Returns the cleaned remainder of the text.
+        """
+        ready, self._pending = self._pending, ""
+        return _clean_piece(ready)
+
+    def clean(self, pieces):
+        """
+        Cleans an iterable of raw text pieces.
+
+        Parameters:
+        - pieces: An iterable of raw text pieces.
+
+        Returns:
+        - A generator of cleaned text pieces.
+        """
+        for piece in pieces:
+            cleaned = self.feed(piece)
+            if cleaned:
+                yield cleaned
+        cleaned = self.finish()
+        if cleaned:
+            yield cleaned
+
+
+def _clean_piece(piece):
+    """Cleans a piece of a larger text, an empty piece is not an empty document."""
+    return clean_up_text(piece) if piece else piece
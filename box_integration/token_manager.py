@@ -0,0 +1,237 @@
+"""
+Box OAuth2 tokens shared by threads and processes.
+---
+ManagedOAuth2 keeps one access token in memory for all the threads using
+a client, together with its expiry read from the token file. The token is
+refreshed only when it is close to expiry, ahead of time by a background
+thread, or when Box rejects it.
+
+The token file is written atomically (write to a temporary file, then
+rename) and refreshes hold an exclusive lock on a companion lock file, so
+several processes sharing the file, e.g. main.py and the sync daemon, do
+not refresh the same token twice: a process waiting for the lock picks up
+the token written by the other one instead of spending the refresh token.
+"""
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from boxsdk import OAuth2
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows, refreshes are only synchronized between threads
+    fcntl = None
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+BOX_TOKEN_PATH = getattr(config, "BOX_TOKEN_PATH", ".oauth.json")
+# Seconds before expiry at which the access token is refreshed
+BOX_TOKEN_REFRESH_MARGIN = getattr(config, "BOX_TOKEN_REFRESH_MARGIN", 300)
+
+# Lifetimes assumed when Box does not return them
+ACCESS_TOKEN_LIFETIME = timedelta(minutes=60)
+REFRESH_TOKEN_LIFETIME = timedelta(days=60)
+
+# Seconds to wait before retrying a failed background refresh
+_RETRY_DELAY = 30
+
+
+def read_token_file(path=BOX_TOKEN_PATH):
+    """
+    Reads the stored tokens.
+
+    Parameters:
+    - path: The path of the token file (default is BOX_TOKEN_PATH).
+
+    Returns:
+    - A dictionary with the "access_token", "access_token_expires_on", "refresh_token"
+      and "refresh_token_expires_on", or None if there is no token file.
+    """
+    try:
+        with open(path, "r", encoding="UTF-8") as file:
+            return json.loads(file.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_token_file(access_token, refresh_token, access_token_expires_on, path=BOX_TOKEN_PATH):
+    """
+    Writes the tokens atomically: readers see either the previous or the new file.
+
+    Parameters:
+    - access_token: The access token.
+    - refresh_token: The refresh token.
+    - access_token_expires_on: The expiry of the access token, a datetime.
+    - path: The path of the token file (default is BOX_TOKEN_PATH).
+    """
+    oauth_json = {
+        "access_token": access_token,
+        "access_token_expires_on": str(access_token_expires_on),
+        "refresh_token": refresh_token,
+        "refresh_token_expires_on": str(datetime.today() + REFRESH_TOKEN_LIFETIME),
+    }
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=".oauth-", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w", encoding="UTF-8") as file:
+            file.write(json.dumps(oauth_json, indent=4))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temporary_path)
+        raise
+
+
+@contextlib.contextmanager
+def token_file_lock(path=BOX_TOKEN_PATH):
+    """
+    Holds an exclusive lock on the token file, across processes.
+
+    The lock is taken on a companion ".lock" file, as the token file itself
+    is replaced on every write.
+
+    Parameters:
+    - path: The path of the token file (default is BOX_TOKEN_PATH).
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a", encoding="UTF-8") as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def _parse_expiry(value):
+    """Parses a stored expiry, None if it is missing or malformed."""
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+class ManagedOAuth2(OAuth2):
+    """
+    boxsdk OAuth2 backed by the token file, refreshing the access token before it expires.
+
+    Parameters:
+    - client_id: The Box client ID.
+    - client_secret: The Box client secret.
+    - path: The path of the token file (default is BOX_TOKEN_PATH).
+    - refresh_margin: The seconds before expiry at which the token is refreshed (default is BOX_TOKEN_REFRESH_MARGIN).
+    """
+
+    def __init__(self, client_id, client_secret, path=BOX_TOKEN_PATH, refresh_margin=BOX_TOKEN_REFRESH_MARGIN):
+        self.path = path
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.access_token_expires_on = None
+        self._expires_in = None
+        self._stop = threading.Event()
+        self._refresher = None
+        # Reentrant, refresh() holds it around the base class refresh taking it again
+        super().__init__(client_id=client_id, client_secret=client_secret, refresh_lock=threading.RLock())
+        self._update_current_tokens(*self._get_tokens())
+
+    def _get_tokens(self):
+        """
+        Reads the tokens from the token file, so a token refreshed by another process is picked up.
+        """
+        oauth_dict = read_token_file(self.path)
+        if oauth_dict is None:
+            return self._access_token, self._refresh_token
+        self.access_token_expires_on = _parse_expiry(oauth_dict.get("access_token_expires_on"))
+        return oauth_dict.get("access_token"), oauth_dict.get("refresh_token")
+
+    def _execute_token_request(self, data, access_token, expect_refresh_token=True):
+        token_response = super()._execute_token_request(data, access_token, expect_refresh_token)
+        self._expires_in = token_response.expires_in if "expires_in" in token_response else None
+        return token_response
+
+    def _store_tokens(self, access_token, refresh_token):
+        if self._expires_in:
+            expires_on = datetime.today() + timedelta(seconds=self._expires_in)
+        else:
+            expires_on = datetime.today() + ACCESS_TOKEN_LIFETIME
+        self.access_token_expires_on = expires_on
+        super()._store_tokens(access_token, refresh_token)
+        if access_token is None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+            return
+        write_token_file(access_token, refresh_token, expires_on, self.path)
+
+    def authenticate(self, auth_code):
+        with self._refresh_lock, token_file_lock(self.path):
+            return super().authenticate(auth_code)
+
+    def refresh(self, access_token_to_refresh):
+        """
+        Refreshes the access token, unless another thread or process already did.
+        """
+        with self._refresh_lock, token_file_lock(self.path):
+            return super().refresh(access_token_to_refresh)
+
+    def seconds_until_refresh(self):
+        """
+        Returns the seconds left before the access token should be refreshed, 0 if it should be now.
+        """
+        if self._access_token is None or self.access_token_expires_on is None:
+            return 0
+        refresh_at = self.access_token_expires_on - self.refresh_margin
+        return max(0.0, (refresh_at - datetime.today()).total_seconds())
+
+    def ensure_fresh(self):
+        """
+        Refreshes the access token if it is missing, expired or about to expire.
+
+        Returns:
+        - The current access token.
+        """
+        if self.seconds_until_refresh() > 0:
+            return self._access_token
+        with self._refresh_lock:
+            # Another thread, or another process through the token file, may have refreshed it meanwhile
+            access_token, refresh_token = self._get_tokens()
+            self._update_current_tokens(access_token, refresh_token)
+            if self.seconds_until_refresh() > 0:
+                return self._access_token
+            logging.info("Box access token is about to expire, refreshing it")
+            return self.refresh(self._access_token)[0]
+
+    def start_background_refresh(self):
+        """
+        Starts a daemon thread refreshing the access token ahead of its expiry.
+        """
+        if self._refresher is not None:
+            return
+        self._refresher = threading.Thread(target=self._refresh_loop, name="box-token-refresh", daemon=True)
+        self._refresher.start()
+
+    def stop_background_refresh(self):
+        """Stops the background refresh thread."""
+        self._stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
+    def _refresh_loop(self):
+        delay = self.seconds_until_refresh()
+        while not self._stop.wait(delay):
+            try:
+                self.ensure_fresh()
+                # A token living less than the margin is refreshed every _RETRY_DELAY
+                delay = self.seconds_until_refresh() or _RETRY_DELAY
+            except Exception as e:
+                logging.error(f"Background refresh of the Box access token failed: {e}")
+                delay = _RETRY_DELAY
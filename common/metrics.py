@@ -0,0 +1,498 @@
+"""
+Counters and latency histograms of the ingestion and query stages.
+---
+Disabled by default (METRICS_ENABLED). When disabled, increment() and
+observe() return right away and timer() / timed_iter() hand back shared
+no-op objects, so the instrumentation left in the code costs a function
+call and an attribute check.
+
+When enabled, every metric is kept per name and label set. report() prints
+a summary table at the end of a run and optionally writes the metrics in
+the Prometheus text format and as OTLP JSON.
+
+profile() is a separate, opt-in hook (PROFILE_ENABLED) running cProfile
+in every thread and tracemalloc around a block and printing the top
+hotspots, the files with the highest peak memory while indexed and the
+source files with the most allocated memory.
+"""
+import bisect
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import config
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+METRICS_ENABLED = getattr(config, "METRICS_ENABLED", False)
+METRICS_PROMETHEUS_PATH = getattr(config, "METRICS_PROMETHEUS_PATH", None)
+METRICS_OTLP_PATH = getattr(config, "METRICS_OTLP_PATH", None)
+PROFILE_ENABLED = getattr(config, "PROFILE_ENABLED", False)
+PROFILE_TOP = getattr(config, "PROFILE_TOP", 20)
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 10, 50, 100, 500, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+# In MB
+MEMORY_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1_000, 2_500)
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets and keeps their sum, minimum and maximum.
+
+    Parameters:
+    - buckets: The sorted upper bounds of the buckets, an overflow bucket is added.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile by interpolating inside its bucket.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for position, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[position - 1] if position else min(self.min, self.buckets[0])
+                upper = self.buckets[position] if position < len(self.buckets) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / bucket_count
+                return min(max(estimate, self.min), self.max)
+            seen += bucket_count
+        return self.max
+
+
+class MetricsRegistry:
+    """
+    Holds the counters and histograms of a process. Safe to share between threads.
+
+    Parameters:
+    - enabled: Whether metrics are recorded (default is METRICS_ENABLED).
+    """
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        """
+        Adds value to a counter.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        """
+        Records a value in a histogram, latencies are in seconds.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """
+        Returns a context manager recording the duration of its block in a histogram.
+        """
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name, labels)
+
+    def timed_iter(self, name, iterable, **labels):
+        """
+        Wraps an iterable, recording the time spent producing its items once it is exhausted.
+
+        Only the time spent in this iterable is counted: the time spent in
+        other timed iterables it pulls from is excluded, so chained lazy
+        stages (download -> clean -> chunk) are each measured on their own.
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iterable, labels)
+
+    def _timed_iter(self, name, iterable, labels):
+        frames = _frames()
+        iterator = iter(iterable)
+        own_time = 0.0
+        while True:
+            frames.append(0.0)
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+                done = False
+            except StopIteration:
+                done = True
+            elapsed = time.perf_counter() - started
+            nested = frames.pop()
+            own_time += elapsed - nested
+            if frames:
+                frames[-1] += elapsed
+            if done:
+                break
+            yield item
+        self.observe(name, own_time, **labels)
+
+    def reset(self):
+        """Forgets all recorded metrics."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def summary_table(self):
+        """
+        Returns the metrics as a text table.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        lines = []
+        if histograms:
+            lines.append(f"{'histogram':<52}{'count':>8}{'sum':>14}{'mean':>12}{'p50':>12}{'p99':>12}{'max':>12}")
+            for (name, labels), histogram in histograms:
+                lines.append(
+                    f"{_display_name(name, labels):<52}{histogram.count:>8}{histogram.sum:>14.3f}"
+                    f"{histogram.sum / histogram.count:>12.4f}{histogram.quantile(0.5):>12.4f}"
+                    f"{histogram.quantile(0.99):>12.4f}{histogram.max:>12.4f}"
+                )
+        if counters:
+            lines.append("")
+            lines.append(f"{'counter':<52}{'value':>14}")
+            for (name, labels), value in counters:
+                lines.append(f"{_display_name(name, labels):<52}{value:>14}")
+        return "\n".join(lines) if lines else "No metrics recorded"
+
+    def prometheus_text(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            metric_name = f"{name}_total"
+            if metric_name not in typed:
+                lines.append(f"# TYPE {metric_name} counter")
+                typed.add(metric_name)
+            lines.append(f"{metric_name}{_prometheus_labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_prometheus_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_prometheus_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_prometheus_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def otlp_json(self, service_name="box-pinecone-integration"):
+        """
+        Returns the metrics as an OTLP/JSON metrics export request.
+        """
+        now = str(time.time_ns())
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        metrics = {}
+        for (name, labels), value in counters:
+            metric = metrics.setdefault(name, {
+                "name": name,
+                "sum": {"dataPoints": [], "aggregationTemporality": 2, "isMonotonic": True},
+            })
+            metric["sum"]["dataPoints"].append({
+                "attributes": _otlp_attributes(labels), "timeUnixNano": now, "asDouble": value,
+            })
+        for (name, labels), histogram in histograms:
+            metric = metrics.setdefault(name, {
+                "name": name,
+                "histogram": {"dataPoints": [], "aggregationTemporality": 2},
+            })
+            metric["histogram"]["dataPoints"].append({
+                "attributes": _otlp_attributes(labels),
+                "timeUnixNano": now,
+                "count": str(histogram.count),
+                "sum": histogram.sum,
+                "min": histogram.min,
+                "max": histogram.max,
+                "bucketCounts": [str(count) for count in histogram.counts],
+                "explicitBounds": list(histogram.buckets),
+            })
+        return {"resourceMetrics": [{
+            "resource": {"attributes": _otlp_attributes((("service.name", service_name),))},
+            "scopeMetrics": [{"scope": {"name": __name__}, "metrics": list(metrics.values())}],
+        }]}
+
+
+class _Timer:
+    """Records the duration of a with block."""
+
+    def __init__(self, registry, name, labels):
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._registry.observe(self._name, time.perf_counter() - self._started, **self._labels)
+        return False
+
+
+class _NoTimer:
+    """The timer handed out while metrics are disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+_local = threading.local()
+
+
+def _frames():
+    """The time spent in nested timed iterables, per thread."""
+    frames = getattr(_local, "frames", None)
+    if frames is None:
+        frames = _local.frames = []
+    return frames
+
+
+def _display_name(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{key}={value}" for key, value in labels) + "}"
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _otlp_attributes(labels):
+    return [{"key": key, "value": {"stringValue": str(value)}} for key, value in labels]
+
+
+# The registry of the process
+registry = MetricsRegistry()
+
+increment = registry.increment
+observe = registry.observe
+timer = registry.timer
+timed_iter = registry.timed_iter
+
+
+def report(prometheus_path=METRICS_PROMETHEUS_PATH, otlp_path=METRICS_OTLP_PATH, stream=None):
+    """
+    Prints the end of run summary table and writes the configured exports.
+
+    Does nothing while metrics are disabled.
+
+    Parameters:
+    - prometheus_path: Optional path of a Prometheus text file (default is METRICS_PROMETHEUS_PATH).
+    - otlp_path: Optional path of an OTLP JSON file (default is METRICS_OTLP_PATH).
+    - stream: Where to print the table (default is sys.stderr).
+    """
+    if not registry.enabled:
+        return
+    print(registry.summary_table(), file=stream or sys.stderr)
+    if prometheus_path:
+        with open(prometheus_path, "w", encoding="UTF-8") as file:
+            file.write(registry.prometheus_text())
+    if otlp_path:
+        with open(otlp_path, "w", encoding="UTF-8") as file:
+            file.write(json.dumps(registry.otlp_json(), indent=4))
+
+
+class _ThreadProfiles:
+    """
+    A cProfile profiler per thread started while profiling, merged into one report.
+
+    Before Python 3.12 a profiler only sees the thread that enabled it, so
+    every new thread enables its own from the threading profile hook. From
+    3.12 on, profilers use sys.monitoring and see all threads, one is enough.
+    """
+
+    _ONE_PROFILER = sys.version_info >= (3, 12)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._caller = cProfile.Profile()
+        self._threads = []
+
+    def start(self):
+        if not self._ONE_PROFILER:
+            threading.setprofile(self._start_thread)
+        self._caller.enable()
+
+    def _start_thread(self, frame, event, arg):  # pylint: disable=unused-argument
+        # Called on the first event of a new thread, the profiler replaces the hook
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._threads.append(profiler)
+        profiler.enable()
+
+    def stop(self):
+        """Stops profiling the calling thread and the threads started from now on."""
+        self._caller.disable()
+        if not self._ONE_PROFILER:
+            threading.setprofile(None)
+
+    def stats(self):
+        """Returns the pstats.Stats of all threads, merged."""
+        with self._lock:
+            threads = list(self._threads)
+        stats = pstats.Stats(self._caller)
+        for profiler in threads:
+            stats.add(_ProfilerSnapshot(profiler))
+        return stats
+
+
+class _ProfilerSnapshot:
+    """
+    The stats of a thread profiler in the form pstats.Stats loads.
+
+    A profiler can only be disabled from its own thread, the stats of the
+    threads still running at the end of the block are read while it runs.
+    """
+
+    def __init__(self, profiler):
+        profiler.snapshot_stats()
+        self.stats = profiler.stats
+
+    def create_stats(self):
+        pass
+
+
+# The peak traced memory of every file, while profile() traces allocations
+_memory_lock = threading.Lock()
+_file_peaks = []
+_overall_peak = 0
+
+
+def start_memory_peak():
+    """
+    Starts measuring the peak traced memory of a file, does nothing unless profile() traces allocations.
+
+    The peak is of the whole process, so while files are processed
+    concurrently it is an upper bound of the memory of each one.
+    """
+    global _overall_peak  # pylint: disable=global-statement
+    if not tracemalloc.is_tracing():
+        return
+    with _memory_lock:
+        _overall_peak = max(_overall_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+
+def record_memory_peak(label):
+    """
+    Records the peak traced memory since start_memory_peak(), does nothing unless profile() traces allocations.
+
+    Parameters:
+    - label: The name of the file, used in the profile report.
+    """
+    if not tracemalloc.is_tracing():
+        return
+    peak = tracemalloc.get_traced_memory()[1]
+    with _memory_lock:
+        _file_peaks.append((peak, label))
+    observe("file_peak_traced_mb", peak / 1_000_000, buckets=MEMORY_BUCKETS)
+
+
+@contextlib.contextmanager
+def profile(name, enabled=PROFILE_ENABLED, top=PROFILE_TOP, stream=None):
+    """
+    Profiles a block with cProfile and tracemalloc when enabled.
+
+    Prints the functions with the highest cumulative time, over the thread
+    running the block and every thread it starts, the files with the
+    highest peak traced memory while they were indexed, and the source
+    files that allocated the most memory still held at the end of the block.
+
+    Parameters:
+    - name: The name of the profiled run, used in the report.
+    - enabled: Whether to profile (default is PROFILE_ENABLED).
+    - top: The number of entries of each list (default is PROFILE_TOP).
+    - stream: Where to print the report (default is sys.stderr).
+    """
+    global _overall_peak  # pylint: disable=global-statement
+    if not enabled:
+        yield
+        return
+    stream = stream or sys.stderr
+    profiles = _ThreadProfiles()
+    with _memory_lock:
+        _file_peaks.clear()
+        _overall_peak = 0
+    tracemalloc.start()
+    profiles.start()
+    try:
+        yield
+    finally:
+        profiles.stop()
+        snapshot = tracemalloc.take_snapshot()
+        with _memory_lock:
+            file_peaks = sorted(_file_peaks, reverse=True)
+            peak = max([_overall_peak, tracemalloc.get_traced_memory()[1]] + [size for size, _ in file_peaks])
+        tracemalloc.stop()
+
+        output = io.StringIO()
+        stats = profiles.stats()
+        stats.stream = output
+        stats.sort_stats("cumulative").print_stats(top)
+        print(f"Profile of {name}: top {top} functions by cumulative time, all threads", file=stream)
+        print(output.getvalue(), file=stream)
+        print(f"Peak traced memory: {peak / 1_000_000:.1f} MB", file=stream)
+        if file_peaks:
+            print(f"Top {top} of {len(file_peaks)} files by peak traced memory while indexed:", file=stream)
+            for size, label in file_peaks[:top]:
+                print(f"{size / 1_000_000:>10.2f} MB  {label}", file=stream)
+        print(f"Top {top} source files by allocated memory held at the end:", file=stream)
+        for statistic in snapshot.statistics("filename")[:top]:
+            print(f"{statistic.size / 1_000_000:>10.2f} MB {statistic.count:>10} blocks  {statistic.traceback}", file=stream)
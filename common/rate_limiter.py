@@ -0,0 +1,343 @@
+"""
+Limits the load sent to the external services.
+---
+The RequestScheduler adapts the load to the services: every endpoint
+class (Box listing, representations, content, Pinecone upsert, search,
+rerank, OpenAI chat) has an AdaptiveLimiter whose concurrency grows by
+one per window of successful requests and is halved when the service
+answers 429 or 5xx (AIMD). A Retry-After header pauses the whole endpoint
+class, and throttled requests are retried with backoff. All Box, Pinecone
+and OpenAI calls of the ingestion and query paths go through
+get_scheduler().
+"""
+import contextlib
+import email.utils
+import logging
+import random
+import sys
+import threading
+import time
+import config
+from common import metrics
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+# Endpoint classes: initial and largest number of requests in flight, requests per second (None for no rate limit)
+DEFAULT_ENDPOINT_LIMITS = {
+    "box_api": {"concurrency": 4, "max_concurrency": 16, "rate": None},
+    "box_listing": {"concurrency": 4, "max_concurrency": 16, "rate": None},
+    "box_representations": {"concurrency": 8, "max_concurrency": 32, "rate": None},
+    "box_content": {"concurrency": 8, "max_concurrency": 32, "rate": None},
+    "pinecone_upsert": {"concurrency": 4, "max_concurrency": 16, "rate": None},
+    "pinecone_search": {"concurrency": 8, "max_concurrency": 32, "rate": None},
+    "pinecone_rerank": {"concurrency": 4, "max_concurrency": 16, "rate": None},
+    # Deletes and record ID listings
+    "pinecone_data": {"concurrency": 4, "max_concurrency": 16, "rate": None},
+    "openai_chat": {"concurrency": 4, "max_concurrency": 16, "rate": None},
+}
+# Per endpoint overrides of DEFAULT_ENDPOINT_LIMITS, e.g. {"box_content": {"rate": 16}}
+SCHEDULER_ENDPOINTS = getattr(config, "SCHEDULER_ENDPOINTS", {})
+SCHEDULER_MAX_ATTEMPTS = getattr(config, "SCHEDULER_MAX_ATTEMPTS", 6)
+SCHEDULER_BACKOFF_SECONDS = getattr(config, "SCHEDULER_BACKOFF_SECONDS", 0.5)
+
+# Responses telling the client to slow down
+THROTTLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+_MAX_BACKOFF_SECONDS = 30
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Safe to share between threads.
+
+    Parameters:
+    - rate: The number of tokens added per second.
+    - capacity: The largest burst, in tokens (default is rate, at least 1).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """
+        Takes tokens from the bucket, sleeping until enough are available.
+
+        Parameters:
+        - tokens: The number of tokens to take (default is 1).
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def error_status(error):
+    """
+    Returns the HTTP status of a failed request, None if there is none.
+
+    Understands the exceptions of requests, boxsdk, Pinecone and OpenAI.
+    """
+    status = getattr(error, "status", None) or getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(error):
+    """
+    Returns the delay asked for by the Retry-After header of a failed request, None if there is none.
+    """
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    return parse_retry_after((headers or {}).get("Retry-After") or (headers or {}).get("retry-after"))
+
+
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header, in seconds or as an HTTP date.
+
+    Returns:
+    - The number of seconds to wait, or None if the value is missing or malformed.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def is_connection_error(error):
+    """Checks if a request failed before getting a response."""
+    connection_errors = (ConnectionError, TimeoutError)
+    # Errors of urllib3 and requests, looked up rather than imported: they can only come from a loaded library
+    urllib3 = sys.modules.get("urllib3")
+    if urllib3 is not None:
+        connection_errors += (urllib3.exceptions.HTTPError,)
+    requests = sys.modules.get("requests")
+    if requests is not None:
+        connection_errors += (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    if isinstance(error, connection_errors):
+        return True
+    # openai.APIConnectionError and its APITimeoutError, matched by name so openai is not imported here
+    return any(cls.__name__ == "APIConnectionError" for cls in type(error).__mro__)
+
+
+class AdaptiveLimiter:
+    """
+    Adapts the number of requests in flight to an endpoint class to the responses of the service.
+
+    Safe to share between threads.
+
+    Parameters:
+    - name: The name of the endpoint class, used in the logs and metrics.
+    - concurrency: The initial number of requests in flight.
+    - max_concurrency: The largest number of requests in flight (default is concurrency).
+    - min_concurrency: The smallest number of requests in flight (default is 1).
+    - rate: The number of requests per second, or None for no rate limit (default is None).
+    """
+
+    def __init__(self, name, concurrency, max_concurrency=None, min_concurrency=1, rate=None):
+        self.name = name
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(max_concurrency or concurrency, concurrency)
+        self.limit = float(max(concurrency, self.min_concurrency))
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._decreased_at = 0.0
+        self._condition = threading.Condition()
+        self._bucket = TokenBucket(rate) if rate else None
+
+    @property
+    def concurrency(self):
+        """The current number of requests allowed in flight."""
+        return int(self.limit)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Holds a request slot: waits for a pause to end, a free slot and a rate token.
+
+        The caller reports the outcome with record_success() or record_throttle().
+
+        Returns:
+        - The monotonic time the request is sent at, to pass to record_throttle().
+        """
+        started = time.monotonic()
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    self._condition.wait(self._paused_until - now)
+                elif self._in_flight >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    break
+            self._in_flight += 1
+        try:
+            if self._bucket is not None:
+                self._bucket.acquire()
+            sent_at = time.monotonic()
+            metrics.observe("scheduler_wait_seconds", sent_at - started, endpoint=self.name)
+            yield sent_at
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+
+    def record_success(self):
+        """
+        Additive increase: one more slot after a window of successful requests.
+
+        Called while holding the slot. The concurrency only grows while all the slots are used.
+        """
+        with self._condition:
+            if self.limit >= self.max_concurrency or self._in_flight < int(self.limit):
+                return
+            previous = int(self.limit)
+            self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            if int(self.limit) > previous:
+                self._condition.notify_all()
+
+    def record_throttle(self, retry_after=None, sent_at=None):
+        """
+        Multiplicative decrease: halves the concurrency, and pauses the endpoint class for retry_after seconds.
+
+        A request sent before the last decrease was sent at the old
+        concurrency, its throttled response does not lower it again.
+        """
+        metrics.increment("scheduler_throttled", endpoint=self.name)
+        now = time.monotonic()
+        with self._condition:
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            if sent_at is not None and sent_at < self._decreased_at:
+                return
+            self._decreased_at = now
+            self.limit = max(self.min_concurrency, self.limit / 2)
+        logging.info(f"{self.name} is throttling, concurrency lowered to {int(self.limit)}")
+
+    def call(self, func, *args, max_attempts=SCHEDULER_MAX_ATTEMPTS, backoff_seconds=SCHEDULER_BACKOFF_SECONDS,
+             **kwargs):
+        """
+        Calls func in a request slot, retrying throttled requests and connection errors.
+
+        Parameters:
+        - func: The callable sending the request. It raises on a failed request.
+        - args, kwargs: The arguments of func.
+        - max_attempts: The number of attempts before giving up (default is SCHEDULER_MAX_ATTEMPTS).
+        - backoff_seconds: The delay before the first retry without Retry-After, doubled on every
+          attempt (default is SCHEDULER_BACKOFF_SECONDS).
+
+        Returns:
+        - The result of func.
+        """
+        attempt = 1
+        while True:
+            with self.slot() as sent_at:
+                try:
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    throttled = error_status(e) in THROTTLE_STATUS_CODES
+                    retry_after = retry_after_seconds(e) if throttled else None
+                    if throttled:
+                        self.record_throttle(retry_after, sent_at)
+                    if attempt >= max_attempts or not (throttled or is_connection_error(e)):
+                        raise
+                    error = e
+                else:
+                    self.record_success()
+                    return result
+            if retry_after is None:
+                retry_after = min(_MAX_BACKOFF_SECONDS, backoff_seconds * (2 ** (attempt - 1)) * (0.5 + random.random()))
+            metrics.increment("scheduler_retries", endpoint=self.name)
+            logging.warning(f"{self.name} request failed ({error}), retry {attempt}/{max_attempts - 1} in {retry_after:.1f}s")
+            time.sleep(retry_after)
+            attempt += 1
+
+
+class RequestScheduler:
+    """
+    The adaptive limiters of the endpoint classes, created on first use. Safe to share between threads.
+
+    Parameters:
+    - limits: The limits of the endpoint classes, see DEFAULT_ENDPOINT_LIMITS
+      (default is DEFAULT_ENDPOINT_LIMITS updated with SCHEDULER_ENDPOINTS).
+    """
+
+    def __init__(self, limits=None):
+        if limits is None:
+            limits = {
+                endpoint: dict(DEFAULT_ENDPOINT_LIMITS.get(endpoint, {}), **SCHEDULER_ENDPOINTS.get(endpoint, {}))
+                for endpoint in set(DEFAULT_ENDPOINT_LIMITS) | set(SCHEDULER_ENDPOINTS)
+            }
+        self.limits = limits
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, endpoint):
+        """Returns the limiter of an endpoint class."""
+        limiter = self._limiters.get(endpoint)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(endpoint)
+                if limiter is None:
+                    limits = self.limits.get(endpoint, {"concurrency": 4, "max_concurrency": 16})
+                    limiter = self._limiters[endpoint] = AdaptiveLimiter(endpoint, **limits)
+        return limiter
+
+    def call(self, endpoint, func, *args, **kwargs):
+        """Calls func through the limiter of an endpoint class, see AdaptiveLimiter.call."""
+        return self.limiter(endpoint).call(func, *args, **kwargs)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Returns the process wide scheduler, creating it on first use.
+    """
+    global _scheduler  # pylint: disable=global-statement
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = RequestScheduler()
+    return _scheduler
+
+
+def scheduled_call(endpoint, func, *args, **kwargs):
+    """
+    Calls func through the process wide scheduler.
+
+    Parameters:
+    - endpoint: The endpoint class of the request, e.g. "box_content" or "pinecone_search".
+    - func: The callable sending the request.
+    - args, kwargs: The arguments of func, and optionally max_attempts and backoff_seconds.
+
+    Returns:
+    - The result of func.
+    """
+    return get_scheduler().call(endpoint, func, *args, **kwargs)
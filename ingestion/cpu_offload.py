@@ -0,0 +1,142 @@
+"""
+Cleans and chunks large documents in worker processes.
+---
+Cleaning and chunking are pure Python and hold the GIL: with threads,
+only one document is processed at a time however many cores there are.
+With INGEST_CPU_OFFLOAD enabled, documents of at least
+INGEST_CPU_OFFLOAD_MIN_CHARS characters are cleaned and chunked in a
+process pool with one process per core (INGEST_CPU_PROCESSES). Smaller
+documents stay in the calling thread, where the handoff would cost more
+than it saves.
+
+The texts are not pickled. The calling thread copies the UTF-8 encoded
+text into a shared memory block and the worker hands the cleaned text
+back the same way, with the (start, end) span of every chunk in it. The
+calling thread then slices the chunks and builds the records. Where
+shared memory is not available, the texts are pickled instead.
+
+Offloading needs the whole text, so the indexer uses the non streaming
+fetch and process stages when it is enabled.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import config
+from box_integration.text_cleaning import clean_up_text
+from pinecone_integration.pinecone_client import CHUNK_OVERLAP, iter_content_defined_chunks
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+CPU_OFFLOAD = getattr(config, "INGEST_CPU_OFFLOAD", False)
+# Worker processes, one per core by default
+CPU_PROCESSES = getattr(config, "INGEST_CPU_PROCESSES", None) or os.cpu_count() or 1
+# Documents shorter than this are cleaned and chunked in the calling thread
+CPU_OFFLOAD_MIN_CHARS = getattr(config, "INGEST_CPU_OFFLOAD_MIN_CHARS", 1_000_000)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process wide pool of worker processes, starting it on first use.
+
+    Workers are spawned rather than forked, the ingestion process runs many threads.
+    """
+    global _pool  # pylint: disable=global-statement
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                logging.debug(f"Starting {CPU_PROCESSES} worker processes for cleaning and chunking")
+                # Started before the workers, they share it and a block created by one side can be freed by the other
+                resource_tracker.ensure_running()
+                _pool = ProcessPoolExecutor(max_workers=CPU_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def _share(text):
+    """Copies a text into a new shared memory block, returns the block and the number of bytes."""
+    data = text.encode("utf-8")
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+    block.buf[:len(data)] = data
+    return block, len(data)
+
+
+def _read_shared(name, size, unlink=False):
+    """Reads the text of a shared memory block, freeing the block if unlink is set."""
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(block.buf[:size]).decode("utf-8")
+    finally:
+        block.close()
+        if unlink:
+            block.unlink()
+
+
+def _chunk_spans(text, chunks):
+    """Returns the (start, end) span of every chunk in the text they were cut from."""
+    spans = []
+    end = 0
+    for chunk in chunks:
+        # Every chunk repeats the tail of the previous one
+        start = end - min(CHUNK_OVERLAP, end - spans[-1][0]) if spans else 0
+        end = start + len(chunk)
+        spans.append((start, end))
+    return spans
+
+
+def _clean_and_chunk(text, suffix, clean=True):
+    """Cleans a text if clean is set, appends the suffix and chunks it, returns the combined text and the chunk spans."""
+    combined = (clean_up_text(text) if clean else text) + " " + suffix
+    return combined, _chunk_spans(combined, iter_content_defined_chunks([combined]))
+
+
+def _clean_and_chunk_shared(name, size, suffix, clean=True):
+    """Worker side of clean_and_chunk for a text in shared memory, answering in shared memory too."""
+    combined, spans = _clean_and_chunk(_read_shared(name, size), suffix, clean)
+    block, combined_size = _share(combined)
+    block.close()
+    return block.name, combined_size, spans
+
+
+def _clean_and_chunk_pickled(text, suffix, clean=True):
+    """Worker side of clean_and_chunk when shared memory is not available."""
+    return _clean_and_chunk(text, suffix, clean)
+
+
+def should_offload(text):
+    """Returns True if the text is long enough to be cleaned and chunked in a worker process."""
+    return CPU_OFFLOAD and text is not None and len(text) >= CPU_OFFLOAD_MIN_CHARS
+
+
+def clean_and_chunk(text, suffix="", clean=True):
+    """
+    Cleans a text, appends a suffix to it and chunks it, in a worker process.
+
+    Parameters:
+    - text: The raw text.
+    - suffix: The text appended after the cleaned text, separated by a space (default is empty).
+    - clean: Clean the text, off for a text cleaned already, e.g. cached (default is True).
+
+    Returns:
+    - A tuple of the combined text, clean_up_text(text) + " " + suffix, and the list of its chunks.
+    """
+    pool = get_pool()
+    try:
+        block, size = _share(text)
+    except OSError as e:
+        logging.warning(f"Shared memory unavailable, pickling the text instead: {e}")
+        combined, spans = pool.submit(_clean_and_chunk_pickled, text, suffix, clean).result()
+    else:
+        try:
+            name, combined_size, spans = pool.submit(_clean_and_chunk_shared, block.name, size, suffix, clean).result()
+        finally:
+            block.close()
+            block.unlink()
+        combined = _read_shared(name, combined_size, unlink=True)
+    return combined, [combined[start:end] for start, end in spans]
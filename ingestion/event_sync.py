@@ -0,0 +1,314 @@
+"""
+Keeps the Pinecone index in sync with a Box folder from the events stream.
+---
+Events are coalesced per file and debounced: a burst of edits to one file
+results in a single re-index once the file has been quiet for a while.
+Uploads, moves, copies and restores from the trash re-check the file
+against the configured folder and re-index or delete it, trashed files
+have their chunks deleted.
+
+An action that fails is retried with an exponential backoff and added to
+the dead-letter list of the manifest. The saved position holds at its
+event until it succeeds or runs out of attempts, then main.py retries the
+file from the dead-letter list on its next run.
+"""
+import logging
+import time
+import traceback
+import config
+from boxsdk.exception import BoxAPIException
+from box_integration.box_integration import LISTING_FIELDS, is_supported_file_type
+from ingestion.indexer import index_file, invalidate_cached_queries, record_failure, remove_file
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+DEBOUNCE_SECONDS = getattr(config, "EVENTS_DEBOUNCE_SECONDS", 5)
+MAX_DELAY_SECONDS = getattr(config, "EVENTS_MAX_DELAY_SECONDS", 60)
+RETRY_SECONDS = getattr(config, "EVENTS_RETRY_SECONDS", 10)
+MAX_ATTEMPTS = getattr(config, "EVENTS_MAX_ATTEMPTS", 5)
+
+# Event types the sync reacts to, and what they mean for the file
+SYNC_EVENTS = {"ITEM_UPLOAD", "ITEM_MOVE", "ITEM_COPY", "ITEM_UNDELETE_VIA_TRASH"}
+DELETE_EVENTS = {"ITEM_TRASH"}
+
+SYNC = "sync"
+DELETE = "delete"
+
+
+class EventCoalescer:
+    """
+    Collapses the events of each file into one pending action.
+
+    A file becomes due once no event arrived for it during debounce_seconds,
+    or max_delay_seconds after its first event, whichever comes first.
+    An action handed out by pop_due is in flight until done() or retry()
+    is called for its file, its events are not safe to skip until then.
+
+    Parameters:
+    - debounce_seconds: The quiet time required before acting on a file.
+    - max_delay_seconds: The longest an action is postponed by new events, and the longest retry backoff.
+    - retry_seconds: The backoff before the first retry of a failed action, doubled on every retry.
+    - max_attempts: The number of attempts of an action before it is given up.
+    """
+
+    def __init__(self, debounce_seconds=DEBOUNCE_SECONDS, max_delay_seconds=MAX_DELAY_SECONDS,
+                 retry_seconds=RETRY_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self._pending = {}
+        # The first seen time and stream position of the actions in flight
+        self._in_flight = {}
+        # The failed attempts of the actions being retried
+        self._attempts = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, file_id, action, stream_position=None, now=None):
+        """
+        Records an action for a file, replacing any earlier pending one.
+
+        Parameters:
+        - file_id: The ID of the file.
+        - action: SYNC or DELETE.
+        - stream_position: The stream position the event was read from.
+        - now: The current monotonic time (default is time.monotonic()).
+        """
+        now = time.monotonic() if now is None else now
+        _, first_seen, _, first_position = self._pending.get(file_id, (None, now, None, stream_position))
+        due = min(now + self.debounce_seconds, first_seen + self.max_delay_seconds)
+        self._pending[file_id] = (action, first_seen, due, first_position)
+
+    def pop_due(self, now=None):
+        """
+        Removes and returns the actions that are due.
+
+        Parameters:
+        - now: The current monotonic time (default is time.monotonic()).
+
+        Returns:
+        - A list of (file_id, action) tuples.
+        """
+        now = time.monotonic() if now is None else now
+        due = [(file_id, action) for file_id, (action, _, due_at, _) in self._pending.items() if due_at <= now]
+        for file_id, _ in due:
+            _, first_seen, _, first_position = self._pending.pop(file_id)
+            self._in_flight[file_id] = (first_seen, first_position)
+        return due
+
+    def done(self, file_id):
+        """
+        Records that the action of a file was applied.
+
+        Returns:
+        - The number of failed attempts before it succeeded.
+        """
+        self._in_flight.pop(file_id, None)
+        return self._attempts.pop(file_id, 0)
+
+    def retry(self, file_id, action, now=None):
+        """
+        Records that the action of a file failed, scheduling it again after a backoff.
+
+        Parameters:
+        - file_id: The ID of the file.
+        - action: SYNC or DELETE.
+        - now: The current monotonic time (default is time.monotonic()).
+
+        Returns:
+        - True if the action is retried, False if it ran out of attempts and was given up.
+        """
+        now = time.monotonic() if now is None else now
+        first_seen, first_position = self._in_flight.pop(file_id)
+        attempts = self._attempts.get(file_id, 0) + 1
+        if attempts >= self.max_attempts:
+            self._attempts.pop(file_id, None)
+            return False
+        self._attempts[file_id] = attempts
+        backoff = min(self.retry_seconds * 2 ** (attempts - 1), self.max_delay_seconds)
+        # An event arriving in the meantime replaces the action, keeping the first position
+        self._pending[file_id] = (action, first_seen, now + backoff, first_position)
+        return True
+
+    def seconds_until_due(self, now=None):
+        """
+        Returns the time until the next action is due, or None if nothing is pending.
+        """
+        if not self._pending:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, min(due_at for _, _, due_at, _ in self._pending.values()) - now)
+
+    def safe_position(self, stream_position):
+        """
+        Returns the stream position it is safe to persist.
+
+        Parameters:
+        - stream_position: The position read up to.
+
+        Returns:
+        - stream_position if nothing is pending or in flight, otherwise the position the
+          oldest pending or in flight event was read from, so it is replayed after a restart.
+        """
+        unapplied = [(first_seen, position) for _, first_seen, _, position in self._pending.values()]
+        unapplied += self._in_flight.values()
+        if not unapplied:
+            return stream_position
+        return min(unapplied, key=lambda event: event[0])[1]
+
+
+def event_action(event):
+    """
+    Maps a Box event to the action to take on its file.
+
+    Parameters:
+    - event: The event dictionary returned by the events API.
+
+    Returns:
+    - A (file_id, action) tuple, or None if the event is not about a file or not relevant.
+    """
+    source = event.get("source") or {}
+    if source.get("type") != "file":
+        return None
+    event_type = event.get("event_type")
+    if event_type in SYNC_EVENTS:
+        return source["id"], SYNC
+    if event_type in DELETE_EVENTS:
+        return source["id"], DELETE
+    return None
+
+
+def is_in_folder(file, folder_id, recursive=True):
+    """
+    Checks if a file lives in the folder, or in its subfolders when recursive.
+
+    Parameters:
+    - file: The Box file object, fetched with its parent and path_collection.
+    - folder_id: The ID of the synced folder.
+    - recursive: Whether files of subfolders count (default is True).
+    """
+    if file.parent is not None and file.parent["id"] == folder_id:
+        return True
+    if not recursive:
+        return False
+    return any(entry["id"] == folder_id for entry in file.path_collection["entries"])
+
+
+def apply_action(client, index, manifest, box_user_id, folder_id, file_id, action, recursive=True):
+    """
+    Re-indexes or deletes a single file.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - index: The Pinecone index to store the data in.
+    - manifest: The Manifest of indexed files.
+    - box_user_id: The namespace identifier for the Box user.
+    - folder_id: The ID of the synced folder.
+    - file_id: The ID of the file the events were about.
+    - action: SYNC or DELETE.
+    - recursive: Whether files of subfolders are synced (default is True).
+
+    Returns:
+    - True if the records of the file changed in the index.
+    """
+    if action == SYNC:
+        try:
+            file = client.file(file_id).get(fields=LISTING_FIELDS + ["parent", "path_collection", "item_status"])
+        except BoxAPIException as e:
+            if e.status != 404:
+                raise
+            file = None
+        if (
+            file is not None
+            and file.item_status == "active"
+            and is_supported_file_type(file.name)
+            and is_in_folder(file, folder_id, recursive)
+        ):
+            if index_file(client, file, index, box_user_id, manifest):
+                logging.info(f"Re-indexed file: {file.name}")
+                return True
+            return False
+
+    # Trashed, deleted or moved out of the folder
+    if action == DELETE or manifest.get(box_user_id, file_id) is not None:
+        if remove_file(index, manifest, box_user_id, file_id):
+            logging.info(f"Removed file ID {file_id} from the index")
+            return True
+    return False
+
+
+def run_event_sync(client, stream, cursor, index, manifest, box_user_id, folder_id,
+                   coalescer=None, recursive=True, should_stop=None):
+    """
+    Follows the events stream and applies the changes until should_stop returns True.
+
+    The saved cursor never moves past the oldest pending event, so a restart
+    replays the events of files that were not applied yet. Applying an event
+    twice is harmless, unchanged files are skipped through the manifest.
+    Failed actions are retried with a backoff and added to the dead-letter
+    list of the manifest, which they leave once they succeed. The cached
+    queries of the namespace are invalidated once per batch of due actions.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - stream: The EventStream to read.
+    - cursor: The EventCursor persisting the stream position.
+    - index: The Pinecone index to store the data in.
+    - manifest: The Manifest of indexed files.
+    - box_user_id: The namespace identifier for the Box user.
+    - folder_id: The ID of the synced folder.
+    - coalescer: Optional EventCoalescer (default uses the configured debounce).
+    - recursive: Whether files of subfolders are synced (default is True).
+    - should_stop: Optional callable returning True to end the loop.
+    """
+    if coalescer is None:
+        coalescer = EventCoalescer()
+    should_stop = should_stop or (lambda: False)
+
+    stream_position = cursor.load()
+    if stream_position is None:
+        stream_position = stream.current_position()
+        cursor.save(stream_position)
+        logging.info(f"Starting event sync from the current position {stream_position}")
+    else:
+        logging.info(f"Resuming event sync from position {stream_position}")
+
+    while not should_stop():
+        read_position = stream_position
+        events, stream_position = stream.get_events(read_position)
+        for event in events:
+            action = event_action(event)
+            if action is not None:
+                logging.debug(f"Event {event.get('event_type')} for file ID {action[0]}")
+                coalescer.add(*action, stream_position=read_position)
+
+        changed = False
+        for file_id, action in coalescer.pop_due():
+            try:
+                changed |= apply_action(client, index, manifest, box_user_id, folder_id, file_id, action, recursive)
+            except Exception as e:
+                logging.error(f"Failed to {action} file ID {file_id}: {e}")
+                logging.error(traceback.format_exc())
+                record_failure(manifest, None, box_user_id, client.file(file_id), "events", e)
+                if not coalescer.retry(file_id, action):
+                    logging.error(f"Giving up on file ID {file_id} after {coalescer.max_attempts} attempts, "
+                                  f"it is retried from the dead-letter list by the next indexing run")
+                continue
+            if coalescer.done(file_id):
+                manifest.clear_failure(box_user_id, file_id)
+        if changed:
+            invalidate_cached_queries([box_user_id])
+
+        cursor.save(coalescer.safe_position(stream_position))
+
+        if events:
+            continue
+        wait = coalescer.seconds_until_due()
+        if wait is None:
+            stream.wait_for_change(stream_position)
+        else:
+            time.sleep(min(wait, 1.0))
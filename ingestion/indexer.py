@@ -0,0 +1,883 @@
+"""
+Indexes Box files into Pinecone through the staged ingestion pipeline.
+---
+list -> fetch representation -> clean/chunk -> upsert
+Fetching and upserting are bound by network I/O, so those stages get most
+of the worker threads. Worker counts and queue sizes come from the config.
+
+With INGEST_STREAM_TEXT enabled, the fetch stage only opens the download
+and the clean/chunk stage wraps it in lazy generators: the text is then
+downloaded, cleaned and chunked while the upsert stage consumes the
+records, so memory is bounded by the chunk size, not the document size.
+With INGEST_CPU_OFFLOAD enabled instead, whole texts are fetched and the
+large ones are cleaned and chunked in worker processes (cpu_offload.py),
+so the CPU bound work of several documents runs on several cores.
+
+Chunks are content-defined and named by their content hash, so when an
+edited file is indexed again only the chunks whose text changed are sent
+to Pinecone: the others already exist under the same ID, listed in the
+manifest entry of the file, and only their fields of the previous version
+(position, modification time, size) are updated. The chunks that
+disappeared are deleted, along with any record left under the ID prefix
+of the file by an earlier attempt that failed midway; a failed attempt
+also deletes the records it wrote right away.
+
+Files are only handed to the fetch stage once Box generated their text
+representation: the RepresentationScheduler requests it for all listed
+files up front and polls the pending ones in the background, so a slow
+conversion never holds up the files that are already ready.
+
+The cleaned text of every file is kept in a local TextCache
+(text_cache.py), keyed by the file ID and SHA-1: files already cached are
+handed to the fetch stage without any representation request and their
+text is read from disk, so re-indexing an unchanged folder, e.g. with a
+new chunk size, costs no Box download.
+
+An optional Journal records the progress of a run batch by batch, so an
+interrupted run can be resumed without writing the same records again,
+and files that fail are added to the dead-letter list of the manifest.
+"""
+import itertools
+import logging
+import threading
+import time
+import traceback
+import config
+from boxsdk.exception import BoxAPIException
+from box_integration.box_integration import LISTING_FIELDS, fetch_file_text, open_file_text_stream, clean_up_text
+from box_integration.representations import REPRESENTATION_WORKERS, RepresentationScheduler
+from box_integration.text_cleaning import IncrementalCleaner
+from pinecone_integration.pinecone_client import (
+    build_chunk_records,
+    iter_chunk_records,
+    records_from_chunks,
+    upsert_chunk_records,
+    update_chunk_metadata,
+    delete_chunk_records,
+    list_file_record_ids,
+)
+from pinecone_integration.batch_upserter import BatchUpserter, UpsertTicket
+from pinecone_integration.query_cache import QUERY_CACHE_ENABLED, QUERY_CACHE_INVALIDATE_SECONDS, invalidate_namespace
+from ingestion import cpu_offload
+from ingestion.pipeline import Stage, interleave, run_pipeline
+from ingestion.text_cache import get_text_cache
+from common import metrics
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+FETCH_WORKERS = getattr(config, "INGEST_FETCH_WORKERS", 8)
+PROCESS_WORKERS = getattr(config, "INGEST_PROCESS_WORKERS", 2)
+UPSERT_WORKERS = getattr(config, "INGEST_UPSERT_WORKERS", 4)
+QUEUE_SIZE = getattr(config, "INGEST_QUEUE_SIZE", 32)
+STREAM_TEXT = getattr(config, "INGEST_STREAM_TEXT", True)
+MANIFEST_PATH = getattr(config, "MANIFEST_PATH", ".manifest.sqlite")
+
+
+class FileJob:
+    """
+    Carries a single Box file and its intermediate results through the pipeline.
+
+    Parameters:
+    - client: The Box client used to fetch the file.
+    - file: The Box file object.
+    - box_user_id: The namespace identifier for the Box user.
+    - download_url: The text representation download URL, if already known (default is to look it up).
+    - listing: The FolderListing the file comes from, if any (default is None).
+    """
+
+    def __init__(self, client, file, box_user_id, download_url=None, listing=None):
+        self.client = client
+        self.file = file
+        self.box_user_id = box_user_id
+        self.download_url = download_url
+        self.listing = listing
+        self.text = None
+        self.text_stream = None
+        # The text or text stream is cleaned already, read from the text cache
+        self.text_cached = False
+        self.records = None
+
+    def __str__(self):
+        return self.file.name
+
+
+def file_metadata(file, box_user_id):
+    """
+    Extracts the metadata stored alongside every chunk of a file.
+
+    Parameters:
+    - file: The Box file object.
+    - box_user_id: The namespace identifier for the Box user.
+
+    Returns:
+    - A dictionary of metadata.
+    """
+    return {
+        "file_name": file.name,
+        "file_id": file.id,
+        "created_at": file.created_at,
+        "modified_at": file.modified_at,
+        "size": file.size,
+        "box_user_id": box_user_id
+    }
+
+
+def metadata_text(metadata):
+    """Renders the metadata appended to the text content for vectorization."""
+    return " ".join(f"{key}: {value}" for key, value in metadata.items())
+
+
+def fetch_stage(job):
+    """Reads the cleaned text of the file from the text cache, or else downloads its extracted text representation."""
+    logging.info(f"Processing file: {job.file.name}")
+    # Read back in finish_file, only while profiling
+    metrics.start_memory_peak()
+    cache = get_text_cache()
+    if cache is not None:
+        with metrics.timer("text_cache_read_seconds"):
+            job.text = cache.get(job.file)
+        if job.text is not None:
+            job.text_cached = True
+            return job
+    with metrics.timer("box_representation_fetch_seconds"):
+        job.text = fetch_file_text(job.client, job.file, download_url=job.download_url)
+    return job
+
+
+def stream_fetch_stage(job):
+    """Opens the cached text of the file, or else a streamed download of its extracted text representation."""
+    logging.info(f"Processing file: {job.file.name}")
+    # Read back in finish_file, only while profiling
+    metrics.start_memory_peak()
+    cache = get_text_cache()
+    if cache is not None:
+        job.text_stream = cache.open_text(job.file)
+        if job.text_stream is not None:
+            job.text_cached = True
+            return job
+    with metrics.timer("box_representation_fetch_seconds"):
+        job.text_stream = open_file_text_stream(job.client, job.file, download_url=job.download_url)
+    return job
+
+
+def stream_process_stage(job):
+    """Chains the incremental cleaner and chunker on the streamed text, nothing is read yet."""
+    metadata = file_metadata(job.file, job.box_user_id)
+    cache = get_text_cache()
+    # Each lazy step is timed on its own, when the upsert stage consumes the records
+    if job.text_cached:
+        cleaned_pieces = metrics.timed_iter("text_cache_read_seconds", job.text_stream)
+    else:
+        text_stream = metrics.timed_iter("box_download_seconds", job.text_stream)
+        cleaned_pieces = metrics.timed_iter("clean_seconds", IncrementalCleaner().clean(text_stream))
+        if cache is not None:
+            # Stored once the whole text went through
+            cleaned_pieces = metrics.timed_iter("text_cache_write_seconds", cache.caching(job.file, cleaned_pieces))
+    # Combine text content with metadata for vectorization
+    text_pieces = itertools.chain(cleaned_pieces, [" " + metadata_text(metadata)])
+    job.records = metrics.timed_iter(
+        "chunk_seconds", iter_chunk_records(job.file.id, text_pieces, metadata, job.box_user_id)
+    )
+    job.text_stream = None
+    return job
+
+
+def process_stage(job):
+    """Cleans the text, unless read from the text cache, combines it with the metadata and chunks it into records."""
+    metadata = file_metadata(job.file, job.box_user_id)
+    cache = get_text_cache()
+    if cpu_offload.should_offload(job.text):
+        suffix = metadata_text(metadata)
+        with metrics.timer("cpu_offload_seconds"):
+            combined_text, text_chunks = cpu_offload.clean_and_chunk(job.text, suffix, clean=not job.text_cached)
+        if cache is not None and not job.text_cached:
+            with metrics.timer("text_cache_write_seconds"):
+                cache.put(job.file, combined_text[:len(combined_text) - len(suffix) - 1])
+        job.records = records_from_chunks(job.file.id, text_chunks, metadata, job.box_user_id)
+        job.text = None
+        return job
+
+    if job.text_cached:
+        text_content = job.text
+    else:
+        with metrics.timer("clean_seconds"):
+            text_content = clean_up_text(job.text)
+        if cache is not None:
+            with metrics.timer("text_cache_write_seconds"):
+                cache.put(job.file, text_content)
+
+    # Combine text content with metadata for vectorization
+    combined_text = text_content + " " + metadata_text(metadata)
+    logging.debug(f"Text: {combined_text}")
+    with metrics.timer("chunk_seconds"):
+        job.records = build_chunk_records(job.file.id, {"text": combined_text, **metadata}, job.box_user_id)
+    job.text = None
+    return job
+
+
+def known_chunk_ids(manifest, box_user_id, file):
+    """
+    Returns the IDs of the chunks already stored for the previous version of a file.
+
+    Parameters:
+    - manifest: The Manifest of indexed files, or None.
+    - box_user_id: The namespace identifier for the Box user.
+    - file: The Box file object.
+
+    Returns:
+    - A set of record IDs, empty if the file was never indexed.
+    """
+    entry = manifest.get(box_user_id, file.id) if manifest is not None else None
+    return set(entry["chunk_ids"]) if entry else set()
+
+
+def new_chunk_records(records, known_ids, chunk_ids, reused=None):
+    """
+    Yields the records that are not stored yet, collecting the IDs of all records.
+
+    A record whose ID is known has the same content hash, and so the same
+    text and embedding, as a stored chunk: it is not written again.
+
+    Parameters:
+    - records: An iterable of records.
+    - known_ids: The IDs of the records already stored.
+    - chunk_ids: A list the ID of every record is appended to, written or not.
+    - reused: Optional dictionary the chunk_id of the records not written is added to, by ID.
+
+    Returns:
+    - A generator of the records to write.
+    """
+    unchanged = 0
+    for record in records:
+        chunk_ids.append(record["_id"])
+        if record["_id"] in known_ids:
+            unchanged += 1
+            if reused is not None:
+                reused[record["_id"]] = record["chunk_id"]
+            continue
+        yield record
+    metrics.increment("chunks", len(chunk_ids) - unchanged, outcome="new")
+    metrics.increment("chunks", unchanged, outcome="unchanged")
+    if unchanged:
+        logging.info(f"Reusing {unchanged} of {len(chunk_ids)} unchanged chunks")
+
+
+def record_failure(manifest, journal, box_user_id, file, stage, error):
+    """
+    Adds a failed file to the dead-letter list of the manifest and to the journal, when there are.
+
+    Parameters:
+    - manifest: The Manifest of indexed files, or None.
+    - journal: The Journal of the run, or None.
+    - box_user_id: The namespace identifier for the Box user.
+    - file: The Box file object.
+    - stage: The name of the stage that failed.
+    - error: The error.
+    """
+    try:
+        if manifest is not None:
+            manifest.record_failure(box_user_id, file, stage, error)
+        if journal is not None:
+            journal.file_failed(box_user_id, file, stage, error)
+    except Exception as e:
+        logging.error(f"Failed to record the failure of file {file.name}: {e}")
+
+
+def text_stages():
+    """
+    Returns the fetch and process stage functions for the configuration.
+
+    Returns:
+    - A tuple of the fetch stage, the process stage and the number of process stage workers.
+    """
+    if cpu_offload.CPU_OFFLOAD:
+        # A process stage thread waits for each document in a worker process
+        return fetch_stage, process_stage, max(PROCESS_WORKERS, cpu_offload.CPU_PROCESSES)
+    if STREAM_TEXT:
+        return stream_fetch_stage, stream_process_stage, PROCESS_WORKERS
+    return fetch_stage, process_stage, PROCESS_WORKERS
+
+
+def refresh_chunk_positions(index, manifest, box_user_id, file, reused):
+    """
+    Sets the new position of the reused chunks that moved, e.g. after text was inserted before them.
+
+    The other fields of a reused chunk, like modified_at and size, stay those
+    of the version that wrote it, the manifest has the current version.
+    A failure is logged: the context builder checks the text of consecutive
+    chunks before merging them, so a stale position only prevents a merge.
+
+    Parameters:
+    - index: The Pinecone index the chunks are stored in.
+    - manifest: The Manifest of indexed files, or None.
+    - box_user_id: The namespace identifier for the Box user.
+    - file: The Box file object.
+    - reused: The chunk_id of the records not written, by ID, see new_chunk_records.
+    """
+    entry = manifest.get(box_user_id, file.id) if manifest is not None and reused else None
+    if not entry:
+        return
+    # The chunk_id of a record is its position in the IDs of the file
+    positions = {record_id: position for position, record_id in enumerate(entry["chunk_ids"])}
+    moved = {
+        record_id: {"chunk_id": chunk_id} for record_id, chunk_id in reused.items()
+        if record_id in positions and positions[record_id] != chunk_id
+    }
+    if not moved:
+        return
+    try:
+        logging.info(f"Updating the position of {len(moved)} reused chunks for file: {file.name}")
+        update_chunk_metadata(index, moved, box_user_id)
+    except Exception as e:
+        logging.error(f"Failed to update the position of the reused chunks for file {file.name}: {e}")
+
+
+def finish_file(index, manifest, file, box_user_id, chunk_ids):
+    """
+    Records a fully written file in the manifest, deleting the chunks its previous version had in excess.
+
+    A file without a manifest entry, or which failed before, has its records
+    listed by ID prefix, so the records left over by a failed attempt, or
+    written before the manifest existed, are deleted too.
+    The cached queries of the namespace are left to the caller to invalidate, once for all its files.
+
+    Parameters:
+    - index: The Pinecone index the chunks were written to.
+    - manifest: The Manifest of indexed files.
+    - file: The Box file object.
+    - box_user_id: The namespace identifier for the Box user.
+    - chunk_ids: The IDs of the records of the file, written or reused.
+    """
+    previous = manifest.get(box_user_id, file.id)
+    stored_ids = set(previous["chunk_ids"]) if previous else set()
+    if previous is None or manifest.failure(box_user_id, file.id) is not None:
+        stored_ids |= set(list_file_record_ids(index, file.id, box_user_id))
+    stale_ids = stored_ids - set(chunk_ids)
+    if stale_ids:
+        logging.info(f"Deleting {len(stale_ids)} stale chunks for file: {file.name}")
+        delete_chunk_records(index, sorted(stale_ids), box_user_id)
+    manifest.record(box_user_id, file, chunk_ids)
+    metrics.record_memory_peak(file.name)
+
+
+def invalidate_cached_queries(box_user_ids):
+    """
+    Invalidates the cached queries of the namespaces that changed, once each, when the query cache is enabled.
+
+    A failure is logged, the cached queries are then answered from the previous content until the next change.
+
+    Parameters:
+    - box_user_ids: The namespace identifiers of the Box users whose files changed.
+    """
+    if not QUERY_CACHE_ENABLED:
+        return
+    for box_user_id in sorted(set(box_user_ids)):
+        try:
+            invalidate_namespace(box_user_id)
+        except Exception as e:
+            logging.error(f"Failed to invalidate the cached queries of namespace {box_user_id}: {e}")
+
+
+def discard_written_records(index, manifest, journal, box_user_id, file, written_ids):
+    """
+    Deletes the records a failed attempt wrote for a file, keeping those its indexed version lists.
+
+    If the deletion fails too, the records are deleted once the file is indexed again.
+
+    Parameters:
+    - index: The Pinecone index the records were written to.
+    - manifest: The Manifest of indexed files, or None.
+    - journal: The Journal of the run, or None. The records it lists as written are deleted too.
+    - box_user_id: The namespace identifier for the Box user.
+    - file: The Box file object.
+    - written_ids: The IDs of the records written by the attempt.
+    """
+    orphaned_ids = set(written_ids)
+    if journal is not None:
+        orphaned_ids |= journal.written_ids(box_user_id, file)
+    orphaned_ids -= known_chunk_ids(manifest, box_user_id, file)
+    if not orphaned_ids:
+        return
+    try:
+        logging.info(f"Deleting {len(orphaned_ids)} chunks written for failed file: {file.name}")
+        delete_chunk_records(index, sorted(orphaned_ids), box_user_id)
+        if journal is not None:
+            journal.records_discarded(box_user_id, file)
+    except Exception as e:
+        logging.error(f"Failed to delete the chunks written for failed file {file.name}: {e}")
+
+
+def make_upsert_stage(index, manifest=None, reuse_chunks=True):
+    """
+    Returns an upsert stage function writing each file synchronously.
+
+    Parameters:
+    - index: The Pinecone index to store the data in.
+    - manifest: Optional Manifest updated once a file is fully written.
+    - reuse_chunks: Skip the chunks the manifest lists for the previous version of the file (default is True).
+    """
+    def upsert_stage(job):
+        logging.info(f"Storing metadata in Pinecone for file: {job.file.name}")
+        known_ids = known_chunk_ids(manifest, job.box_user_id, job.file) if reuse_chunks else set()
+        chunk_ids = []
+        reused = {}
+        try:
+            upsert_chunk_records(index, new_chunk_records(job.records, known_ids, chunk_ids, reused), job.box_user_id)
+        except Exception:
+            # Any batch of the records read so far may be written
+            discard_written_records(index, manifest, None, job.box_user_id, job.file, chunk_ids)
+            raise
+        refresh_chunk_positions(index, manifest, job.box_user_id, job.file, reused)
+        if manifest is not None:
+            finish_file(index, manifest, job.file, job.box_user_id, chunk_ids)
+        logging.info(f"Processed and stored metadata for file: {job.file.name}")
+        job.records = None
+        return job
+    return upsert_stage
+
+
+def make_batched_upsert_stage(upserter, index, manifest=None, results=None, reuse_chunks=True, journal=None,
+                              on_file_written=None):
+    """
+    Returns an upsert stage function handing the records of each file to a shared BatchUpserter.
+
+    The stage returns as soon as the records are batched. A file is finished,
+    and counted in results, once its UpsertTicket completes.
+
+    Parameters:
+    - upserter: The BatchUpserter shared by all files.
+    - index: The Pinecone index the upserter writes to.
+    - manifest: Optional Manifest updated once a file is fully written.
+    - results: Optional dictionary counting the "completed" and "failed" files.
+    - reuse_chunks: Skip the chunks the manifest lists for the previous version of the file (default is True).
+    - journal: Optional Journal of the run, the records it lists as written are skipped too.
+    - on_file_written: Optional callback(job, outcome) called once a file is finished,
+      outcome being "completed" or "failed". Tickets carry their FileJob as source.
+    """
+    lock = threading.Lock()
+    results = {"completed": 0, "failed": 0} if results is None else results
+
+    def file_written(job, ticket, chunk_ids):
+        file = job.file
+        try:
+            # Raises if a batch failed, the IDs it returns are only those of the new chunks
+            ticket.result()
+            if manifest is not None:
+                finish_file(index, manifest, file, ticket.namespace, chunk_ids)
+            if journal is not None:
+                journal.file_done(ticket.namespace, file)
+            logging.info(f"Processed and stored metadata for file: {file.name}")
+            outcome = "completed"
+        except Exception as e:
+            logging.error(f"Failed to process file {file.name}: {e}")
+            discard_written_records(index, manifest, journal, ticket.namespace, file, ticket.written_ids)
+            record_failure(manifest, journal, ticket.namespace, file, "upsert", e)
+            outcome = "failed"
+        with lock:
+            results[outcome] += 1
+        if on_file_written is not None:
+            on_file_written(job, outcome)
+
+    def upsert_stage(job):
+        logging.info(f"Storing metadata in Pinecone for file: {job.file.name}")
+        file = job.file
+        known_ids = known_chunk_ids(manifest, job.box_user_id, file) if reuse_chunks else set()
+        if journal is not None:
+            known_ids |= journal.written_ids(job.box_user_id, file)
+        chunk_ids = []
+        reused = {}
+        ticket = UpsertTicket(job.box_user_id, source=job)
+        try:
+            # The records are all consumed before add_records returns, chunk_ids is then complete
+            upserter.add_records(
+                job.box_user_id, new_chunk_records(job.records, known_ids, chunk_ids, reused), ticket=ticket
+            )
+        except Exception:
+            # The records batched before the error are still flushed, they are deleted once written
+            ticket.add_done_callback(lambda ticket: discard_written_records(
+                index, manifest, journal, ticket.namespace, file, ticket.written_ids
+            ))
+            raise
+        # On the stage thread, the done callbacks run on the flush threads of the upserter
+        refresh_chunk_positions(index, manifest, job.box_user_id, file, reused)
+        ticket.add_done_callback(lambda ticket: file_written(job, ticket, chunk_ids))
+        job.records = None
+        return job
+    return upsert_stage
+
+
+def delete_removed_files(index, manifest, box_user_id, listed_file_ids):
+    """
+    Deletes the chunks of files that are in the manifest but no longer in Box.
+
+    Parameters:
+    - index: The Pinecone index to delete the records from.
+    - manifest: The Manifest of indexed files.
+    - box_user_id: The namespace identifier for the Box user.
+    - listed_file_ids: The IDs of all files returned by the folder listing.
+
+    Returns:
+    - The number of files removed from the index.
+    """
+    removed_ids = manifest.file_ids(box_user_id) - set(listed_file_ids)
+    for file_id in sorted(removed_ids):
+        try:
+            logging.info(f"Deleting chunks of removed file ID: {file_id}")
+            remove_file(index, manifest, box_user_id, file_id)
+        except Exception as e:
+            logging.error(f"Failed to delete chunks of removed file ID {file_id}: {e}")
+    return len(removed_ids)
+
+
+def remove_file(index, manifest, box_user_id, file_id):
+    """
+    Deletes all chunks of a single file and forgets it in the manifest.
+
+    The records are also listed by ID prefix, so those left over by a failed attempt are deleted too.
+    The cached queries of the namespace are left to the caller to invalidate.
+
+    Parameters:
+    - index: The Pinecone index to delete the records from.
+    - manifest: The Manifest of indexed files.
+    - box_user_id: The namespace identifier for the Box user.
+    - file_id: The ID of the file to remove.
+
+    Returns:
+    - The number of chunks deleted.
+    """
+    entry = manifest.get(box_user_id, file_id)
+    chunk_ids = set(entry["chunk_ids"]) if entry is not None else set()
+    chunk_ids |= set(list_file_record_ids(index, file_id, box_user_id))
+    if chunk_ids:
+        logging.info(f"Deleting {len(chunk_ids)} chunks of file ID: {file_id}")
+        delete_chunk_records(index, sorted(chunk_ids), box_user_id)
+    manifest.remove(box_user_id, file_id)
+    return len(chunk_ids)
+
+
+def index_file(client, file, index, box_user_id, manifest):
+    """
+    Indexes a single file synchronously, running the pipeline stages in order.
+
+    Waits for Box to generate the text representation of the file first.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - file: The Box file object.
+    - index: The Pinecone index to store the data in.
+    - box_user_id: The namespace identifier for the Box user.
+    - manifest: The Manifest of indexed files.
+
+    Returns:
+    - True if the file was indexed, False if it was unchanged or has no text representation.
+    """
+    if manifest.is_unchanged(box_user_id, file):
+        logging.debug(f"Skipping unchanged file: {file.name}")
+        return False
+    cache = get_text_cache()
+    scheduler = RepresentationScheduler(client, workers=1, has_text=cache.contains if cache is not None else None)
+    ready = list(scheduler.ready_files([file]))
+    if not ready:
+        return False
+    job = FileJob(client, file, box_user_id, download_url=ready[0][1])
+    fetch, process, _ = text_stages()
+    make_upsert_stage(index, manifest)(process(fetch(job)))
+    return True
+
+
+def log_failed_file(stage, job, error):
+    """Logs a file that failed in any stage, the remaining files keep flowing."""
+    logging.error(f"Failed to process file {job.file.name} in stage {stage.name}: {error}")
+    logging.error("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+
+
+def load_failed_files(client, manifest, box_user_id):
+    """
+    Returns the files of the dead-letter list that still need indexing.
+
+    Files deleted from Box, or already indexed at their current version,
+    are removed from the list.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - manifest: The Manifest holding the dead-letter list.
+    - box_user_id: The namespace identifier for the Box user.
+
+    Returns:
+    - A list of Box file objects carrying the LISTING_FIELDS.
+    """
+    files = []
+    for failure in manifest.failures(box_user_id):
+        try:
+            file = client.file(failure["file_id"]).get(fields=LISTING_FIELDS)
+        except BoxAPIException as e:
+            if e.status != 404:
+                raise
+            logging.info(f"Failed file {failure['name']} ({failure['file_id']}) no longer exists")
+            manifest.clear_failure(box_user_id, failure["file_id"])
+            continue
+        if manifest.is_unchanged(box_user_id, file):
+            manifest.clear_failure(box_user_id, file.id)
+            continue
+        logging.info(f"Retrying file {file.name}, failed {failure['attempts']} times in stage {failure['stage']}: "
+                     f"{failure['error']}")
+        files.append(file)
+    return files
+
+
+class FolderListing:
+    """
+    The files of one folder to index into one namespace, with the counts of their outcomes.
+
+    Listed files that the manifest or the journal report as done are
+    skipped, the others are handed out as FileJobs once their text
+    representation is ready.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - files: An iterable of Box file objects.
+    - box_user_id: The namespace identifier for the Box user.
+    - manifest: Optional Manifest used to skip unchanged files.
+    - full_resync: Do not skip the files the manifest reports as unchanged (default is False).
+    - journal: Optional Journal of the run, the files it lists as done are skipped.
+    - representation_workers: The number of concurrent representation requests (default is REPRESENTATION_WORKERS).
+    - name: The name of the listing in reports (default is the namespace).
+    """
+
+    def __init__(self, client, files, box_user_id, manifest=None, full_resync=False, journal=None,
+                 representation_workers=REPRESENTATION_WORKERS, name=None):
+        self.client = client
+        self.files = files
+        self.box_user_id = box_user_id
+        self.manifest = manifest
+        self.full_resync = full_resync
+        self.journal = journal
+        self.name = name or box_user_id
+        cache = get_text_cache()
+        self.scheduler = RepresentationScheduler(client, workers=representation_workers,
+                                                 has_text=cache.contains if cache is not None else None)
+        self.listed_file_ids = set()
+        self.complete = False
+        self.counts = {"completed": 0, "failed": 0, "skipped": 0, "chunks": 0}
+        self.started = time.monotonic()
+        self.finished = None
+        # Optional callable, called once all the jobs of the listing left the pipeline
+        self.on_drained = None
+        self._lock = threading.Lock()
+        # Jobs handed out and not yet through the pipeline
+        self._in_pipeline = 0
+        self._exhausted = False
+
+    def count(self, outcome, value=1):
+        """Adds value to the count of an outcome."""
+        with self._lock:
+            self.counts[outcome] += value
+            self.finished = time.monotonic()
+
+    def changed_files(self):
+        """Yields the listed files that need indexing, the listing is complete once exhausted."""
+        for file in self.files:
+            self.listed_file_ids.add(file.id)
+            if (self.manifest is not None and not self.full_resync
+                    and self.manifest.is_unchanged(self.box_user_id, file)):
+                logging.debug(f"Skipping unchanged file: {file.name}")
+                self.count("skipped")
+                continue
+            if self.journal is not None:
+                if self.journal.is_done(self.box_user_id, file):
+                    logging.debug(f"Skipping file done before the run was interrupted: {file.name}")
+                    self.count("skipped")
+                    continue
+                self.journal.listed(self.box_user_id, file)
+            yield file
+        self.complete = True
+
+    def jobs(self):
+        """Yields a FileJob for every changed file, in the order their representations get ready."""
+        for file, download_url in self.scheduler.ready_files(self.changed_files()):
+            with self._lock:
+                self._in_pipeline += 1
+            yield FileJob(self.client, file, self.box_user_id, download_url=download_url, listing=self)
+        with self._lock:
+            self._exhausted = True
+            drained = not self._in_pipeline
+        if drained and self.on_drained is not None:
+            self.on_drained()
+
+    def job_done(self):
+        """Notes that a job left the pipeline, batched for upsert or failed."""
+        with self._lock:
+            self._in_pipeline -= 1
+            drained = self._exhausted and not self._in_pipeline
+        if drained and self.on_drained is not None:
+            self.on_drained()
+
+
+def run_listings(listings, index, manifest=None, full_resync=False, journal=None):
+    """
+    Runs the files of one or more folder listings through a single ingestion pipeline.
+
+    The stage workers, the upsert batches and the connections are shared by
+    all listings. Their files enter the pipeline in round-robin order, so a
+    folder with many files does not hold up the others. The outcome of
+    every file is counted in its listing. The cached queries of a namespace
+    are invalidated at most every QUERY_CACHE_INVALIDATE_SECONDS while its
+    files complete, and once at the end, also when the run fails.
+    An error of a listing is raised once the files listed before it are written.
+
+    Parameters:
+    - listings: The FolderListings to index.
+    - index: The Pinecone index to store the data in.
+    - manifest: Optional Manifest updated once a file is fully written.
+    - full_resync: Write all the chunks of every file again (default is False).
+    - journal: Optional started Journal recording the progress of the run.
+    """
+    fetch, process, process_workers = text_stages()
+
+    def on_batch_written(namespace, ticket, records):
+        ticket.source.listing.count("chunks", len(records))
+        if journal is not None:
+            journal.batch_written(namespace, ticket.source.file, records)
+
+    if journal is not None:
+        fetch_text = fetch
+
+        def fetch(job):
+            job = fetch_text(job)
+            journal.fetched(job.box_user_id, job.file)
+            return job
+
+    def on_error(stage, job, error):
+        log_failed_file(stage, job, error)
+        record_failure(manifest, journal, job.box_user_id, job.file, stage.name, error)
+        job.listing.count("failed")
+        job.listing.job_done()
+
+    # The namespaces with files completed since their last invalidation, and when that was
+    changed_namespaces = set()
+    invalidated_at = {}
+    run_started = time.monotonic()
+    invalidation_lock = threading.Lock()
+
+    def on_file_written(job, outcome):
+        job.listing.count(outcome)
+        if outcome != "completed":
+            return
+        namespace = job.box_user_id
+        with invalidation_lock:
+            now = time.monotonic()
+            due = now - invalidated_at.get(namespace, run_started) >= QUERY_CACHE_INVALIDATE_SECONDS
+            if due:
+                invalidated_at[namespace] = now
+                changed_namespaces.discard(namespace)
+            else:
+                changed_namespaces.add(namespace)
+        if due:
+            invalidate_cached_queries([namespace])
+
+    upserter = BatchUpserter(index, on_batch_written=on_batch_written)
+    batch_records = make_batched_upsert_stage(upserter, index, manifest, reuse_chunks=not full_resync,
+                                              journal=journal, on_file_written=on_file_written)
+
+    def upsert(job):
+        job = batch_records(job)
+        job.listing.job_done()
+        return job
+
+    for listing in listings:
+        # The last files of a listing do not wait for the other listings to fill the batches
+        listing.on_drained = lambda namespace=listing.box_user_id: upserter.flush(namespace)
+    stages = [
+        Stage("fetch", fetch, FETCH_WORKERS),
+        Stage("process", process, process_workers),
+        Stage("upsert", upsert, UPSERT_WORKERS),
+    ]
+    jobs = listings[0].jobs() if len(listings) == 1 else interleave([listing.jobs() for listing in listings])
+    try:
+        # Raises if a listing failed, once the files listed before are processed
+        run_pipeline(jobs, stages, queue_size=QUEUE_SIZE, on_error=on_error)
+    finally:
+        try:
+            # Files of the last partial batches complete here
+            upserter.close()
+        finally:
+            # Once per namespace rather than per file, queries may be answered differently now
+            invalidate_cached_queries(changed_namespaces)
+
+    for listing in listings:
+        # Representations that timed out or could not be requested may be available on a retry
+        for reason in ("timeout", "exception"):
+            for file in listing.scheduler.failed[reason]:
+                record_failure(manifest, journal, listing.box_user_id, file, "representation", reason)
+
+
+def listing_stats(listing, index, manifest=None, delete_removed=True):
+    """
+    Returns the statistics of an indexed folder listing, deleting the files removed from the folder first.
+
+    Parameters:
+    - listing: The FolderListing run through run_listings.
+    - index: The Pinecone index the files were indexed in.
+    - manifest: Optional Manifest used to delete the chunks of files removed from the folder.
+    - delete_removed: Delete the chunks of the manifest files missing from the listing (default is True).
+
+    Returns:
+    - A dictionary with the number of "completed", "failed", "skipped" and "removed" files,
+      "unavailable", the number of files without text representation by reason, "chunks",
+      the number of records written, and "seconds", the time until the last file finished.
+    """
+    stats = {outcome: listing.counts[outcome] for outcome in ("completed", "failed", "skipped")}
+    stats["removed"] = 0
+    stats["unavailable"] = {reason: len(failed) for reason, failed in listing.scheduler.failed.items()}
+
+    # Only a complete listing tells which files were removed from the folder
+    if manifest is not None and delete_removed and listing.complete:
+        stats["removed"] = delete_removed_files(index, manifest, listing.box_user_id, listing.listed_file_ids)
+        if stats["removed"]:
+            invalidate_cached_queries([listing.box_user_id])
+    elif manifest is not None and delete_removed:
+        logging.warning(f"Folder listing of {listing.name} did not complete, not deleting removed files")
+
+    for outcome in ("completed", "failed", "skipped", "removed"):
+        metrics.increment("indexed_files", stats[outcome], outcome=outcome)
+    stats["chunks"] = listing.counts["chunks"]
+    stats["seconds"] = round((listing.finished or listing.started) - listing.started, 3)
+    logging.info(f"{listing.name}: skipped {stats['skipped']} unchanged files, removed {stats['removed']} deleted files")
+    return stats
+
+
+def index_files(client, files, index, box_user_id, manifest=None, full_resync=False, journal=None,
+                delete_removed=True):
+    """
+    Runs the files through the ingestion pipeline.
+
+    Parameters:
+    - client: The Box client used to interact with the Box service.
+    - files: An iterable of Box file objects.
+    - index: The Pinecone index to store the data in.
+    - box_user_id: The namespace identifier for the Box user.
+    - manifest: Optional Manifest used to skip unchanged files and to delete the
+      chunks of files that were removed from the folder.
+    - full_resync: Re-index every file even if the manifest says it is unchanged,
+      writing all of its chunks again (default is False).
+    - journal: Optional started Journal recording the progress of the run. The files
+      it lists as done are skipped and the records it lists as written are not sent again.
+      The run is recorded as ended only once the listing and the pipeline completed without error,
+      otherwise it is left to resume.
+    - delete_removed: Delete the chunks of the manifest files missing from files, which must
+      then be the whole folder (default is True).
+
+    Returns:
+    - A dictionary with the number of "completed", "failed", "skipped" and "removed" files,
+      and "unavailable", the number of files without text representation by reason.
+    """
+    listing = FolderListing(client, files, box_user_id, manifest, full_resync, journal)
+    # Raises if the listing or the pipeline failed, before the run is recorded as ended
+    run_listings([listing], index, manifest, full_resync, journal)
+    stats = listing_stats(listing, index, manifest, delete_removed)
+    # A run whose listing stopped early can still be resumed
+    if journal is not None and listing.complete:
+        journal.end(stats)
+    return stats
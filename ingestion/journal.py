@@ -0,0 +1,224 @@
+"""
+Append-only journal of an ingestion run, used to resume it after a crash.
+---
+Every line of the journal is a JSON event:
+- "run": a run started, with its options; "resume": it was resumed.
+- "listed": a file was listed and handed to the pipeline.
+- "fetched": the text of a file was fetched (or its download opened).
+- "batch": records of a file were upserted, with their IDs and offsets,
+  the positions of the chunks in the file.
+- "done": all records of a file were written and the manifest updated.
+- "failed": a file failed, with the stage and the error.
+- "discarded": the records written for a failed file were deleted.
+- "end": the run completed.
+
+Events are buffered and the journal is flushed and fsync'd with every
+"batch", "done", "failed", "discarded" and "end" event: a crash loses at most the
+"listed" and "fetched" events written since the last upserted batch,
+which are informative only. A line torn by a crash is ignored on reading.
+
+A resumed run appends to the journal of the interrupted one: files done
+are skipped, and the records of the batches already upserted for the
+current version of a file are not sent again, their IDs being content
+hashes of the chunks.
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+import config
+from ingestion.manifest import file_fingerprint
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+INGEST_JOURNAL_PATH = getattr(config, "INGEST_JOURNAL_PATH", ".ingest_journal.jsonl")
+
+# Events after which the journal is fsync'd
+_DURABLE_EVENTS = {"run", "resume", "batch", "done", "failed", "discarded", "end"}
+
+
+def file_version(file):
+    """
+    Returns the version of a Box file the journal entries of the file refer to.
+
+    Parameters:
+    - file: The Box file object.
+
+    Returns:
+    - The file version ID, or else the SHA-1 or modification time of the file, as text.
+    """
+    fingerprint = file_fingerprint(file)
+    return str(fingerprint["version"] or fingerprint["sha1"] or fingerprint["modified_at"])
+
+
+def read_journal(path=INGEST_JOURNAL_PATH):
+    """
+    Reads the events of a journal, skipping the lines that cannot be parsed.
+
+    Parameters:
+    - path: The path of the journal (default is INGEST_JOURNAL_PATH).
+
+    Returns:
+    - A list of event dictionaries, empty if there is no journal.
+    """
+    events = []
+    try:
+        with open(path, "r", encoding="UTF-8") as file:
+            for number, line in enumerate(file, 1):
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    logging.warning(f"Ignoring unreadable line {number} of journal {path}")
+    except FileNotFoundError:
+        pass
+    return events
+
+
+class Journal:
+    """
+    Append-only record of the progress of an ingestion run. Safe to share between threads.
+
+    Parameters:
+    - path: The path of the journal (default is INGEST_JOURNAL_PATH).
+    """
+
+    def __init__(self, path=INGEST_JOURNAL_PATH):
+        self.path = path
+        self.options = {}
+        self._lock = threading.Lock()
+        self._file = None
+        # (namespace, file ID, version) of the files done in the current run
+        self._done = set()
+        # (namespace, file ID) -> (version, IDs of the records written) of the files in progress
+        self._written = {}
+
+    def start(self, resume=False, **options):
+        """
+        Opens the journal for a run.
+
+        Parameters:
+        - resume: Continue the last run of the journal if it did not complete (default is False).
+        - options: The options of a new run, e.g. the folder ID, stored in its "run" event.
+
+        Returns:
+        - True if an interrupted run is resumed, in which case options holds its options,
+          False if a new run started.
+        """
+        events = read_journal(self.path) if resume else []
+        starts = [position for position, event in enumerate(events) if event.get("event") == "run"]
+        if starts and events[-1].get("event") != "end":
+            for event in events[starts[-1]:]:
+                self._apply(event)
+            self._file = open(self.path, "a", encoding="UTF-8")
+            self._write({"event": "resume"})
+            logging.info(f"Resuming ingestion run: {len(self._done)} files done, "
+                         f"{len(self._written)} files partially written")
+            return True
+
+        if resume:
+            logging.info("No interrupted ingestion run to resume, starting a new one")
+        self.options = dict(options)
+        self._file = open(self.path, "w", encoding="UTF-8")
+        self._write({"event": "run", "options": self.options})
+        return False
+
+    def is_done(self, namespace, file):
+        """Returns True if the current version of the file was completed in this run."""
+        with self._lock:
+            return (namespace, file.id, file_version(file)) in self._done
+
+    def written_ids(self, namespace, file):
+        """Returns the IDs of the records already upserted in this run for the current version of the file."""
+        with self._lock:
+            version, ids = self._written.get((namespace, file.id), (None, ()))
+            return set(ids) if version == file_version(file) else set()
+
+    def listed(self, namespace, file):
+        """Records that a file is handed to the pipeline."""
+        self._write(self._file_event("listed", namespace, file, name=file.name))
+
+    def fetched(self, namespace, file):
+        """Records that the text of a file was fetched."""
+        self._write(self._file_event("fetched", namespace, file))
+
+    def batch_written(self, namespace, file, records):
+        """
+        Records that records of a file were upserted.
+
+        Parameters:
+        - namespace: The namespace the records were written to.
+        - file: The Box file object.
+        - records: The records written.
+        """
+        self._write(self._file_event(
+            "batch", namespace, file,
+            ids=[record["_id"] for record in records],
+            offsets=[record.get("chunk_id") for record in records],
+        ))
+
+    def file_done(self, namespace, file):
+        """Records that all records of a file were written."""
+        self._write(self._file_event("done", namespace, file))
+
+    def file_failed(self, namespace, file, stage, error):
+        """Records that a file failed in a stage."""
+        self._write(self._file_event("failed", namespace, file, stage=stage, error=str(error)))
+
+    def records_discarded(self, namespace, file):
+        """Records that the records written for a failed file were deleted, a resume writes them again."""
+        self._write(self._file_event("discarded", namespace, file))
+
+    def end(self, stats=None):
+        """
+        Records that the run completed, a later resume then starts a new run.
+
+        Parameters:
+        - stats: Optional statistics of the run.
+        """
+        self._write({"event": "end", "stats": stats or {}})
+
+    def close(self):
+        """Closes the journal file."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _file_event(self, event, namespace, file, **fields):
+        return {"event": event, "namespace": namespace, "file_id": file.id, "version": file_version(file), **fields}
+
+    def _write(self, event):
+        event["at"] = datetime.now().isoformat()
+        line = json.dumps(event, default=str) + "\n"
+        with self._lock:
+            self._apply(event)
+            self._file.write(line)
+            if event["event"] in _DURABLE_EVENTS:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def _apply(self, event):
+        """Updates the state of the run with an event, the lock is held or the journal not shared yet."""
+        kind = event.get("event")
+        if kind == "run":
+            self.options = event.get("options", {})
+            self._done.clear()
+            self._written.clear()
+            return
+        key = (event.get("namespace"), event.get("file_id"))
+        if kind == "batch":
+            version, ids = self._written.get(key, (None, None))
+            if version != event["version"]:
+                # Records of an older version of the file are superseded
+                ids = set()
+                self._written[key] = (event["version"], ids)
+            ids.update(event["ids"])
+        elif kind == "done":
+            self._done.add((*key, event["version"]))
+            # The manifest lists the chunks of the file from now on
+            self._written.pop(key, None)
+        elif kind == "discarded":
+            self._written.pop(key, None)
@@ -0,0 +1,275 @@
+"""
+Persistent manifest of the Box files already indexed in Pinecone.
+---
+The manifest is a small SQLite database keyed by namespace and Box file ID.
+It remembers the version of every indexed file and the chunk IDs written
+for it, so a re-run can skip unchanged files and clean up stale chunks.
+
+It also keeps the dead-letter list of the files that failed to index, with
+the stage and error, until they are indexed or removed
+(python main.py --retry-failed retries only them).
+"""
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+
+
+def file_fingerprint(file):
+    """
+    Returns the fields identifying a version of a Box file.
+
+    Parameters:
+    - file: The Box file object.
+
+    Returns:
+    - A dictionary with the "modified_at", "sha1" and "version" of the file.
+    """
+    file_version = getattr(file, "file_version", None)
+    if isinstance(file_version, dict):
+        version = file_version.get("id")
+    else:
+        version = getattr(file_version, "id", None)
+    return {
+        "modified_at": getattr(file, "modified_at", None),
+        "sha1": getattr(file, "sha1", None),
+        "version": version,
+    }
+
+
+class Manifest:
+    """
+    SQLite backed record of indexed files. Safe to share between threads.
+
+    Parameters:
+    - path: The path of the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                namespace TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                modified_at TEXT,
+                sha1 TEXT,
+                version TEXT,
+                chunk_ids TEXT NOT NULL,
+                indexed_at TEXT NOT NULL,
+                PRIMARY KEY (namespace, file_id)
+            )
+            """
+        )
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS failed_files (
+                namespace TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                name TEXT,
+                stage TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL,
+                failed_at TEXT NOT NULL,
+                PRIMARY KEY (namespace, file_id)
+            )
+            """
+        )
+        self._connection.commit()
+
+    def get(self, namespace, file_id):
+        """
+        Returns the manifest entry of a file.
+
+        Parameters:
+        - namespace: The Pinecone namespace the file is indexed in.
+        - file_id: The Box file ID.
+
+        Returns:
+        - A dictionary with the fingerprint and "chunk_ids" of the file, or None if it is not indexed.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT modified_at, sha1, version, chunk_ids FROM files WHERE namespace = ? AND file_id = ?",
+                (namespace, file_id),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "modified_at": row[0],
+            "sha1": row[1],
+            "version": row[2],
+            "chunk_ids": json.loads(row[3]),
+        }
+
+    def is_unchanged(self, namespace, file):
+        """
+        Checks if a file is indexed at exactly its current version.
+
+        Parameters:
+        - namespace: The Pinecone namespace the file is indexed in.
+        - file: The Box file object.
+
+        Returns:
+        - True if the file can be skipped, False if it must be (re-)indexed.
+        """
+        entry = self.get(namespace, file.id)
+        if entry is None:
+            return False
+        fingerprint = {key: _to_text(value) for key, value in file_fingerprint(file).items()}
+        if not any(fingerprint.values()):
+            return False
+        return all(entry[key] == value for key, value in fingerprint.items())
+
+    def record(self, namespace, file, chunk_ids):
+        """
+        Stores the fingerprint of a file and the chunk IDs written for it.
+
+        Parameters:
+        - namespace: The Pinecone namespace the file is indexed in.
+        - file: The Box file object.
+        - chunk_ids: The IDs of the records upserted for the file.
+        """
+        fingerprint = file_fingerprint(file)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    namespace,
+                    file.id,
+                    _to_text(fingerprint["modified_at"]),
+                    _to_text(fingerprint["sha1"]),
+                    _to_text(fingerprint["version"]),
+                    json.dumps(list(chunk_ids)),
+                    datetime.now().isoformat(),
+                ),
+            )
+            self._connection.execute(
+                "DELETE FROM failed_files WHERE namespace = ? AND file_id = ?", (namespace, file.id)
+            )
+            self._connection.commit()
+
+    def remove(self, namespace, file_id):
+        """
+        Removes a file from the manifest.
+
+        Parameters:
+        - namespace: The Pinecone namespace the file is indexed in.
+        - file_id: The Box file ID.
+        """
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM files WHERE namespace = ? AND file_id = ?", (namespace, file_id)
+            )
+            self._connection.execute(
+                "DELETE FROM failed_files WHERE namespace = ? AND file_id = ?", (namespace, file_id)
+            )
+            self._connection.commit()
+
+    def file_ids(self, namespace):
+        """
+        Returns the IDs of all files indexed in a namespace.
+
+        Parameters:
+        - namespace: The Pinecone namespace.
+
+        Returns:
+        - A set of Box file IDs.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT file_id FROM files WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def record_failure(self, namespace, file, stage, error):
+        """
+        Adds a file to the dead-letter list, counting its failed attempts.
+
+        Parameters:
+        - namespace: The Pinecone namespace the file is indexed in.
+        - file: The Box file object.
+        - stage: The name of the stage that failed.
+        - error: The error, stored as text.
+        """
+        with self._lock:
+            self._connection.execute(
+                """
+                INSERT INTO failed_files VALUES (?, ?, ?, ?, ?, 1, ?)
+                ON CONFLICT (namespace, file_id) DO UPDATE SET
+                    name = excluded.name, stage = excluded.stage, error = excluded.error,
+                    attempts = attempts + 1, failed_at = excluded.failed_at
+                """,
+                (namespace, file.id, getattr(file, "name", None), stage, str(error), datetime.now().isoformat()),
+            )
+            self._connection.commit()
+
+    def clear_failure(self, namespace, file_id):
+        """
+        Removes a file from the dead-letter list.
+
+        Parameters:
+        - namespace: The Pinecone namespace the file is indexed in.
+        - file_id: The Box file ID.
+        """
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM failed_files WHERE namespace = ? AND file_id = ?", (namespace, file_id)
+            )
+            self._connection.commit()
+
+    def failure(self, namespace, file_id):
+        """
+        Returns the dead-letter entry of a file.
+
+        Parameters:
+        - namespace: The Pinecone namespace.
+        - file_id: The Box file ID.
+
+        Returns:
+        - A dictionary with the "file_id", "name", "stage", "error", "attempts" and "failed_at"
+          of the file, or None if it is not in the dead-letter list.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT file_id, name, stage, error, attempts, failed_at FROM failed_files"
+                " WHERE namespace = ? AND file_id = ?",
+                (namespace, file_id),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("file_id", "name", "stage", "error", "attempts", "failed_at"), row))
+
+    def failures(self, namespace):
+        """
+        Returns the dead-letter list of a namespace.
+
+        Parameters:
+        - namespace: The Pinecone namespace.
+
+        Returns:
+        - A list of dictionaries with the "file_id", "name", "stage", "error", "attempts"
+          and "failed_at" of every failed file, oldest failure first.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT file_id, name, stage, error, attempts, failed_at FROM failed_files"
+                " WHERE namespace = ? ORDER BY failed_at",
+                (namespace,),
+            ).fetchall()
+        keys = ("file_id", "name", "stage", "error", "attempts", "failed_at")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def close(self):
+        """Closes the database connection."""
+        with self._lock:
+            self._connection.close()
+        logging.debug(f"Closed manifest {self.path}")
+
+
+def _to_text(value):
+    """Normalizes a fingerprint value for storage and comparison."""
+    return None if value is None else str(value)
@@ -0,0 +1,191 @@
+"""
+Staged, thread based processing pipeline.
+---
+Items produced by a source iterable flow through a list of stages.
+Every stage has its own pool of worker threads and is connected to the
+next stage by a bounded queue, so a slow stage applies backpressure to the
+stages feeding it instead of letting work pile up in memory.
+
+A failing item only fails itself, while an error of the source, e.g. a
+folder listing that cannot continue, fails the run: the items already
+produced are processed, then the error is raised.
+"""
+import logging
+import queue
+import threading
+from common import metrics
+
+# Marks the end of the stream on a stage queue
+_DONE = object()
+
+
+class Stage:
+    """
+    A single step of the pipeline.
+
+    Parameters:
+    - name: The name of the stage, used in log messages.
+    - func: Callable applied to every item. It returns the item to hand to the
+      next stage, or None to drop the item.
+    - workers: The number of worker threads running this stage (default is 1).
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+
+
+def _log_error(stage, item, error):
+    """Default error handler, logs the failure and keeps the pipeline running."""
+    logging.error(f"Stage {stage.name} failed for item {item}: {error}")
+
+
+def run_pipeline(source, stages, queue_size=100, on_error=None):
+    """
+    Runs every item of source through the stages and waits for completion.
+
+    If the source raises, the items it produced are still processed, then its error is raised.
+
+    Parameters:
+    - source: An iterable producing the items to process. It is consumed on its
+      own thread, so it may be a lazy generator doing network I/O.
+    - stages: The list of Stage objects to run, in order.
+    - queue_size: The maximum number of items waiting in front of each stage (default is 100).
+    - on_error: Optional callable(stage, item, error) invoked when a stage raises.
+      Failures are isolated to the item, the pipeline keeps running.
+
+    Returns:
+    - A dictionary with the number of "completed" and "failed" items.
+    """
+    if not stages:
+        raise ValueError("At least one stage is required")
+    on_error = on_error or _log_error
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    remaining = [stage.workers for stage in stages]
+    stats = {"completed": 0, "failed": 0}
+    lock = threading.Lock()
+    source_errors = []
+
+    def feed():
+        try:
+            for item in source:
+                queues[0].put(item)
+        except Exception as e:
+            logging.error(f"Pipeline source failed: {e}")
+            source_errors.append(e)
+        finally:
+            for _ in range(stages[0].workers):
+                queues[0].put(_DONE)
+
+    def work(position):
+        stage = stages[position]
+        is_last = position == len(stages) - 1
+        while True:
+            item = queues[position].get()
+            if item is _DONE:
+                break
+            try:
+                with metrics.timer("pipeline_stage_seconds", stage=stage.name):
+                    result = stage.func(item)
+            except Exception as e:
+                metrics.increment("pipeline_failures", stage=stage.name)
+                with lock:
+                    stats["failed"] += 1
+                on_error(stage, item, e)
+                continue
+            if result is None:
+                continue
+            if is_last:
+                with lock:
+                    stats["completed"] += 1
+            else:
+                queues[position + 1].put(result)
+
+        # The last worker of a stage to finish closes the next stage
+        with lock:
+            remaining[position] -= 1
+            closing = remaining[position] == 0
+        if closing and not is_last:
+            for _ in range(stages[position + 1].workers):
+                queues[position + 1].put(_DONE)
+
+    threads = [threading.Thread(target=feed, name="pipeline-source", daemon=True)]
+    for position, stage in enumerate(stages):
+        for n in range(stage.workers):
+            threads.append(
+                threading.Thread(target=work, args=(position,), name=f"pipeline-{stage.name}-{n}", daemon=True)
+            )
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    logging.info(f"Pipeline finished: {stats['completed']} completed, {stats['failed']} failed")
+    if source_errors:
+        raise source_errors[0]
+    return stats
+
+
+def interleave(sources, buffer_size=2):
+    """
+    Yields the items of several iterables in round-robin order.
+
+    Every source is consumed on its own thread into a small buffer, and
+    each turn takes one item from the next source with an item ready: a
+    source that is slow to produce does not hold up the others, and a
+    source with many items gets no more turns than the others while they
+    have items too. The first error of a source is raised once the other
+    sources are exhausted.
+
+    Parameters:
+    - sources: The iterables to interleave.
+    - buffer_size: The number of items read ahead per source (default is 2).
+
+    Returns:
+    - A generator of the items of all sources.
+    """
+    condition = threading.Condition()
+    buffers = [[] for _ in sources]
+    finished = [False] * len(sources)
+    errors = []
+
+    def feed(position, source):
+        try:
+            for item in source:
+                with condition:
+                    while len(buffers[position]) >= buffer_size:
+                        condition.wait()
+                    buffers[position].append(item)
+                    condition.notify_all()
+        except Exception as e:
+            logging.error(f"Pipeline source {position} failed: {e}")
+            errors.append(e)
+        finally:
+            with condition:
+                finished[position] = True
+                condition.notify_all()
+
+    for position, source in enumerate(sources):
+        threading.Thread(target=feed, args=(position, source), name=f"pipeline-source-{position}", daemon=True).start()
+
+    turn = 0
+    while True:
+        with condition:
+            while True:
+                ready = [position for position in range(len(sources)) if buffers[position]]
+                if ready or all(finished):
+                    break
+                condition.wait()
+            if not ready:
+                if errors:
+                    raise errors[0]
+                return
+            # The first source with an item at or after the current turn
+            position = min(ready, key=lambda position: (position - turn) % len(sources))
+            item = buffers[position].pop(0)
+            condition.notify_all()
+        turn = position + 1
+        yield item
@@ -0,0 +1,219 @@
+"""
+Indexes the folders of many Box users in one process.
+---
+The tenants file lists one entry per Box user: a name, the folder to
+index and the user's token, either a token file written by the OAuth flow
+("token_path", refreshed like the single user token) or an access token
+obtained elsewhere ("access_token", never refreshed):
+
+    [
+        {"name": "alice", "folder_id": "123", "token_path": ".oauth-alice.json"},
+        {"name": "bob", "folder_id": "456", "access_token": "..."}
+    ]
+
+All tenants share the process: one boxsdk network layer and HTTP session
+(so their connection pools), the request scheduler limits, one Pinecone
+index, one upsert batcher and the worker threads of the pipeline stages.
+Files of the tenants enter the pipeline in round-robin order, so a tenant
+with a huge folder does not starve the others, and every tenant gets its
+own namespace, its Box user ID, as with main.py.
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from boxsdk import Client, OAuth2
+from boxsdk.session.session import AuthorizedSession
+import config
+from box_integration.box_integration import iter_files_in_folder
+from box_integration.http_session import ScheduledNetwork
+from box_integration.token_manager import ManagedOAuth2
+from ingestion.indexer import FolderListing, listing_stats, load_failed_files, run_listings
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+TENANTS_PATH = getattr(config, "TENANTS_PATH", "tenants.json")
+TENANTS_JOURNAL_PATH = getattr(config, "TENANTS_JOURNAL_PATH", ".tenants_journal.jsonl")
+# Tenants authenticated in parallel at start-up
+TENANT_CONNECT_WORKERS = getattr(config, "TENANT_CONNECT_WORKERS", 8)
+# Per tenant: folders listed in parallel and concurrent representation requests
+TENANT_LISTING_WORKERS = getattr(config, "TENANT_LISTING_WORKERS", 1)
+TENANT_REPRESENTATION_WORKERS = getattr(config, "TENANT_REPRESENTATION_WORKERS", 2)
+
+
+class Tenant:
+    """
+    A Box user and the folder indexed for them.
+
+    Parameters:
+    - name: The name of the tenant, used in logs and reports.
+    - folder_id: The ID of the Box folder to index.
+    - token_path: The token file of the user (default is None).
+    - access_token: The access token of the user, used when there is no token file (default is None).
+    """
+
+    def __init__(self, name, folder_id, token_path=None, access_token=None):
+        self.name = name
+        self.folder_id = folder_id
+        self.token_path = token_path
+        self.access_token = access_token
+        self.client = None
+        self.box_user_id = None
+        self.error = None
+
+    def __str__(self):
+        return self.name
+
+
+def load_tenants(path=TENANTS_PATH):
+    """
+    Reads the tenants file.
+
+    Parameters:
+    - path: The path of the tenants file (default is TENANTS_PATH).
+
+    Returns:
+    - A list of Tenant objects.
+    """
+    with open(path, "r", encoding="UTF-8") as file:
+        entries = json.loads(file.read())
+    tenants = []
+    for number, entry in enumerate(entries, 1):
+        name = entry.get("name") or f"tenant-{number}"
+        if not entry.get("folder_id"):
+            raise ValueError(f"Tenant {name} has no folder_id")
+        if not entry.get("token_path") and not entry.get("access_token"):
+            raise ValueError(f"Tenant {name} has neither token_path nor access_token")
+        tenants.append(Tenant(name, str(entry["folder_id"]), entry.get("token_path"), entry.get("access_token")))
+    names = [tenant.name for tenant in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError("Tenant names must be unique")
+    return tenants
+
+
+def connect_tenant(tenant, network):
+    """
+    Creates the Box client of a tenant and looks up its Box user ID, the namespace of its records.
+
+    Parameters:
+    - tenant: The Tenant.
+    - network: The boxsdk network layer shared by all tenants.
+    """
+    if tenant.token_path:
+        oauth = ManagedOAuth2(config.BOX_CLIENT_ID, config.BOX_CLIENT_SECRET, path=tenant.token_path)
+        if not oauth.access_token:
+            raise RuntimeError(f"No token in {tenant.token_path}, run the OAuth flow for this user first")
+        oauth.ensure_fresh()
+        oauth.start_background_refresh()
+    else:
+        oauth = OAuth2(client_id=config.BOX_CLIENT_ID, client_secret=config.BOX_CLIENT_SECRET,
+                       access_token=tenant.access_token)
+    tenant.client = Client(oauth, AuthorizedSession(oauth, network_layer=network))
+    tenant.box_user_id = tenant.client.user().get().id
+
+
+def connect_tenants(tenants, network=None, max_workers=TENANT_CONNECT_WORKERS):
+    """
+    Connects the tenants in parallel. A tenant that cannot connect keeps its error and is not indexed.
+
+    Two tenants of the same Box user would share a namespace, the later ones are not indexed.
+
+    Parameters:
+    - tenants: The Tenant objects.
+    - network: The boxsdk network layer shared by all tenants (default is a new ScheduledNetwork).
+    - max_workers: The number of tenants connected in parallel (default is TENANT_CONNECT_WORKERS).
+
+    Returns:
+    - The list of connected tenants.
+    """
+    network = network or ScheduledNetwork()
+
+    def connect(tenant):
+        try:
+            connect_tenant(tenant, network)
+        except Exception as e:
+            logging.error(f"Failed to connect tenant {tenant}: {e}")
+            tenant.error = e
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tenant-connect") as executor:
+        list(executor.map(connect, tenants))
+
+    connected = []
+    namespaces = {}
+    for tenant in tenants:
+        if tenant.error is not None:
+            continue
+        if tenant.box_user_id in namespaces:
+            tenant.error = ValueError(f"same Box user as tenant {namespaces[tenant.box_user_id]}, index one folder per user")
+            logging.error(f"Not indexing tenant {tenant}: {tenant.error}")
+            continue
+        namespaces[tenant.box_user_id] = tenant
+        connected.append(tenant)
+    return connected
+
+
+def index_tenants(tenants, index, manifest=None, full_resync=False, journal=None, retry_failed=False):
+    """
+    Indexes the folders of connected tenants through one shared ingestion pipeline.
+
+    Parameters:
+    - tenants: The connected Tenant objects.
+    - index: The Pinecone index to store the data in.
+    - manifest: Optional Manifest of indexed files, shared by all tenants.
+    - full_resync: Re-index every file, writing all of its chunks again (default is False).
+    - journal: Optional started Journal recording the progress of the run.
+      The run is recorded as ended only once the listings of all tenants and the pipeline
+      completed without error, otherwise it is left to resume.
+    - retry_failed: Only index the files of the dead-letter list of every tenant (default is False).
+
+    Returns:
+    - A dictionary of the statistics of every tenant by name, see listing_stats.
+    """
+    listings = []
+    for tenant in tenants:
+        if retry_failed:
+            files = load_failed_files(tenant.client, manifest, tenant.box_user_id)
+        else:
+            files = iter_files_in_folder(tenant.client, tenant.folder_id,
+                                         recursive=getattr(config, "BOX_RECURSIVE", True),
+                                         max_workers=TENANT_LISTING_WORKERS)
+        listings.append(FolderListing(tenant.client, files, tenant.box_user_id, manifest, full_resync, journal,
+                                      representation_workers=TENANT_REPRESENTATION_WORKERS, name=tenant.name))
+    if listings:
+        # Raises if a listing or the pipeline failed, before the run is recorded as ended
+        run_listings(listings, index, manifest, full_resync, journal)
+    results = {
+        listing.name: listing_stats(listing, index, manifest, delete_removed=not retry_failed)
+        for listing in listings
+    }
+    if journal is not None and all(listing.complete for listing in listings):
+        journal.end(results)
+    return results
+
+
+def tenant_report(tenants, results):
+    """
+    Returns the per tenant statistics and throughput as a text table.
+
+    Parameters:
+    - tenants: All the Tenant objects, connected or not.
+    - results: The statistics returned by index_tenants.
+    """
+    lines = [
+        f"{'tenant':<24}{'completed':>10}{'failed':>8}{'skipped':>9}{'removed':>9}"
+        f"{'chunks':>9}{'seconds':>10}{'files/s':>9}{'chunks/s':>10}"
+    ]
+    for tenant in tenants:
+        stats = results.get(tenant.name)
+        if stats is None:
+            lines.append(f"{tenant.name:<24}  not indexed: {tenant.error}")
+            continue
+        seconds = stats["seconds"]
+        files_per_second = stats["completed"] / seconds if seconds else 0.0
+        chunks_per_second = stats["chunks"] / seconds if seconds else 0.0
+        lines.append(
+            f"{tenant.name:<24}{stats['completed']:>10}{stats['failed']:>8}{stats['skipped']:>9}{stats['removed']:>9}"
+            f"{stats['chunks']:>9}{seconds:>10.1f}{files_per_second:>9.2f}{chunks_per_second:>10.1f}"
+        )
+    return "\n".join(lines)
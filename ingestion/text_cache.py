@@ -0,0 +1,351 @@
+"""
+Content-addressed on-disk cache of the cleaned text of Box files.
+---
+Re-indexing a folder (a new chunk size, a new index or embedding model)
+would otherwise download every text representation from Box again. The
+cache keeps the cleaned text of every file, zlib compressed, in a file
+named after a hash of the Box file ID and its SHA-1 (or version ID): an
+edited file gets a new entry, and files already cached are read from
+local disk without any Box request, not even for the representation info.
+
+Entries are read through mmap, whole or piece by piece for the streaming
+pipeline, and written to a temporary file renamed into place, so several
+threads and processes can share the cache. A SQLite index next to the
+entries records their size and last use: once the cache exceeds
+TEXT_CACHE_MAX_BYTES, the least recently used entries are evicted. An
+entry whose file disappeared is a miss.
+"""
+import codecs
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+import config
+from ingestion.manifest import file_fingerprint
+from common import metrics
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+TEXT_CACHE_ENABLED = getattr(config, "TEXT_CACHE_ENABLED", True)
+TEXT_CACHE_PATH = getattr(config, "TEXT_CACHE_PATH", ".text_cache")
+TEXT_CACHE_MAX_BYTES = getattr(config, "TEXT_CACHE_MAX_BYTES", 1_000_000_000)
+
+# Part of every key, bumped when the cleaner output or the entry format changes
+_FORMAT_VERSION = 1
+# Compresses several times faster than the cleaner cleans, at a ratio close to the default level
+_COMPRESSION_LEVEL = 3
+# Compressed bytes decompressed at a time when reading an entry piece by piece
+_READ_SIZE = 65536
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        last_used REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)",
+)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def cache_key(file):
+    """
+    Builds the cache key of the text of a Box file.
+
+    Parameters:
+    - file: The Box file object.
+
+    Returns:
+    - A hex digest of the file ID and its SHA-1 or version ID, or None if
+      the file has neither and its content cannot be identified.
+    """
+    fingerprint = file_fingerprint(file)
+    content = fingerprint["sha1"] or fingerprint["version"]
+    if not content:
+        return None
+    payload = f"{_FORMAT_VERSION}\0{file.id}\0{content}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def get_text_cache():
+    """
+    Returns the process wide TextCache, opening it on first use.
+
+    Returns:
+    - The TextCache, or None if TEXT_CACHE_ENABLED is off.
+    """
+    global _cache  # pylint: disable=global-statement
+    if not TEXT_CACHE_ENABLED or not TEXT_CACHE_PATH:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TextCache(TEXT_CACHE_PATH)
+    return _cache
+
+
+def _iter_decompressed(data, size=_READ_SIZE):
+    """Decompresses a buffer of compressed UTF-8 text, yielding the text piece by piece."""
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    view = memoryview(data)
+    try:
+        for start in range(0, len(view), size):
+            piece = decoder.decode(decompressor.decompress(view[start:start + size]))
+            if piece:
+                yield piece
+        piece = decoder.decode(decompressor.flush(), final=True)
+        if piece:
+            yield piece
+    finally:
+        view.release()
+
+
+class TextCache:
+    """
+    Compressed cleaned texts of Box files in a directory, with LRU eviction. Safe to share between threads.
+
+    Parameters:
+    - path: The directory of the cache, created if needed.
+    - max_bytes: The compressed size above which the least recently used entries are evicted
+      (default is TEXT_CACHE_MAX_BYTES).
+    """
+
+    def __init__(self, path, max_bytes=TEXT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(path, "index.sqlite"), timeout=30, check_same_thread=False)
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".z")
+
+    def contains(self, file):
+        """Returns True if the text of the file, at its current version, is cached."""
+        key = cache_key(file)
+        return key is not None and os.path.exists(self._entry_path(key))
+
+    def _open(self, file):
+        """Maps the entry of a file in memory, returns the key and the mmap, or None on a miss."""
+        key = cache_key(file)
+        if key is None:
+            return None
+        try:
+            with open(self._entry_path(key), "rb") as entry:
+                data = mmap.mmap(entry.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # Missing, or empty and so torn
+            self._forget(key)
+            metrics.increment("text_cache", outcome="miss")
+            return None
+        metrics.increment("text_cache", outcome="hit")
+        metrics.increment("text_cache_bytes", len(data), operation="read")
+        self._touch(key)
+        return key, data
+
+    def get(self, file):
+        """
+        Reads the cached text of a file.
+
+        Parameters:
+        - file: The Box file object.
+
+        Returns:
+        - The cleaned text, or None if it is not cached.
+        """
+        opened = self._open(file)
+        if opened is None:
+            return None
+        key, data = opened
+        try:
+            return zlib.decompress(data).decode("utf-8")
+        except zlib.error as e:
+            logging.warning(f"Dropping corrupt text cache entry of file {file.name}: {e}")
+            self._discard(key)
+            return None
+        finally:
+            data.close()
+
+    def open_text(self, file):
+        """
+        Opens the cached text of a file for reading piece by piece.
+
+        The entry is opened right away, so it can be read even if it is evicted in the meantime.
+
+        Parameters:
+        - file: The Box file object.
+
+        Returns:
+        - A generator of pieces of the cleaned text, or None if it is not cached.
+        """
+        opened = self._open(file)
+        if opened is None:
+            return None
+        _, data = opened
+
+        def pieces():
+            try:
+                yield from _iter_decompressed(data)
+            finally:
+                data.close()
+        return pieces()
+
+    def put(self, file, text):
+        """
+        Stores the cleaned text of a file, evicting the least recently used entries if the cache is full.
+
+        Parameters:
+        - file: The Box file object.
+        - text: The cleaned text.
+        """
+        writer = self.writer(file)
+        if writer is not None:
+            writer.write(text)
+            writer.commit()
+
+    def writer(self, file):
+        """
+        Returns a writer storing the cleaned text of a file piece by piece.
+
+        Parameters:
+        - file: The Box file object.
+
+        Returns:
+        - A TextCacheWriter, or None if the content of the file cannot be identified.
+        """
+        key = cache_key(file)
+        return TextCacheWriter(self, key) if key is not None else None
+
+    def caching(self, file, pieces):
+        """
+        Yields pieces of the cleaned text of a file, storing the text once they are all consumed.
+
+        Nothing is stored if the pieces are not all consumed or raise.
+
+        Parameters:
+        - file: The Box file object.
+        - pieces: An iterable of pieces of the cleaned text.
+
+        Returns:
+        - A generator of the same pieces.
+        """
+        writer = self.writer(file)
+        if writer is None:
+            yield from pieces
+            return
+        try:
+            for piece in pieces:
+                writer.write(piece)
+                yield piece
+            writer.commit()
+        finally:
+            writer.abort()
+
+    def _commit(self, key, temporary_path, size):
+        """Moves a written entry into place and evicts entries over the size limit."""
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temporary_path, path)
+        metrics.increment("text_cache_bytes", size, operation="written")
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, size, time.time())
+            )
+        self._evict()
+
+    def _touch(self, key):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+
+    def _forget(self, key):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def _discard(self, key):
+        """Deletes an entry and its file."""
+        try:
+            os.remove(self._entry_path(key))
+        except FileNotFoundError:
+            pass
+        self._forget(key)
+
+    def _evict(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for key, size in self._connection.execute("SELECT key, size FROM entries ORDER BY last_used"):
+                if total <= self.max_bytes:
+                    break
+                evicted.append(key)
+                total -= size
+        for key in evicted:
+            self._discard(key)
+        metrics.increment("text_cache_evictions", len(evicted))
+        logging.debug(f"Evicted {len(evicted)} text cache entries")
+
+    def close(self):
+        """Closes the SQLite index."""
+        with self._lock:
+            self._connection.close()
+
+
+class TextCacheWriter:
+    """
+    Compresses a text written piece by piece into a temporary file, moved into the cache on commit.
+
+    Parameters:
+    - cache: The TextCache.
+    - key: The cache key of the file.
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self._compressor = zlib.compressobj(_COMPRESSION_LEVEL)
+        descriptor, self._temporary_path = tempfile.mkstemp(dir=cache.path, suffix=".tmp")
+        self._file = os.fdopen(descriptor, "wb")
+        self._size = 0
+
+    def write(self, piece):
+        """Adds a piece of the text."""
+        data = self._compressor.compress(piece.encode("utf-8"))
+        self._file.write(data)
+        self._size += len(data)
+
+    def commit(self):
+        """Stores the text written so far as the entry."""
+        data = self._compressor.flush()
+        self._file.write(data)
+        self._size += len(data)
+        self._file.close()
+        self.cache._commit(self.key, self._temporary_path, self._size)  # pylint: disable=protected-access
+        self._temporary_path = None
+
+    def abort(self):
+        """Drops the text written so far, does nothing after commit."""
+        if self._temporary_path is None:
+            return
+        self._file.close()
+        try:
+            os.remove(self._temporary_path)
+        except FileNotFoundError:
+            pass
+        self._temporary_path = None
@@ -1,20 +1,52 @@
 """main.py"""
 
-from box_integration.box_integration import get_files_in_folder, get_file_text_content
-from pinecone_integration.pinecone_client import get_pinecone_index, store_metadata_in_pinecone
+from pinecone_integration.pinecone_client import get_pinecone_index
+from ingestion.journal import Journal, INGEST_JOURNAL_PATH
+from ingestion.manifest import Manifest
+from common import metrics
+import argparse
 import config
 import logging
 from box_integration.box_client import get_client
-import traceback
 
 log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
 logging.basicConfig(level=log_level)
 logging.getLogger("box-pinecone-integration")
 
-def main():
+def parse_args(argv=None):
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Index the files of a Box folder in Pinecone.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--full-resync",
+        action="store_true",
+        help="Re-index every file, even those the manifest reports as unchanged.",
+    )
+    mode.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the last run where it stopped, with its options, without writing its upserted batches again.",
+    )
+    mode.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Only index the files that failed in previous runs.",
+    )
+    return parser.parse_args(argv)
+
+def main(argv=None):
     """
     Main function to process files from a Box folder, extract text and metadata, and store them in a Pinecone index.
     """
+    args = parse_args(argv)
+
+    # Imported once the arguments are parsed, so --help does not load the Box SDK
+    # pylint: disable=import-outside-toplevel
+    from box_integration.box_integration import iter_files_in_folder
+    from ingestion.indexer import index_files, load_failed_files, MANIFEST_PATH
+
     # Initialize Box client
     logging.info("Initializing Box client")
     box_client = get_client()
@@ -30,39 +62,47 @@ def main():
     logging.info("Defining Box folder ID")
     folder_id = config.BOX_FOLDER_ID
     
-    # Get all files in the specified folder
-    logging.info("Getting all files in the specified folder")
-    files = get_files_in_folder(box_client, folder_id)
-    
-    # Process each file
-    for file in files:
-        try:
-            logging.info(f"Processing file: {file.name}")
-            # Extract text content from the file representation
-            text_content = get_file_text_content(box_client, file)
-            
-            # Extract metadata from the file object
-            metadata = {
-                "file_name": file.name,
-                "file_id": file.id,
-                "created_at": file.created_at,
-                "modified_at": file.modified_at,
-                "size": file.size,
-                "box_user_id": box_user.id
-            }
-            
-            # Combine text content with metadata for vectorization
-            combined_text = text_content + " " + " ".join(f"{key}: {value}" for key, value in metadata.items())
-            logging.debug(f"Text: {combined_text}")
-            # Store the vectorized representation and metadata in Pinecone
-            logging.info(f"Storing metadata in Pinecone for file: {file.name}")
-            store_metadata_in_pinecone(pinecone_index, file.id, {"text": combined_text, **metadata}, box_user.id)
-            
-            logging.info(f"Processed and stored metadata for file: {file.name}")
-        
-        except Exception as e:
-            logging.error(f"Failed to process file {file.name}: {e}")
-            logging.error(traceback.format_exc())
+    manifest = Manifest(MANIFEST_PATH)
+    journal = None
+    try:
+        if args.retry_failed:
+            # Only the dead-letter list, the rest of the folder is left as it is
+            files = load_failed_files(box_client, manifest, box_user.id)
+            logging.info(f"Retrying {len(files)} failed files")
+            with metrics.profile("indexing"):
+                index_files(box_client, files, pinecone_index, box_user.id, manifest=manifest, delete_removed=False)
+        else:
+            # Record the progress of the run, batch by batch, to resume it after a crash
+            journal = Journal(INGEST_JOURNAL_PATH)
+            resumed = journal.start(resume=args.resume, folder_id=folder_id, full_resync=args.full_resync)
+            full_resync = journal.options.get("full_resync", False) if resumed else args.full_resync
+
+            # List the files of the folder tree lazily, indexing starts with the first page
+            logging.info("Getting all files in the specified folder")
+            files = iter_files_in_folder(
+                box_client,
+                folder_id,
+                recursive=getattr(config, "BOX_RECURSIVE", True),
+                max_workers=getattr(config, "BOX_LISTING_WORKERS", 4),
+            )
+
+            # Fetch, clean, chunk and upsert the new or modified files concurrently; failures are isolated per file
+            with metrics.profile("indexing"):
+                index_files(box_client, files, pinecone_index, box_user.id, manifest=manifest,
+                            full_resync=full_resync, journal=journal)
+
+        failures = manifest.failures(box_user.id)
+        if failures:
+            print(f"{len(failures)} files failed to index, retry them with: python main.py --retry-failed")
+    except Exception:
+        if journal is not None:
+            print("The run stopped before the end of the folder, continue it with: python main.py --resume")
+        raise
+    finally:
+        if journal is not None:
+            journal.close()
+        manifest.close()
+    metrics.report()
     
     logging.info("Processed and stored metadata for all files in the folder.")
 
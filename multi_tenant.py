@@ -0,0 +1,93 @@
+"""multi_tenant.py"""
+
+from pinecone_integration.pinecone_client import get_pinecone_index
+from ingestion.indexer import MANIFEST_PATH
+from ingestion.journal import Journal
+from ingestion.manifest import Manifest
+from ingestion.tenants import (
+    TENANTS_JOURNAL_PATH,
+    TENANTS_PATH,
+    connect_tenants,
+    index_tenants,
+    load_tenants,
+    tenant_report,
+)
+from common import metrics
+import argparse
+import config
+import logging
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Index the Box folders of many users in Pinecone, in one process.")
+    parser.add_argument(
+        "--tenants",
+        default=TENANTS_PATH,
+        help="The JSON file listing the name, folder_id and token_path or access_token of every user.",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--full-resync",
+        action="store_true",
+        help="Re-index every file, even those the manifest reports as unchanged.",
+    )
+    mode.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the last run where it stopped, with its options, without writing its upserted batches again.",
+    )
+    mode.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Only index the files that failed in previous runs.",
+    )
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """
+    Indexes the folder of every tenant, sharing the clients, connections and workers, and prints a report per tenant.
+    """
+    args = parse_args(argv)
+
+    tenants = load_tenants(args.tenants)
+
+    # Authenticate every tenant once, on a shared network layer
+    logging.info(f"Connecting {len(tenants)} tenants")
+    connected = connect_tenants(tenants)
+
+    # Initialize Pinecone client
+    pinecone_index = get_pinecone_index()
+
+    manifest = Manifest(MANIFEST_PATH)
+    journal = None
+    try:
+        if args.retry_failed:
+            full_resync = False
+        else:
+            # Record the progress of the run, batch by batch, to resume it after a crash
+            journal = Journal(TENANTS_JOURNAL_PATH)
+            resumed = journal.start(resume=args.resume, tenants=args.tenants, full_resync=args.full_resync)
+            full_resync = journal.options.get("full_resync", False) if resumed else args.full_resync
+
+        with metrics.profile("indexing"):
+            results = index_tenants(connected, pinecone_index, manifest, full_resync=full_resync, journal=journal,
+                                    retry_failed=args.retry_failed)
+        print(tenant_report(tenants, results))
+    except Exception:
+        if journal is not None:
+            print("The run stopped before the end of the folders, continue it with: python multi_tenant.py --resume")
+        raise
+    finally:
+        if journal is not None:
+            journal.close()
+        manifest.close()
+    metrics.report()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+Batches record upserts across files.
+---
+Records of any number of files are collected per namespace into batches
+limited both by record count and by request payload size. Full batches
+are flushed on a thread pool, several at a time per namespace, through
+the request scheduler, which retries transient failures (429, 5xx,
+connection errors) and adapts the concurrency to them. Every add_records() call returns an UpsertTicket
+that reports exactly which of its record IDs were written.
+"""
+import json
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import config
+from common import metrics
+from common.rate_limiter import scheduled_call
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("pinecone")
+
+# Pinecone limits upserts with integrated embedding to 96 records and 2 MB per request
+MAX_BATCH_RECORDS = getattr(config, "UPSERT_MAX_RECORDS", 96)
+MAX_BATCH_BYTES = getattr(config, "UPSERT_MAX_BYTES", 2_000_000)
+MAX_CONCURRENT_FLUSHES = getattr(config, "UPSERT_CONCURRENCY", 4)
+MAX_RETRIES = getattr(config, "UPSERT_MAX_RETRIES", 5)
+
+
+class UpsertError(Exception):
+    """
+    Raised by UpsertTicket.result() when some records of the ticket were not written.
+    """
+
+    def __init__(self, message, written_ids, failed_ids):
+        super().__init__(message)
+        self.written_ids = written_ids
+        self.failed_ids = failed_ids
+
+
+class UpsertTicket:
+    """
+    Tracks the records of one add_records() call until all of them are flushed.
+
+    Parameters:
+    - namespace: The namespace the records are written to.
+    - source: The object the records come from, e.g. a file (default is None).
+    """
+
+    def __init__(self, namespace, source=None):
+        self.namespace = namespace
+        self.source = source
+        self.written_ids = []
+        self.failed_ids = []
+        self.error = None
+        self._pending = 0
+        self._closed = False
+        self._completed = False
+        self._lock = threading.Lock()
+        self._future = Future()
+
+    def done(self):
+        """Returns True once every record of the ticket was written or failed."""
+        return self._future.done()
+
+    def result(self, timeout=None):
+        """
+        Waits for the ticket to complete.
+
+        Parameters:
+        - timeout: The maximum number of seconds to wait (default is no limit).
+
+        Returns:
+        - The IDs of the written records. Raises UpsertError if some records failed.
+        """
+        return self._future.result(timeout)
+
+    def add_done_callback(self, callback):
+        """
+        Calls callback(ticket) once the ticket completes, from the flushing thread.
+        """
+        self._future.add_done_callback(lambda _: callback(self))
+
+    def _add(self):
+        with self._lock:
+            self._pending += 1
+
+    def _close(self):
+        with self._lock:
+            self._closed = True
+        self._maybe_complete()
+
+    def _settle(self, written_ids, failed_ids, error=None):
+        with self._lock:
+            self.written_ids.extend(written_ids)
+            self.failed_ids.extend(failed_ids)
+            self._pending -= len(written_ids) + len(failed_ids)
+            if error is not None:
+                self.error = error
+        self._maybe_complete()
+
+    def _maybe_complete(self):
+        with self._lock:
+            if not self._closed or self._pending or self._completed:
+                return
+            self._completed = True
+        if self.failed_ids:
+            self._future.set_exception(UpsertError(
+                f"{len(self.failed_ids)} records failed to upsert: {self.error}",
+                self.written_ids,
+                self.failed_ids,
+            ))
+        else:
+            self._future.set_result(self.written_ids)
+
+
+class BatchUpserter:
+    """
+    Upserts records into a Pinecone index in shared, size limited batches.
+
+    Parameters:
+    - index: The Pinecone index to store the data in.
+    - max_records: The maximum number of records per request (default is MAX_BATCH_RECORDS).
+    - max_bytes: The maximum JSON payload size of a request (default is MAX_BATCH_BYTES).
+    - max_concurrent_flushes: The number of requests in flight per namespace (default is MAX_CONCURRENT_FLUSHES).
+    - max_retries: The number of retries of a failing request (default is MAX_RETRIES).
+    - backoff_seconds: The delay before the first retry, doubled on every attempt (default is 1).
+    - on_batch_written: Optional callback(namespace, ticket, records) called with the records of
+      each ticket once a batch is written, before the ticket can complete.
+    """
+
+    def __init__(self, index, max_records=MAX_BATCH_RECORDS, max_bytes=MAX_BATCH_BYTES,
+                 max_concurrent_flushes=MAX_CONCURRENT_FLUSHES, max_retries=MAX_RETRIES, backoff_seconds=1.0,
+                 on_batch_written=None):
+        self.index = index
+        self.on_batch_written = on_batch_written
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_concurrent_flushes = max_concurrent_flushes
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._executor = ThreadPoolExecutor(thread_name_prefix="pinecone-upsert")
+        self._lock = threading.Lock()
+        self._batches = {}
+        self._flush_slots = {}
+        self._flushes = []
+
+    def add_records(self, namespace, records, source=None, ticket=None):
+        """
+        Adds the records of one file to the batches of a namespace.
+
+        Blocks while the namespace already has max_concurrent_flushes requests
+        in flight, which bounds the number of buffered records. If records
+        raises, the ticket still completes once the records added before are
+        flushed, and reports which were written.
+
+        Parameters:
+        - namespace: The namespace to write to.
+        - records: An iterable of records, consumed lazily.
+        - source: The object the records come from, available as ticket.source (default is None).
+        - ticket: Optional new UpsertTicket of the namespace to add the records to, so the caller
+          holds it even if records raises (default is a new ticket).
+
+        Returns:
+        - An UpsertTicket completing once all the records are flushed.
+        """
+        ticket = UpsertTicket(namespace, source) if ticket is None else ticket
+        try:
+            for record in records:
+                ticket._add()
+                size = len(json.dumps(record, default=str).encode("utf-8"))
+                full_batches = []
+                with self._lock:
+                    batch = self._batches.setdefault(namespace, _Batch())
+                    if batch.entries and batch.size + size > self.max_bytes:
+                        full_batches.append(batch)
+                        batch = self._batches[namespace] = _Batch()
+                    batch.add(record, size, ticket)
+                    if len(batch.entries) >= self.max_records:
+                        full_batches.append(self._batches.pop(namespace))
+                for full_batch in full_batches:
+                    self._submit(namespace, full_batch)
+        finally:
+            ticket._close()
+        return ticket
+
+    def flush(self, namespace=None):
+        """
+        Sends the partially filled batches of all namespaces, or of one.
+
+        Parameters:
+        - namespace: The namespace to flush (default is all namespaces).
+        """
+        with self._lock:
+            if namespace is None:
+                batches, self._batches = self._batches, {}
+            else:
+                batches = {namespace: self._batches.pop(namespace)} if namespace in self._batches else {}
+        for namespace, batch in batches.items():
+            if batch.entries:
+                self._submit(namespace, batch)
+
+    def close(self):
+        """
+        Flushes the remaining batches and waits until every request completed.
+        """
+        self.flush()
+        while True:
+            with self._lock:
+                flushes, self._flushes = self._flushes, []
+            if not flushes:
+                break
+            for flush in flushes:
+                flush.result()
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, namespace, batch):
+        """Sends a batch on the thread pool, waiting for a free slot of the namespace."""
+        with self._lock:
+            slots = self._flush_slots.setdefault(namespace, threading.BoundedSemaphore(self.max_concurrent_flushes))
+        slots.acquire()
+        future = self._executor.submit(self._flush_batch, namespace, batch)
+        future.add_done_callback(lambda _: slots.release())
+        with self._lock:
+            self._flushes = [flush for flush in self._flushes if not flush.done()]
+            self._flushes.append(future)
+
+    def _flush_batch(self, namespace, batch):
+        """Upserts a batch, retrying transient failures, and settles its tickets."""
+        records = [record for record, _ in batch.entries]
+        try:
+            logging.debug(f"Upserting {len(records)} records ({batch.size} bytes) into namespace {namespace}")
+            with metrics.timer("pinecone_upsert_seconds"):
+                scheduled_call(
+                    "pinecone_upsert",
+                    self.index.upsert_records,
+                    namespace=namespace,
+                    records=records,
+                    max_attempts=self.max_retries + 1,
+                    backoff_seconds=self.backoff_seconds,
+                )
+            metrics.observe("pinecone_upsert_batch_records", len(records), buckets=metrics.SIZE_BUCKETS)
+            metrics.observe("pinecone_upsert_batch_bytes", batch.size, buckets=metrics.SIZE_BUCKETS)
+            error = None
+        except Exception as e:
+            logging.error(f"Failed to upsert {len(records)} records into namespace {namespace}: {e}")
+            metrics.increment("pinecone_upsert_failed_records", len(records))
+            error = e
+
+        for ticket, ticket_records in batch.records_by_ticket().items():
+            record_ids = [record["_id"] for record in ticket_records]
+            if error is not None:
+                ticket._settle([], record_ids, error)
+                continue
+            if self.on_batch_written is not None:
+                try:
+                    self.on_batch_written(namespace, ticket, ticket_records)
+                except Exception as e:
+                    logging.error(f"Batch callback failed for namespace {namespace}: {e}")
+            ticket._settle(record_ids, [])
+
+
+class _Batch:
+    """Records waiting to be sent in one request, with the tickets they belong to."""
+
+    def __init__(self):
+        self.entries = []
+        self.size = 0
+
+    def add(self, record, size, ticket):
+        self.entries.append((record, ticket))
+        self.size += size
+
+    def records_by_ticket(self):
+        records = {}
+        for record, ticket in self.entries:
+            records.setdefault(ticket, []).append(record)
+        return records
+
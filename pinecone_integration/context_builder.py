@@ -0,0 +1,203 @@
+"""
+Packs search hits into the context of the LLM prompt.
+---
+- Hits are selected by relevance with diversity (maximal marginal
+  relevance on word overlap), so near-duplicate chunks do not crowd out
+  other sources.
+- Selected hits are added while they fit in a token budget, counted with
+  tiktoken, which is only imported when the first context is built. If
+  its encoding cannot be loaded, tokens are estimated from the length.
+- Adjacent chunks of the same file are merged, dropping the characters
+  the chunker repeated between them.
+- Every passage gets a compact source label, e.g. "[1] report.pdf #3-4".
+"""
+import logging
+import config
+from pinecone_integration.pinecone_client import CHUNK_OVERLAP
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("pinecone")
+
+CONTEXT_TOKEN_BUDGET = getattr(config, "CONTEXT_TOKEN_BUDGET", 1500)
+# 1.0 selects by relevance only, lower values favor diversity
+CONTEXT_MMR_LAMBDA = getattr(config, "CONTEXT_MMR_LAMBDA", 0.7)
+# Hits with a higher word overlap with an already selected hit are dropped
+CONTEXT_DUPLICATE_SIMILARITY = getattr(config, "CONTEXT_DUPLICATE_SIMILARITY", 0.9)
+
+# The tiktoken encoding, loaded on first use, False when it could not be loaded
+_encoding = None
+
+
+def _get_encoding():
+    global _encoding  # pylint: disable=global-statement
+    if _encoding is None:
+        try:
+            import tiktoken  # pylint: disable=import-outside-toplevel
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # Missing package, or no network to download the encoding file
+            logging.warning(f"Could not load the tiktoken encoding, estimating the tokens instead: {e}")
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text):
+    """
+    Counts the tokens of a text for the prompt budget.
+
+    Uses the cl100k_base encoding of tiktoken, and falls back to an
+    estimate of 4 characters per token if the encoding cannot be loaded.
+
+    Parameters:
+    - text: The text to count.
+
+    Returns:
+    - The number of tokens.
+    """
+    encoding = _get_encoding()
+    if not encoding:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def word_similarity(words, other_words):
+    """Jaccard similarity of two sets of words."""
+    if not words or not other_words:
+        return 0.0
+    return len(words & other_words) / len(words | other_words)
+
+
+def select_hits(hits, mmr_lambda=CONTEXT_MMR_LAMBDA, duplicate_similarity=CONTEXT_DUPLICATE_SIMILARITY):
+    """
+    Orders hits by maximal marginal relevance.
+
+    The relevance of a hit is given by its rank in the (reranked) search
+    results, its redundancy by its highest word overlap with the hits
+    selected before it.
+
+    Parameters:
+    - hits: The search hits, best first, each with the "chunk_text" in its "fields".
+    - mmr_lambda: The weight of relevance against diversity (default is CONTEXT_MMR_LAMBDA).
+    - duplicate_similarity: The overlap above which a hit is dropped (default is CONTEXT_DUPLICATE_SIMILARITY).
+
+    Returns:
+    - The hits in selection order, without near duplicates.
+    """
+    candidates = [
+        (1.0 - rank / len(hits), set(hit['fields'].get('chunk_text', '').lower().split()), hit)
+        for rank, hit in enumerate(hits)
+    ]
+    selected = []
+    selected_words = []
+    while candidates:
+        best = None
+        for position, (relevance, words, hit) in enumerate(candidates):
+            redundancy = max((word_similarity(words, other) for other in selected_words), default=0.0)
+            score = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+            if best is None or score > best[0]:
+                best = (score, position, redundancy)
+        _, position, redundancy = best
+        _, words, hit = candidates.pop(position)
+        if redundancy >= duplicate_similarity:
+            logging.debug("Dropping near duplicate hit")
+            continue
+        selected.append(hit)
+        selected_words.append(words)
+    return selected
+
+
+def merge_adjacent_chunks(hits, overlap=CHUNK_OVERLAP):
+    """
+    Groups hits into passages, merging consecutive chunks of the same file.
+
+    The chunker repeats the last overlap characters of a chunk at the start
+    of the next one. They are only dropped after checking the texts match,
+    and chunks are only merged when they do: an unchanged chunk keeps the
+    position it was written with, so after an edit two consecutive chunk
+    IDs are not necessarily neighbours in the current text.
+
+    Parameters:
+    - hits: The hits to merge, with "file_id", "chunk_id" and "chunk_text" in their "fields".
+    - overlap: The number of characters repeated between chunks (default is CHUNK_OVERLAP).
+
+    Returns:
+    - A list of passages, dictionaries with the "file_id", "file_name", "chunk_ids" and "text",
+      in the order of the first hit of each passage.
+    """
+    ranked = []
+    by_file = {}
+    for position, hit in enumerate(hits):
+        fields = hit['fields']
+        file_id = fields.get('file_id')
+        if file_id is None or fields.get('chunk_id') is None:
+            ranked.append((position, {"file_id": file_id, "file_name": fields.get('file_name'),
+                                      "chunk_ids": [], "text": fields.get('chunk_text', '')}))
+            continue
+        by_file.setdefault(file_id, []).append((int(fields['chunk_id']), position, fields))
+
+    for file_id, chunks in by_file.items():
+        chunks.sort(key=lambda chunk: chunk[0])
+        passage = None
+        for chunk_id, position, fields in chunks:
+            text = fields.get('chunk_text', '')
+            adjacent = passage is not None and passage["chunk_ids"][-1] + 1 == chunk_id
+            if adjacent and overlap:
+                adjacent = passage["text"][-overlap:] == text[:overlap]
+            if adjacent:
+                passage["text"] += text[overlap:]
+                passage["chunk_ids"].append(chunk_id)
+                rank = min(rank, position)
+                ranked[-1] = (rank, passage)
+                continue
+            passage = {"file_id": file_id, "file_name": fields.get('file_name'), "chunk_ids": [chunk_id], "text": text}
+            rank = position
+            ranked.append((rank, passage))
+
+    # A passage comes where its best hit was selected
+    ranked.sort(key=lambda entry: entry[0])
+    return [passage for _, passage in ranked]
+
+
+def source_label(number, passage):
+    """Returns the compact label of a passage, e.g. "[1] report.pdf #3-4"."""
+    label = f"[{number}] {passage['file_name'] or passage['file_id'] or 'unknown'}"
+    chunk_ids = passage["chunk_ids"]
+    if chunk_ids:
+        label += f" #{chunk_ids[0]}" if len(chunk_ids) == 1 else f" #{chunk_ids[0]}-{chunk_ids[-1]}"
+    return label
+
+
+def build_context(hits, token_budget=CONTEXT_TOKEN_BUDGET, mmr_lambda=CONTEXT_MMR_LAMBDA, overlap=CHUNK_OVERLAP):
+    """
+    Builds the prompt context from search hits.
+
+    Parameters:
+    - hits: The search hits, best first.
+    - token_budget: The maximum number of context tokens (default is CONTEXT_TOKEN_BUDGET).
+    - mmr_lambda: The weight of relevance against diversity (default is CONTEXT_MMR_LAMBDA).
+    - overlap: The number of characters repeated between chunks (default is CHUNK_OVERLAP).
+
+    Returns:
+    - A tuple of the context text and the list of source labels.
+    """
+    hits = list(hits)
+    packed = []
+    used_tokens = 0
+    for hit in select_hits(hits, mmr_lambda=mmr_lambda):
+        tokens = count_tokens(hit['fields'].get('chunk_text', ''))
+        if used_tokens + tokens > token_budget:
+            # A smaller hit further down may still fit
+            continue
+        packed.append(hit)
+        used_tokens += tokens
+
+    blocks = []
+    labels = []
+    for number, passage in enumerate(merge_adjacent_chunks(packed, overlap=overlap), start=1):
+        label = source_label(number, passage)
+        labels.append(label)
+        blocks.append(f"{label}\n{passage['text']}")
+    context = "\n\n".join(blocks)
+    logging.debug(f"Packed {len(packed)} of {len(hits)} hits into {used_tokens} tokens")
+    return context, labels
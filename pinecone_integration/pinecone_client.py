@@ -1,24 +1,50 @@
 import config
-from pinecone import (
-    Pinecone,
-    CloudProvider,
-    AwsRegion,
-    EmbedModel,
-    IndexEmbed
-)
+import hashlib
+import re
+import threading
+import zlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from common import metrics
+from common.rate_limiter import scheduled_call
 
 log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
 logging.basicConfig(level=log_level)
 logging.getLogger("pinecone")
 
+# Concurrent requests updating the fields of stored records
+UPDATE_WORKERS = getattr(config, "PINECONE_UPDATE_WORKERS", 8)
+
+# Chunking used for the records of a file
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 100
+
+# Content-defined chunking: past CHUNK_MIN_SIZE characters, a chunk ends at a
+# sentence end whose preceding text hashes to a multiple of the divisor, so an
+# edit only moves the boundaries around it and the other chunks keep their text
+CHUNK_MIN_SIZE = getattr(config, "CHUNK_MIN_SIZE", CHUNK_SIZE // 2)
+CHUNK_BOUNDARY_DIVISOR = getattr(config, "CHUNK_BOUNDARY_DIVISOR", 6)
+# Characters before a sentence end hashed to decide on a boundary
+_BOUNDARY_WINDOW = 32
+_SENTENCE_END = re.compile(r"[.!?][\"')\]]* ")
+# Text without a selected sentence end, e.g. tables or lists, ends at one word boundary in this many
+_WORD_BOUNDARY_DIVISOR = 32
+
+# The index of get_pinecone_index, created on first use
+_index = None
+_index_lock = threading.Lock()
+
 def initialize_pinecone_client():
     """
     Initializes and returns a Pinecone client using the API key from the configuration.
 
+    The pinecone SDK is imported here, on first use, so commands that do not reach Pinecone start faster.
+
     Returns:
     - A Pinecone client instance.
     """
+    from pinecone import Pinecone  # pylint: disable=import-outside-toplevel
+
     logging.info("Initializing Pinecone client")
     pinecone = Pinecone(
         api_key=config.PINECONE_API_KEY, 
@@ -32,9 +58,21 @@ def get_pinecone_index():
     """
     Retrieves or creates a Pinecone index based on the configuration.
 
+    The index is looked up once per process, later calls return the same instance and its connection pool.
+
     Returns:
     - A Pinecone index instance.
     """
+    global _index  # pylint: disable=global-statement
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = _connect_index()
+    return _index
+
+
+def _connect_index():
+    """Checks that the index of the configuration exists, creating it if needed, and connects to it."""
     pinecone_client = initialize_pinecone_client()
     index_name = config.PINECONE_INDEX or "box-integration-example"
     logging.info(f"Checking if index {index_name} exists")
@@ -59,6 +97,8 @@ def create_index(client, index_name):
     - client: The Pinecone client used to create the index.
     - index_name: The name of the index to create.
     """
+    from pinecone import AwsRegion, CloudProvider, EmbedModel, IndexEmbed  # pylint: disable=import-outside-toplevel
+
     client.create_index_for_model(
         name=index_name,
         cloud=CloudProvider.AWS,
@@ -98,66 +138,312 @@ def chunk_text(text, chunk_size=4000, overlap=200):
     return chunks
 
 
-def store_metadata_in_pinecone(index, file_id, combined_text, box_user_id, upsert_batch_size=96):
+def _segment_end(text, start, min_size, max_size):
     """
-    Stores metadata and chunked text in the Pinecone index.
+    Returns where the segment starting at start ends, looking at most max_size characters ahead.
+
+    The end is the first sentence end past min_size selected by its hash,
+    otherwise the first word boundary selected by its hash, otherwise the
+    last sentence end or space before max_size.
+    """
+    limit = start + max_size
+
+    def selected(end, divisor):
+        return zlib.crc32(text[end - _BOUNDARY_WINDOW:end].encode("utf-8")) % divisor == 0
+
+    last_end = None
+    for match in _SENTENCE_END.finditer(text, start + min_size, limit):
+        last_end = match.end()
+        if selected(last_end, CHUNK_BOUNDARY_DIVISOR):
+            return last_end
+    space = text.find(" ", start + min_size, limit)
+    while space >= 0:
+        if selected(space + 1, _WORD_BOUNDARY_DIVISOR):
+            return space + 1
+        space = text.find(" ", space + 1, limit)
+    if last_end is not None:
+        return last_end
+    space = text.rfind(" ", start + min_size, limit)
+    return space + 1 if space >= 0 else limit
+
+
+def iter_content_defined_chunks(pieces, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP, min_size=CHUNK_MIN_SIZE):
+    """
+    Splits text arriving in pieces into content-defined chunks with overlap.
+
+    Chunk boundaries depend on the text around them, not on their offset in
+    the document: inserting or deleting text only changes the chunks around
+    the edit. Every chunk starts with the last overlap characters of the
+    previous one and is at most chunk_size characters long. Only the current
+    chunk is kept in memory, and the chunks do not depend on how the text is
+    split into pieces.
+
+    Parameters:
+    - pieces: An iterable of text pieces.
+    - chunk_size: The maximum size of a chunk, overlap included (default is CHUNK_SIZE).
+    - overlap: The number of characters repeated from the previous chunk (default is CHUNK_OVERLAP).
+    - min_size: The minimum size of a chunk, overlap excluded (default is CHUNK_MIN_SIZE).
+
+    Returns:
+    - A generator of text chunks.
+    """
+    max_size = chunk_size - overlap
+    min_size = min(min_size, max_size)
+    buffer = ""
+    tail = ""
+    count = 0
+    for piece in pieces:
+        buffer += piece
+        start = 0
+        while len(buffer) - start >= max_size:
+            end = _segment_end(buffer, start, min_size, max_size)
+            chunk = tail + buffer[start:end]
+            yield chunk
+            count += 1
+            tail = chunk[-overlap:] if overlap else ""
+            start = end
+        # Keep only the text that does not make a complete chunk yet
+        buffer = buffer[start:]
+    if buffer:
+        yield tail + buffer
+        count += 1
+    if not count:
+        logging.error("No text to chunk")
+    logging.debug(f"Chunks: {count}")
+
+
+def chunk_hash(chunk, file_name=None):
+    """
+    Returns the content hash of a chunk, which also names its record.
+
+    The file name is hashed with the text, so the chunks of a renamed file
+    are written again with the name they are cited with.
+
+    Parameters:
+    - chunk: The text of the chunk.
+    - file_name: The name of the file the chunk belongs to (default is None).
+
+    Returns:
+    - A hex digest.
+    """
+    return hashlib.sha256(f"{file_name or ''}\0{chunk}".encode("utf-8")).hexdigest()
+
+
+def _chunk_record(file_id, i, chunk, combined_text, box_user_id):
+    """
+    Builds the record of a single chunk.
+
+    The record ID is derived from the content hash, so an unchanged chunk
+    keeps its ID when the file is indexed again.
+    """
+    logging.debug(f"Processing chunk {i}")
+    content_hash = chunk_hash(chunk, combined_text.get("file_name"))
+    # Store the chunk text in metadata
+    minimal_metadata = {
+        "chunk_id": i, 
+        "chunk_hash": content_hash,
+        "file_id": file_id, 
+        "file_name": combined_text.get("file_name"), 
+        "created_at": combined_text.get("created_at"), 
+        "modified_at": combined_text.get("modified_at"), 
+        "size": combined_text.get("size", 0),
+        "box_user_id": box_user_id,
+        "chunk_text": chunk  # Store the chunk text as part of the metadata
+    }
+    return {
+        "_id": f"{file_id}_chunk_{content_hash[:16]}", 
+        **minimal_metadata
+    }
+
+
+def _unique_records(records):
+    """
+    Drops the records repeating an earlier chunk of the same file, they would share its ID.
+
+    The records kept are numbered again, so the chunk_id of a record is its
+    position in the IDs of the file recorded in the manifest.
+    """
+    seen_ids = set()
+    for record in records:
+        if record["_id"] not in seen_ids:
+            record["chunk_id"] = len(seen_ids)
+            seen_ids.add(record["_id"])
+            yield record
+
+
+def build_chunk_records(file_id, combined_text, box_user_id):
+    """
+    Chunks the text of a file and builds the Pinecone records for it.
 
     Parameters:
-    - index: The Pinecone index to store the data in.
     - file_id: The ID of the file being processed.
     - combined_text: A dictionary containing the text and metadata to store.
     - box_user_id: The namespace identifier for the Box user.
-    - upsert_batch_size: The number of records to upsert in a single batch (default is 96).
-    """
-    if not index:
-        logging.error("Pinecone index not initialized")
-        exit(1)
 
+    Returns:
+    - A list of records ready to be upserted, or an empty list if there is no text.
+    """
     # Ensure combined_text["text"] is not None
     text_content = combined_text.get("text")
     if text_content is None:
         logging.error(f"No text representation available for file ID: {file_id}")
-        return
+        return []
 
-    # Chunk the text with overlap
+    # Chunk the text with overlap, at content-defined boundaries
     logging.info(f"Chunking text for file ID: {file_id}")
-    text_chunks = chunk_text(text_content, chunk_size=2000, overlap=100)
+    text_chunks = list(iter_content_defined_chunks([text_content]))
     logging.info(f"Chunked text into {len(text_chunks)} chunks")
 
-    records = []
-    for i, chunk in enumerate(text_chunks):
-        logging.debug(f"Processing chunk {i}")
-        # Store the chunk text in metadata
-        minimal_metadata = {
-            "chunk_id": i, 
-            "file_id": file_id, 
-            "file_name": combined_text.get("file_name"), 
-            "created_at": combined_text.get("created_at"), 
-            "modified_at": combined_text.get("modified_at"), 
-            "size": combined_text.get("size", 0),
-            "box_user_id": box_user_id,
-            "chunk_text": chunk  # Store the chunk text as part of the metadata
-        }
-        if len(records) < upsert_batch_size:
-            logging.debug(f"Adding record {file_id}_chunk_{i} to records list")
-            records.append(
-                {
-                    "_id": f"{file_id}_chunk_{i}", 
-                    **minimal_metadata
-                }
-            )
-        else:
-            logging.debug(f"Upserting {len(records)} records")
-            index.upsert_records(
-            namespace=box_user_id,
-            records=records,
-        )
-            records = []
-
-    # Upsert the remaining records
-    if records:
-        logging.debug(f"Upserting {len(records)} records")
-        index.upsert_records(
-            namespace=box_user_id,
-            records=records,
-        )
\ No newline at end of file
+    return records_from_chunks(file_id, text_chunks, combined_text, box_user_id)
+
+
+def records_from_chunks(file_id, text_chunks, metadata, box_user_id):
+    """
+    Builds the Pinecone records of text already chunked.
+
+    Parameters:
+    - file_id: The ID of the file being processed.
+    - text_chunks: The chunks of the text, in order.
+    - metadata: A dictionary containing the metadata to store.
+    - box_user_id: The namespace identifier for the Box user.
+
+    Returns:
+    - A list of records ready to be upserted.
+    """
+    return list(_unique_records(
+        _chunk_record(file_id, i, chunk, metadata, box_user_id)
+        for i, chunk in enumerate(text_chunks)
+    ))
+
+
+def iter_chunk_records(file_id, text_pieces, metadata, box_user_id):
+    """
+    Chunks text arriving in pieces and yields the Pinecone records as soon as each chunk is complete.
+
+    Parameters:
+    - file_id: The ID of the file being processed.
+    - text_pieces: An iterable of text pieces, e.g. a streamed representation.
+    - metadata: A dictionary containing the metadata to store.
+    - box_user_id: The namespace identifier for the Box user.
+
+    Returns:
+    - A generator of records ready to be upserted.
+    """
+    logging.info(f"Chunking streamed text for file ID: {file_id}")
+    text_chunks = iter_content_defined_chunks(text_pieces)
+    yield from _unique_records(
+        _chunk_record(file_id, i, chunk, metadata, box_user_id) for i, chunk in enumerate(text_chunks)
+    )
+
+
+def upsert_chunk_records(index, records, box_user_id, upsert_batch_size=96):
+    """
+    Upserts records into the Pinecone index in batches.
+
+    Parameters:
+    - index: The Pinecone index to store the data in.
+    - records: An iterable of records to upsert, consumed lazily.
+    - box_user_id: The namespace identifier for the Box user.
+    - upsert_batch_size: The number of records to upsert in a single batch (default is 96).
+
+    Returns:
+    - The IDs of the upserted records.
+    """
+    written_ids = []
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == upsert_batch_size:
+            logging.debug(f"Upserting {len(batch)} records")
+            with metrics.timer("pinecone_upsert_seconds"):
+                scheduled_call("pinecone_upsert", index.upsert_records, namespace=box_user_id, records=batch)
+            metrics.observe("pinecone_upsert_batch_records", len(batch), buckets=metrics.SIZE_BUCKETS)
+            written_ids.extend(record["_id"] for record in batch)
+            batch = []
+    if batch:
+        logging.debug(f"Upserting {len(batch)} records")
+        with metrics.timer("pinecone_upsert_seconds"):
+            scheduled_call("pinecone_upsert", index.upsert_records, namespace=box_user_id, records=batch)
+        metrics.observe("pinecone_upsert_batch_records", len(batch), buckets=metrics.SIZE_BUCKETS)
+        written_ids.extend(record["_id"] for record in batch)
+    return written_ids
+
+
+def delete_chunk_records(index, record_ids, box_user_id, delete_batch_size=1000):
+    """
+    Deletes records from the Pinecone index in batches.
+
+    Parameters:
+    - index: The Pinecone index to delete the records from.
+    - record_ids: The IDs of the records to delete.
+    - box_user_id: The namespace identifier for the Box user.
+    - delete_batch_size: The number of IDs to delete in a single request (default is 1000).
+    """
+    record_ids = list(record_ids)
+    for start in range(0, len(record_ids), delete_batch_size):
+        batch = record_ids[start:start + delete_batch_size]
+        logging.debug(f"Deleting {len(batch)} records")
+        scheduled_call("pinecone_data", index.delete, ids=batch, namespace=box_user_id)
+
+
+def update_chunk_metadata(index, updates, box_user_id, max_workers=UPDATE_WORKERS):
+    """
+    Sets fields of stored records in parallel, without embedding their text again.
+
+    Pinecone updates one record per request, the requests are limited by the scheduler.
+
+    Parameters:
+    - index: The Pinecone index the records are stored in.
+    - updates: A dictionary of the fields to set, by record ID.
+    - box_user_id: The namespace identifier for the Box user.
+    - max_workers: The number of concurrent update requests (default is UPDATE_WORKERS).
+    """
+    def update(item):
+        record_id, fields = item
+        scheduled_call("pinecone_data", index.update, id=record_id, set_metadata=fields, namespace=box_user_id)
+
+    if len(updates) == 1:
+        update(next(iter(updates.items())))
+        return
+    workers = min(max_workers, len(updates))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pinecone-update") as executor:
+        # Raises the first error once all updates are done
+        list(executor.map(update, updates.items()))
+
+
+def list_file_record_ids(index, file_id, box_user_id):
+    """
+    Lists the IDs of all records stored for a file.
+
+    Parameters:
+    - index: The Pinecone index to search in.
+    - file_id: The ID of the file.
+    - box_user_id: The namespace identifier for the Box user.
+
+    Returns:
+    - A list of record IDs.
+    """
+    def list_ids():
+        # Pages are fetched lazily, a retry lists again from the start
+        return [record_id for ids in index.list(prefix=f"{file_id}_chunk_", namespace=box_user_id) for record_id in ids]
+
+    return scheduled_call("pinecone_data", list_ids)
+
+
+def store_metadata_in_pinecone(index, file_id, combined_text, box_user_id, upsert_batch_size=96):
+    """
+    Stores metadata and chunked text in the Pinecone index.
+
+    Parameters:
+    - index: The Pinecone index to store the data in.
+    - file_id: The ID of the file being processed.
+    - combined_text: A dictionary containing the text and metadata to store.
+    - box_user_id: The namespace identifier for the Box user.
+    - upsert_batch_size: The number of records to upsert in a single batch (default is 96).
+    """
+    if not index:
+        logging.error("Pinecone index not initialized")
+        exit(1)
+
+    records = build_chunk_records(file_id, combined_text, box_user_id)
+    upsert_chunk_records(index, records, box_user_id, upsert_batch_size)
@@ -0,0 +1,244 @@
+"""
+Caches query results and answers.
+---
+Two layers: an in-process LRU in front of an optional SQLite store that
+survives restarts. Entries are keyed by namespace, normalized query text,
+top_k and the rerank config, and expire after a TTL.
+
+Every namespace has a version number, stored next to the entries. The
+ingestion path bumps it whenever it writes to the namespace (possibly from
+another process), and an entry cached under an older version is treated
+as a miss.
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import config
+from common import metrics
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("pinecone")
+
+QUERY_CACHE_ENABLED = getattr(config, "QUERY_CACHE_ENABLED", True)
+QUERY_CACHE_SIZE = getattr(config, "QUERY_CACHE_SIZE", 256)
+QUERY_CACHE_TTL_SECONDS = getattr(config, "QUERY_CACHE_TTL_SECONDS", 3600)
+# None keeps the cache in memory only
+QUERY_CACHE_PATH = getattr(config, "QUERY_CACHE_PATH", ".query_cache.sqlite")
+# During a long ingestion run, the namespaces written to are invalidated at most this often
+QUERY_CACHE_INVALIDATE_SECONDS = getattr(config, "QUERY_CACHE_INVALIDATE_SECONDS", 300)
+
+_TRAILING_PUNCTUATION = "?!.,;: "
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        namespace TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        value TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS namespace_versions (
+        namespace TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    )
+    """,
+)
+
+
+def normalize_query(query_text):
+    """
+    Normalizes a query so trivially different phrasings share a cache entry.
+
+    Case, runs of whitespace and trailing punctuation are ignored.
+
+    Parameters:
+    - query_text: The text of the query.
+
+    Returns:
+    - The normalized query text.
+    """
+    return " ".join(query_text.lower().split()).rstrip(_TRAILING_PUNCTUATION)
+
+
+def cache_key(kind, namespace, query_text, **params):
+    """
+    Builds the cache key of a query.
+
+    Parameters:
+    - kind: What is cached, e.g. "search" or "answer".
+    - namespace: The Pinecone namespace the query runs in.
+    - query_text: The text of the query, normalized here.
+    - params: Everything else the result depends on, e.g. top_k and the rerank config.
+
+    Returns:
+    - A hex digest.
+    """
+    payload = json.dumps([kind, namespace, normalize_query(query_text), params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _connect(path):
+    """Opens the SQLite store, creating its tables."""
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    for statement in _SCHEMA:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+
+def invalidate_namespace(namespace, path=QUERY_CACHE_PATH):
+    """
+    Invalidates the cached queries of a namespace in the SQLite store.
+
+    Called by the ingestion path once it finished writing to a namespace. Does nothing
+    when the cache has no SQLite store.
+
+    Parameters:
+    - namespace: The Pinecone namespace that changed.
+    - path: The path of the SQLite store (default is QUERY_CACHE_PATH).
+    """
+    if not QUERY_CACHE_ENABLED or not path:
+        return
+    connection = _connect(path)
+    try:
+        _bump_version(connection, namespace)
+    finally:
+        connection.close()
+
+
+def _bump_version(connection, namespace):
+    with connection:
+        connection.execute(
+            """
+            INSERT INTO namespace_versions VALUES (?, 1)
+            ON CONFLICT(namespace) DO UPDATE SET version = version + 1
+            """,
+            (namespace,),
+        )
+        connection.execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+
+
+class QueryCache:
+    """
+    LRU cache of query results with a TTL and an optional SQLite store. Safe to share between threads.
+
+    Parameters:
+    - max_entries: The number of entries kept in memory (default is QUERY_CACHE_SIZE).
+    - ttl_seconds: The lifetime of an entry (default is QUERY_CACHE_TTL_SECONDS).
+    - path: The path of the SQLite store, or None for memory only (default is QUERY_CACHE_PATH).
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, ttl_seconds=QUERY_CACHE_TTL_SECONDS, path=QUERY_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._connection = _connect(path) if path else None
+
+    def get(self, key, namespace):
+        """
+        Looks up an entry.
+
+        Parameters:
+        - key: The cache key, see cache_key.
+        - namespace: The namespace of the entry.
+
+        Returns:
+        - The cached value, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            version = self._namespace_version(namespace)
+            entry = self._entries.get(key)
+            if entry is None and self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT version, value, created_at FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = (row[0], json.loads(row[1]), row[2])
+                    self._remember(key, entry)
+            if entry is None or entry[0] != version or now - entry[2] > self.ttl_seconds:
+                if entry is not None:
+                    self._forget(key)
+                self.misses += 1
+                metrics.increment("query_cache_requests", result="miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.increment("query_cache_requests", result="hit")
+            return entry[1]
+
+    def put(self, key, namespace, value):
+        """
+        Stores an entry.
+
+        Parameters:
+        - key: The cache key, see cache_key.
+        - namespace: The namespace of the entry.
+        - value: A JSON serializable value.
+        """
+        now = time.time()
+        with self._lock:
+            entry = (self._namespace_version(namespace), value, now)
+            self._remember(key, entry)
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                        (key, namespace, entry[0], json.dumps(value), now),
+                    )
+                    self._connection.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl_seconds,))
+
+    def invalidate(self, namespace):
+        """
+        Invalidates all entries of a namespace, in memory and in the SQLite store.
+
+        Parameters:
+        - namespace: The namespace that changed.
+        """
+        with self._lock:
+            if self._connection is not None:
+                _bump_version(self._connection, namespace)
+            else:
+                self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+    def close(self):
+        """Closes the SQLite store."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+        logging.debug(f"Query cache closed: {self.hits} hits, {self.misses} misses")
+
+    def _namespace_version(self, namespace):
+        """The current version of a namespace, read from the store so other processes can bump it."""
+        if self._connection is None:
+            return self._versions.get(namespace, 0)
+        row = self._connection.execute(
+            "SELECT version FROM namespace_versions WHERE namespace = ?", (namespace,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _forget(self, key):
+        self._entries.pop(key, None)
+        if self._connection is not None:
+            with self._connection:
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
@@ -1,10 +1,20 @@
 import config
-from pinecone import Pinecone
 import logging
+from pinecone_integration.query_cache import cache_key
+from common import metrics
+from common.rate_limiter import scheduled_call
 
 logging.getLogger("pinecone")
 
+# Reranking of the search results, part of the query cache key
+RERANK_MODEL = "cohere-rerank-3.5"
+RERANK_FIELDS = ["chunk_text"]
+# The context builder merges adjacent chunks of a file and labels them with the file name
+SEARCH_FIELDS = ["chunk_text", "file_id", "chunk_id", "file_name"]
+
 def initialize_pinecone_client():
+    from pinecone import Pinecone  # pylint: disable=import-outside-toplevel
+
     pinecone = Pinecone(
         api_key=config.PINECONE_API_KEY, 
         source_tag="box_pinecone_integration"
@@ -39,18 +49,67 @@ def query_pinecone(index, query_text, box_user_id, top_k=50):
     - A list of query results from the Pinecone index, including the top_k results based on the query text.
     """
     logging.info(f"Querying Pinecone with query: {query_text}")
-    query_results = index.search(
-        namespace=box_user_id,
-        query={
-            "inputs": {"text": query_text},
-            "top_k": top_k,
-        },
-        fields=["chunk_text"],
-        rerank={
-            "model": "cohere-rerank-3.5",
-            "top_n": int(top_k/2),
-            "rank_fields": ["chunk_text"]
-        }
-    )
+    rerank = rerank_config(top_k)
+    # The integrated reranking runs within the search request, both are timed and scheduled together
+    with metrics.timer("pinecone_search_seconds", rerank=RERANK_MODEL):
+        query_results = scheduled_call(
+            "pinecone_rerank" if rerank else "pinecone_search",
+            index.search,
+            namespace=box_user_id,
+            query={
+                "inputs": {"text": query_text},
+                "top_k": top_k,
+            },
+            fields=SEARCH_FIELDS,
+            rerank=rerank
+        )
     
     return query_results
+
+def rerank_config(top_k):
+    """
+    Returns the rerank parameters of a search for the top_k results.
+    """
+    return {
+        "model": RERANK_MODEL,
+        "top_n": int(top_k/2),
+        "rank_fields": RERANK_FIELDS
+    }
+
+def search_cache_key(query_text, box_user_id, top_k):
+    """
+    Returns the query cache key of a search, see query_cache.cache_key.
+    """
+    return cache_key("search", box_user_id, query_text, top_k=top_k, fields=SEARCH_FIELDS, rerank=rerank_config(top_k))
+
+def cached_query_pinecone(index, query_text, box_user_id, top_k=50, cache=None):
+    """
+    Same as query_pinecone, answering repeated queries from a QueryCache.
+
+    Parameters:
+    - index: The Pinecone index to search in.
+    - query_text: The text of the query to search for in the index.
+    - box_user_id: The namespace identifier for the Box user, used to scope the search.
+    - top_k: The number of top results to retrieve from the index (default is 50).
+    - cache: Optional QueryCache (default is no caching).
+
+    Returns:
+    - The query results as a dictionary, with the hits under ['result']['hits'].
+    """
+    if cache is None:
+        return search_results_to_dict(query_pinecone(index, query_text, box_user_id, top_k=top_k))
+    key = search_cache_key(query_text, box_user_id, top_k)
+    results = cache.get(key, box_user_id)
+    if results is None:
+        results = search_results_to_dict(query_pinecone(index, query_text, box_user_id, top_k=top_k))
+        cache.put(key, box_user_id, results)
+    else:
+        logging.info(f"Query cache hit for query: {query_text}")
+    return results
+
+def search_results_to_dict(query_results):
+    """
+    Converts search results into plain, JSON serializable dictionaries.
+    """
+    hits = [{"fields": dict(hit['fields'])} for hit in query_results['result']['hits']]
+    return {"result": {"hits": hits}}
@@ -1,21 +1,73 @@
+import argparse
 import config
-from openai import OpenAI
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.request
 from box_integration.box_client import get_client
 from datetime import datetime
-from pinecone_integration.query_utils import query_pinecone
+from pinecone_integration.query_utils import cached_query_pinecone, rerank_config
+from pinecone_integration.query_cache import QueryCache, QUERY_CACHE_ENABLED, cache_key
 from pinecone_integration.pinecone_client import get_pinecone_index
+from pinecone_integration.context_builder import build_context, CONTEXT_TOKEN_BUDGET
+from common import metrics
+from common.rate_limiter import scheduled_call
 
+OPENAI_MODEL = "gpt-4"
+QUERY_TOP_K = getattr(config, "QUERY_TOP_K", 10)
+# Query server answering the questions, see query_server.py, None to answer them in this process
+QUERY_SERVER_URL = getattr(config, "QUERY_SERVER_URL", None)
+QUERY_SERVER_TOKEN = getattr(config, "QUERY_SERVER_TOKEN", None)
 
-def initialize_openai():
+
+def initialize_openai(warm_up=True):
     """
     Initializes and returns an OpenAI client using the API key from the configuration.
 
+    Throttled requests are retried by the request scheduler, not by the client. The openai
+    package is imported here, the thin client of a query server never loads it.
+
+    Parameters:
+    - warm_up: Open a connection to the OpenAI API in the background, once (default is True).
+
     Returns:
     - An OpenAI client instance.
     """
-    client = OpenAI(api_key=config.OPENAI_API_KEY)
+    from openai import OpenAI  # pylint: disable=import-outside-toplevel
+
+    client = OpenAI(api_key=config.OPENAI_API_KEY, max_retries=0)
+    if warm_up:
+        threading.Thread(target=warm_up_openai, args=(client,), daemon=True).start()
     return client
 
+def build_messages(query_text, context):
+    """
+    Builds the chat messages asking to answer a question from the context.
+
+    Parameters:
+    - query_text: The question or query to be answered.
+    - context: The context or background information to be used for generating the answer.
+
+    Returns:
+    - A list of chat messages.
+    """
+    current_date = datetime.now().strftime("%Y-%m-%d")
+    # Each instruction is sent once
+    system_prompt = (
+        "You are a helpful assistant. "
+        "Answer the question using the provided context, considering synonymous or related terms when "
+        "identifying entities and the temporal context. "
+        f"The current date is {current_date}. "
+        "The context is made of passages labeled with their source, e.g. [1]. "
+        "Keep your answer concise and to the point, in a professional yet friendly tone, without emojis."
+    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {query_text}"},
+    ]
+
 def query_openai_for_answer(openai_client, query_text, context):
     """
     Queries OpenAI's API to generate an answer based on the provided query text and context.
@@ -28,47 +80,173 @@ def query_openai_for_answer(openai_client, query_text, context):
     Returns:
     - The generated answer as a string.
     """
-    current_date = datetime.now().strftime("%Y-%m-%d")
-    messages=[
-        {"role": "system", "content": f"""
-        You are a helpful assistant. 
-        Use the provided context to answer the question. Focus on answering the question based on the context provided.
-        Consider synonymous or related terms when identifying entities. 
-        The current date is {current_date}.
-        The user is requesting information about the context provided.
-        Keep your answer concise and to the point.
-        Keep your tone professional and avoid using emojis.
-        Make sure to answer the question in a friendly and engaging tone.
-        """,
-        },
-        {"role": "user", "content": f"Context: {context}\n"},
-        {"role": "user", "content": f"""
-        Question: {query_text}. 
-        Please use the above context to answer, considering synonymous or related terms and the temporal context.
-        Focus on answering the question based on the context provided.
-        Keep your answer concise and to the point.
-        Keep your tone professional and avoid using emojis.
-        Make sure to answer the question in a friendly and engaging tone.
-        """,
-        },
-    ]
-    response = openai_client.chat.completions.create(model="gpt-4", messages=messages, max_tokens=150)
+    messages = build_messages(query_text, context)
+    with metrics.timer("openai_completion_seconds", model=OPENAI_MODEL):
+        response = scheduled_call(
+            "openai_chat", openai_client.chat.completions.create, model=OPENAI_MODEL, messages=messages, max_tokens=150
+        )
     return response.choices[0].message.content.strip()
 
-def main():
+def stream_openai_answer(openai_client, query_text, context):
     """
-    Main function to interactively query OpenAI and Pinecone for answers based on user input.
+    Streams the answer generated by OpenAI as it arrives.
+
+    Parameters:
+    - openai_client: The OpenAI client used to interact with the OpenAI service.
+    - query_text: The question or query to be answered.
+    - context: The context or background information to be used for generating the answer.
+
+    Returns:
+    - A generator of answer pieces, without the leading whitespace of the answer.
     """
-    # Initialize OpenAI and Pinecone clients
-    openai_client = initialize_openai()
-    pinecone_index = get_pinecone_index()
+    messages = build_messages(query_text, context)
+    requested = time.perf_counter()
+    # The request slot is held until the answer starts streaming
+    stream = scheduled_call(
+        "openai_chat",
+        openai_client.chat.completions.create,
+        model=OPENAI_MODEL,
+        messages=messages,
+        max_tokens=150,
+        stream=True,
+    )
+    started = False
+    try:
+        for event in stream:
+            if not event.choices:
+                continue
+            piece = event.choices[0].delta.content
+            if not started and piece:
+                piece = piece.lstrip()
+            if piece:
+                if not started:
+                    metrics.observe("openai_first_token_seconds", time.perf_counter() - requested, model=OPENAI_MODEL)
+                started = True
+                yield piece
+    finally:
+        stream.close()
+        metrics.observe("openai_completion_seconds", time.perf_counter() - requested, model=OPENAI_MODEL)
 
-    # Initialize Box client
-    box_client = get_client()
+def warm_up_openai(openai_client):
+    """
+    Opens a connection to the OpenAI API, so the next request skips the connection setup.
+    """
+    try:
+        openai_client.models.list()
+    except Exception as e:
+        logging.debug(f"OpenAI warm up failed: {e}")
 
-    # Get Box User ID for namespacing
-    box_user = box_client.user().get()
+def answer_question(openai_client, pinecone_index, query_text, box_user_id, top_k=QUERY_TOP_K, cache=None, timings=None):
+    """
+    Answers a question from the indexed files, streaming the answer.
 
+    Parameters:
+    - openai_client: The OpenAI client used to interact with the OpenAI service.
+    - pinecone_index: The Pinecone index to search in.
+    - query_text: The question to be answered.
+    - box_user_id: The namespace identifier for the Box user.
+    - top_k: The number of search results, half of them are kept by the reranker (default is QUERY_TOP_K).
+    - cache: Optional QueryCache, a cached answer is yielded in one piece.
+    - timings: Optional dictionary, filled with the "first_token" and "total" latency in seconds.
+
+    Returns:
+    - A generator of answer pieces.
+    """
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    answer_key = cache_key(
+        "answer", box_user_id, query_text,
+        top_k=top_k, rerank=rerank_config(top_k), model=OPENAI_MODEL, token_budget=CONTEXT_TOKEN_BUDGET,
+    )
+    answer = cache.get(answer_key, box_user_id) if cache is not None else None
+    if answer is not None:
+        timings["first_token"] = timings["total"] = time.perf_counter() - started
+        yield answer
+        return
+
+    # Query Pinecone and retrieve top_k results
+    results = cached_query_pinecone(pinecone_index, query_text, box_user_id, top_k=top_k, cache=cache)
+
+    # Pack the most relevant, diverse chunks into the context token budget
+    with metrics.timer("context_build_seconds"):
+        context, _ = build_context(results['result']['hits'])
+
+    # Use OpenAI to extract the answer
+    pieces = []
+    for piece in stream_openai_answer(openai_client, query_text, context):
+        if not pieces:
+            timings["first_token"] = time.perf_counter() - started
+        pieces.append(piece)
+        yield piece
+    timings["total"] = time.perf_counter() - started
+    timings.setdefault("first_token", timings["total"])
+    metrics.observe("question_seconds", timings["total"])
+
+    answer = "".join(pieces).strip()
+    if cache is not None and answer:
+        cache.put(answer_key, box_user_id, answer)
+
+def ask_server(server_url, query_text, namespace=None, top_k=None, token=QUERY_SERVER_TOKEN, timings=None):
+    """
+    Asks a question to a running query server, streaming the answer.
+
+    Parameters:
+    - server_url: The base URL of the query server, e.g. http://127.0.0.1:8765.
+    - query_text: The question to be answered.
+    - namespace: The namespace to search in (default is the Box user of the server).
+    - top_k: The number of search results (default is the QUERY_TOP_K of the server).
+    - token: The bearer token of the server, if it requires one (default is QUERY_SERVER_TOKEN).
+    - timings: Optional dictionary, filled with the "first_token" and "total" latency in seconds measured by the server.
+
+    Returns:
+    - A generator of answer pieces. Raises RuntimeError if the server answers with an error,
+      urllib.error.URLError if it cannot be reached.
+    """
+    timings = {} if timings is None else timings
+    body = {"question": query_text, "namespace": namespace, "top_k": top_k, "stream": True}
+    request = urllib.request.Request(
+        server_url.rstrip("/") + "/ask",
+        data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json", **({"Authorization": f"Bearer {token}"} if token else {})},
+    )
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read()).get("error")
+        except (ValueError, AttributeError):
+            message = None
+        raise RuntimeError(f"Query server answered {e.code}: {message or e.reason}") from e
+    with response:
+        for line in response:
+            event = json.loads(line)
+            if "error" in event:
+                raise RuntimeError(f"Query server failed to answer: {event['error']}")
+            if "piece" in event:
+                yield event["piece"]
+            else:
+                timings.update(event.get("timings", {}))
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Answer questions about the indexed Box files interactively.")
+    parser.add_argument(
+        "--server",
+        default=QUERY_SERVER_URL,
+        help="The URL of a running query_server.py to send the questions to, instead of answering them in this process.",
+    )
+    parser.add_argument("--namespace", help="The namespace asked through --server (default is the Box user of the server).")
+    return parser.parse_args(argv)
+
+def ask_loop(ask):
+    """
+    Reads questions from the user and prints the answers as they arrive, until 'q' or the end of the input.
+
+    Parameters:
+    - ask: A function(query_text, timings) returning a generator of answer pieces.
+    """
     while True:
         try:
             # Get user input for the question
@@ -76,22 +254,54 @@ def main():
             if query_text.lower() == 'q':
                 break
 
-            # Vectorize the query
-            #query_vector = vectorize_query(pinecone_index, query_text)
+            # Print the answer as it arrives
+            timings = {}
+            print("Answer: ", end="", flush=True)
+            for piece in ask(query_text, timings):
+                print(piece, end="", flush=True)
+            print()
+            if "total" in timings:
+                print(f"(first token after {timings.get('first_token', timings['total']):.2f}s, "
+                      f"total {timings['total']:.2f}s)")
+        except EOFError:
+            print("Exiting...")
+            break
+        except (urllib.error.URLError, ConnectionError, RuntimeError) as e:
+            # The server is down or failed on this question, the next one may succeed
+            print()
+            print(f"Error: {e}")
 
-            # Query Pinecone and retrieve top 5 results
-            results = query_pinecone(pinecone_index, query_text, box_user.id, top_k=5)
+def main(argv=None):
+    """
+    Main function to interactively query OpenAI and Pinecone for answers based on user input.
 
-            # Combine all the relevant chunk texts from the top results
-            combined_text = " ".join(hit['fields']['chunk_text'] for hit in results['result']['hits'])
+    With --server, the questions are sent to a running query server, which keeps its clients warm.
+    """
+    args = parse_args(argv)
+    if args.server:
+        ask_loop(lambda query_text, timings: ask_server(args.server, query_text, args.namespace, timings=timings))
+        return
 
-            # Use OpenAI to extract the answer
-            answer = query_openai_for_answer(openai_client, query_text, combined_text)
+    # Initialize OpenAI and Pinecone clients
+    openai_client = initialize_openai()
+    pinecone_index = get_pinecone_index()
 
-            print(f"Answer: {answer}")
-        except EOFError:
-            print("Exiting...")
-            break
+    # Initialize Box client
+    box_client = get_client()
+
+    # Get Box User ID for namespacing
+    box_user = box_client.user().get()
+
+    # Repeated questions are answered from the cache until the namespace is re-indexed
+    cache = QueryCache() if QUERY_CACHE_ENABLED else None
+
+    ask_loop(lambda query_text, timings: answer_question(
+        openai_client, pinecone_index, query_text, box_user.id, cache=cache, timings=timings
+    ))
+
+    if cache is not None:
+        cache.close()
+    metrics.report()
 
 if __name__ == "__main__":
     main()
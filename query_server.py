@@ -0,0 +1,310 @@
+"""query_server.py"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from box_integration.box_client import get_client
+from pinecone_integration.pinecone_client import get_pinecone_index
+from pinecone_integration.query_cache import QueryCache, QUERY_CACHE_ENABLED
+from common import metrics
+from query import answer_question, initialize_openai, QUERY_TOP_K
+import argparse
+import hmac
+import json
+import threading
+import time
+import config
+import logging
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+QUERY_SERVER_HOST = getattr(config, "QUERY_SERVER_HOST", "127.0.0.1")
+QUERY_SERVER_PORT = getattr(config, "QUERY_SERVER_PORT", 8765)
+# Bearer token required by every endpoint, None to accept any request
+QUERY_SERVER_TOKEN = getattr(config, "QUERY_SERVER_TOKEN", None)
+# The namespaces, besides the one of the server, a request may name. None allows any namespace
+# when a token is required and none otherwise
+QUERY_SERVER_NAMESPACES = getattr(config, "QUERY_SERVER_NAMESPACES", None)
+# Largest accepted request body, in bytes
+MAX_REQUEST_BYTES = 65536
+
+
+class QueryServer(ThreadingHTTPServer):
+    """
+    HTTP server answering questions with clients created once and shared by all requests.
+
+    Every request is handled on its own thread. The OpenAI and Pinecone
+    clients keep their connection pools open between requests, and all
+    requests share the query cache and the request scheduler limits.
+
+    Parameters:
+    - address: The (host, port) to listen on.
+    - openai_client: The OpenAI client used to interact with the OpenAI service.
+    - pinecone_index: The Pinecone index to search in.
+    - namespace: The namespace of the questions that do not name one, the Box user ID of the server.
+    - cache: Optional QueryCache shared by all requests.
+    - token: Optional bearer token required by every endpoint (default is QUERY_SERVER_TOKEN).
+    - namespaces: Optional namespaces, besides namespace, the requests may name (default is
+      QUERY_SERVER_NAMESPACES). When None, any namespace is allowed if a token is required, none otherwise.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, openai_client, pinecone_index, namespace, cache=None, token=QUERY_SERVER_TOKEN,
+                 namespaces=QUERY_SERVER_NAMESPACES):
+        super().__init__(address, QueryRequestHandler)
+        self.openai_client = openai_client
+        self.pinecone_index = pinecone_index
+        self.namespace = namespace
+        self.cache = cache
+        self.token = token
+        self.namespaces = None if namespaces is None else {str(namespace) for namespace in namespaces}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.answered = 0
+        self.failed = 0
+
+    def count(self, in_flight=0, answered=0, failed=0):
+        """Updates the request counts reported by /health."""
+        with self._lock:
+            self.in_flight += in_flight
+            self.answered += answered
+            self.failed += failed
+
+    def allows_namespace(self, namespace):
+        """Checks if the requests may query a namespace."""
+        if namespace == str(self.namespace):
+            return True
+        if self.namespaces is not None:
+            return namespace in self.namespaces
+        return bool(self.token)
+
+    def health(self):
+        """Returns the status of the server as a dictionary."""
+        with self._lock:
+            return {
+                "status": "ok",
+                "namespace": self.namespace,
+                "uptime_seconds": round(time.monotonic() - self.started, 3),
+                "in_flight": self.in_flight,
+                "answered": self.answered,
+                "failed": self.failed,
+            }
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of the query server.
+
+    - POST /ask: answers the JSON body {"question": ..., "namespace": ..., "top_k": ..., "stream": ...}.
+      The namespace defaults to the Box user of the server, another one must be allowed by the
+      server, see QueryServer. With "stream", the answer is sent as JSON lines, {"piece": ...}
+      as it is generated, then {"timings": ...}; otherwise as a single JSON object with the
+      "answer" and the "timings".
+    - GET /health: the status of the server as JSON.
+    - GET /metrics: the metrics in the Prometheus text format.
+
+    Every endpoint requires the bearer token of the server, if it has one.
+    """
+
+    # Keeps the connections of the clients open between requests
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serves /health and /metrics.
+        """
+        if self.path in ("/health", "/metrics") and not self._authorized():
+            self._send_json(401, {"error": "missing or wrong bearer token"})
+        elif self.path == "/health":
+            self._send_json(200, self.server.health())
+        elif self.path == "/metrics":
+            self._send_body(200, metrics.registry.prometheus_text().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Serves /ask.
+        """
+        if self.path != "/ask":
+            self._skip_body()
+            self._send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        if not self._authorized():
+            self._skip_body()
+            self._send_json(401, {"error": "missing or wrong bearer token"})
+            return
+        try:
+            request = self._read_json()
+            question = request.get("question")
+            if not isinstance(question, str) or not question.strip():
+                raise ValueError("question is required")
+            namespace = str(request.get("namespace") or self.server.namespace)
+            top_k = int(request.get("top_k") or QUERY_TOP_K)
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        if not self.server.allows_namespace(namespace):
+            self._send_json(403, {"error": f"namespace {namespace} is not allowed"})
+            return
+
+        self.server.count(in_flight=1)
+        try:
+            if request.get("stream"):
+                self._stream_answer(question, namespace, top_k)
+            else:
+                self._send_answer(question, namespace, top_k)
+        finally:
+            self.server.count(in_flight=-1)
+
+    def _answer(self, question, namespace, top_k, timings):
+        return answer_question(
+            self.server.openai_client, self.server.pinecone_index, question, namespace,
+            top_k=top_k, cache=self.server.cache, timings=timings,
+        )
+
+    def _send_answer(self, question, namespace, top_k):
+        timings = {}
+        try:
+            answer = "".join(self._answer(question, namespace, top_k, timings)).strip()
+        except Exception as e:
+            logging.error(f"Failed to answer question in namespace {namespace}: {e}")
+            self.server.count(failed=1)
+            self._send_json(500, {"error": str(e)})
+            return
+        self.server.count(answered=1)
+        self._send_json(200, {"answer": answer, "timings": _rounded(timings)})
+
+    def _stream_answer(self, question, namespace, top_k):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        timings = {}
+        pieces = self._answer(question, namespace, top_k, timings)
+        try:
+            try:
+                for piece in pieces:
+                    self._write_chunk({"piece": piece})
+                last = {"timings": _rounded(timings)}
+                self.server.count(answered=1)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away, stops the answer
+                self.close_connection = True
+                return
+            except Exception as e:
+                logging.error(f"Failed to answer question in namespace {namespace}: {e}")
+                self.server.count(failed=1)
+                last = {"error": str(e)}
+            self._write_chunk(last)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            pieces.close()
+
+    def _write_chunk(self, payload):
+        data = (json.dumps(payload) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _authorized(self):
+        if not self.server.token:
+            return True
+        expected = f"Bearer {self.server.token}"
+        return hmac.compare_digest(self.headers.get("Authorization", "").encode(), expected.encode())
+
+    def _body_length(self):
+        """Returns the length of the request body, or None if it cannot be read within MAX_REQUEST_BYTES."""
+        if self.headers.get("Transfer-Encoding"):
+            return None
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            return None
+        return length if 0 <= length <= MAX_REQUEST_BYTES else None
+
+    def _skip_body(self):
+        """
+        Reads and drops the request body before an early response, so the next request of the
+        connection starts at the right place. A body that cannot be skipped closes the connection.
+        """
+        length = self._body_length()
+        if length is None:
+            self.close_connection = True
+        elif length:
+            self.rfile.read(length)
+
+    def _read_json(self):
+        length = self._body_length()
+        if length is None:
+            # The body is left unread, the connection cannot be reused
+            self.close_connection = True
+            raise ValueError(f"request body must have a Content-Length of at most {MAX_REQUEST_BYTES} bytes")
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not isinstance(request, dict):
+            raise ValueError("request body must be a JSON object")
+        return request
+
+    def _send_json(self, status, payload):
+        self._send_body(status, json.dumps(payload).encode("utf-8"), "application/json")
+
+    def _send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+def _rounded(timings):
+    return {name: round(seconds, 4) for name, seconds in timings.items()}
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Serve questions about the indexed Box files over HTTP.")
+    parser.add_argument("--host", default=QUERY_SERVER_HOST, help="The address to listen on.")
+    parser.add_argument("--port", type=int, default=QUERY_SERVER_PORT, help="The port to listen on.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Creates the clients once and serves questions until interrupted.
+    """
+    args = parse_args(argv)
+
+    # Initialize OpenAI and Pinecone clients
+    openai_client = initialize_openai()
+    pinecone_index = get_pinecone_index()
+
+    # Get Box User ID for the default namespace
+    box_user = get_client().user().get()
+
+    # Repeated questions are answered from the cache until the namespace is re-indexed
+    cache = QueryCache() if QUERY_CACHE_ENABLED else None
+
+    server = QueryServer((args.host, args.port), openai_client, pinecone_index, box_user.id, cache=cache)
+    print(f"Answering questions on http://{args.host}:{server.server_address[1]}/ask, Ctrl-C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping query server")
+    finally:
+        server.server_close()
+        if cache is not None:
+            cache.close()
+        metrics.report()
+
+if __name__ == "__main__":
+    main()
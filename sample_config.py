@@ -6,4 +6,122 @@ PINECONE_API_KEY = ''
 OPENAI_API_KEY = ''
 REDIRECT_URI = 'http://127.0.0.1:5000/callback'
 CALLBACK_HOSTNAME = '127.0.0.1'
-CALLBACK_PORT = 5000
\ No newline at end of file
+CALLBACK_PORT = 5000
+LOG_LEVEL = 'ERROR'
+
+# Box OAuth tokens: token file shared by all processes, seconds before expiry at which the access token is refreshed
+BOX_TOKEN_PATH = '.oauth.json'
+BOX_TOKEN_REFRESH_MARGIN = 300
+
+# Ingestion pipeline: worker threads per stage and queue size between stages
+INGEST_FETCH_WORKERS = 8
+INGEST_PROCESS_WORKERS = 2
+INGEST_UPSERT_WORKERS = 4
+INGEST_QUEUE_SIZE = 32
+
+# Content-defined chunking: smallest chunk in characters, one sentence end in this many ends a chunk
+CHUNK_MIN_SIZE = 1000
+CHUNK_BOUNDARY_DIVISOR = 6
+
+# Local manifest of indexed files, used to skip unchanged files on re-runs
+MANIFEST_PATH = '.manifest.sqlite'
+# Journal of the progress of main.py runs, used by python main.py --resume
+INGEST_JOURNAL_PATH = '.ingest_journal.jsonl'
+
+# Multi-tenant ingestion (multi_tenant.py): tenants file, journal, tenants authenticated in parallel,
+# folders listed in parallel and representation requests in flight per tenant
+TENANTS_PATH = 'tenants.json'
+TENANTS_JOURNAL_PATH = '.tenants_journal.jsonl'
+TENANT_CONNECT_WORKERS = 8
+TENANT_LISTING_WORKERS = 1
+TENANT_REPRESENTATION_WORKERS = 2
+
+# Folder listing: descend into subfolders, number of folders listed in parallel
+BOX_RECURSIVE = True
+BOX_LISTING_WORKERS = 4
+
+# Event sync daemon (sync_daemon.py)
+BOX_API_URL = 'https://api.box.com/2.0'
+EVENTS_CURSOR_PATH = '.box_events.json'
+EVENTS_DEBOUNCE_SECONDS = 5
+EVENTS_MAX_DELAY_SECONDS = 60
+# Backoff before the first retry of a failed event, doubled on every retry, and attempts before giving up
+EVENTS_RETRY_SECONDS = 10
+EVENTS_MAX_ATTEMPTS = 5
+
+# Stream representations through an incremental cleaner and chunker (bounded memory)
+INGEST_STREAM_TEXT = True
+
+# Clean and chunk documents of at least INGEST_CPU_OFFLOAD_MIN_CHARS characters in worker processes
+# (None for one per core), fetching whole texts instead of streaming them
+INGEST_CPU_OFFLOAD = False
+INGEST_CPU_PROCESSES = None
+INGEST_CPU_OFFLOAD_MIN_CHARS = 1000000
+
+# Local cache of the cleaned text of indexed files, keyed by file ID and SHA-1, and its size limit
+TEXT_CACHE_ENABLED = True
+TEXT_CACHE_PATH = '.text_cache'
+TEXT_CACHE_MAX_BYTES = 1000000000
+
+# Text representations: concurrent requests, polls of a pending one, longest delay between polls
+REPRESENTATION_WORKERS = 8
+REPRESENTATION_MAX_ATTEMPTS = 12
+REPRESENTATION_MAX_DELAY = 60
+
+# Query cache of query.py: in-memory entries, lifetime, SQLite store shared with ingestion (None for memory only)
+QUERY_CACHE_ENABLED = True
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_TTL_SECONDS = 3600
+QUERY_CACHE_PATH = '.query_cache.sqlite'
+# Seconds between two invalidations of a namespace while main.py is writing to it
+QUERY_CACHE_INVALIDATE_SECONDS = 300
+
+# Prompt context of query.py: search results (half kept after reranking), token budget, relevance vs diversity
+QUERY_TOP_K = 10
+CONTEXT_TOKEN_BUDGET = 1500
+CONTEXT_MMR_LAMBDA = 0.7
+
+# Query server (query_server.py): listening address, bearer token required by every endpoint (None for none),
+# and the URL query.py sends the questions to (None to answer them in query.py itself)
+QUERY_SERVER_HOST = '127.0.0.1'
+QUERY_SERVER_PORT = 8765
+QUERY_SERVER_TOKEN = None
+# Namespaces besides the server's own that the questions may name (None: any with a token, none without)
+QUERY_SERVER_NAMESPACES = None
+QUERY_SERVER_URL = None
+
+# Batch questions (batch_query.py): questions answered at once, the requests go through the request scheduler
+BATCH_QUERY_WORKERS = 12
+
+# Metrics: per stage counters and latency histograms, summary printed at the end of a run, optional exports
+METRICS_ENABLED = False
+METRICS_PROMETHEUS_PATH = None
+METRICS_OTLP_PATH = None
+# cProfile and tracemalloc report of main.py and batch_query.py
+PROFILE_ENABLED = False
+PROFILE_TOP = 20
+
+# Pinecone Assistant demo: name of the assistant reused across runs, files synced in parallel
+ASSISTANT_NAME = 'box-assistant'
+ASSISTANT_SYNC_WORKERS = 4
+
+# Pinecone upserts: records and bytes per request, requests in flight per namespace, retries
+UPSERT_MAX_RECORDS = 96
+UPSERT_MAX_BYTES = 2000000
+UPSERT_CONCURRENCY = 4
+UPSERT_MAX_RETRIES = 5
+# Requests in flight updating the chunk positions of the reused chunks of an edited file
+PINECONE_UPDATE_WORKERS = 8
+
+# HTTP session used for Box downloads: (connect, read) timeouts, retries of connection errors, pool size
+HTTP_TIMEOUT = (10, 120)
+HTTP_MAX_RETRIES = 5
+HTTP_POOL_SIZE = 12
+BOX_DOWNLOAD_WORKERS = 8
+
+# Request scheduler: per endpoint class overrides of the initial and largest concurrency and of the
+# requests per second (see DEFAULT_ENDPOINT_LIMITS in common/rate_limiter.py), attempts of a throttled
+# request and the delay before its first retry when the service sends no Retry-After
+SCHEDULER_ENDPOINTS = {}
+SCHEDULER_MAX_ATTEMPTS = 6
+SCHEDULER_BACKOFF_SECONDS = 0.5
@@ -0,0 +1,58 @@
+"""sync_daemon.py"""
+
+from box_integration.box_client import get_client
+from box_integration.box_events import EventCursor, EventStream
+from pinecone_integration.pinecone_client import get_pinecone_index
+from ingestion.event_sync import run_event_sync
+from ingestion.indexer import MANIFEST_PATH
+from ingestion.manifest import Manifest
+from common import metrics
+import config
+import logging
+
+log_level = getattr(logging, config.LOG_LEVEL.upper(), logging.ERROR)
+logging.basicConfig(level=log_level)
+logging.getLogger("box-pinecone-integration")
+
+def main():
+    """
+    Long running mode that keeps the Pinecone index in sync with the Box folder by following the Box events stream.
+    """
+    # Initialize Box client
+    logging.info("Initializing Box client")
+    box_client = get_client()
+
+    # Get Box User ID for namespacing
+    logging.info("Getting Box user ID")
+    box_user = box_client.user().get()
+
+    # Initialize Pinecone client
+    pinecone_index = get_pinecone_index()
+
+    stream = EventStream(
+        get_access_token=lambda: box_client.auth.access_token,
+        refresh_access_token=box_client.auth.refresh,
+    )
+    cursor = EventCursor(getattr(config, "EVENTS_CURSOR_PATH", ".box_events.json"))
+    manifest = Manifest(MANIFEST_PATH)
+
+    logging.info(f"Following Box events for folder {config.BOX_FOLDER_ID}")
+    try:
+        run_event_sync(
+            box_client,
+            stream,
+            cursor,
+            pinecone_index,
+            manifest,
+            box_user.id,
+            config.BOX_FOLDER_ID,
+            recursive=getattr(config, "BOX_RECURSIVE", True),
+        )
+    except KeyboardInterrupt:
+        logging.info("Stopping event sync")
+    finally:
+        manifest.close()
+        metrics.report()
+
+if __name__ == "__main__":
+    main()